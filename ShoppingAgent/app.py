@@ -1,16 +1,20 @@
 import streamlit as st
+import os
 import sys
-import io
-from contextlib import redirect_stdout
-from dotenv import load_dotenv
+from config import load_config
 
-# Import the agent's core components
+# Settings in .env must reach the environment before the modules below read them
+load_config()
+
+# Import the agent's core components. The agent itself (Gemini SDK, HTTP client, HTML parser)
+# is imported when the first session initializes it, so the page renders without waiting for it.
 from knowledge_base import KnowledgeBase
-from llm_agent import LLMAgent
-from discovery import find_local_stores, get_national_stores, get_international_stores, verify_communication_methods
+from discovery import load_stores
+import tracing
+from events import ToolCallStarted, ToolCallFinished, ProductsFound, AnswerToken, QueryFinished
 
-# Load environment variables from .env file
-load_dotenv()
+# The dashboard shows the agent's spans instead of captured console output
+tracing.enable()
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -19,39 +23,99 @@ st.set_page_config(
     layout="wide"
 )
 
+# Tool calls of all sessions share one pool
+SHARED_TOOL_WORKERS = int(os.getenv("SHARED_TOOL_WORKERS", "32"))
+
+# --- Shared Resources ---
+# Built once per process and shared by every session, so a new session costs almost nothing
+@st.cache_resource
+def get_knowledge_base():
+    return KnowledgeBase()
+
+@st.cache_resource
+def get_agent_resources():
+    """The Gemini client, toolbox, tool executor, recommendation cache and plan cache shared by all sessions."""
+    if not os.getenv("GEMINI_API_KEY"):
+        raise ValueError("GEMINI_API_KEY not found in .env file.")
+    from google import genai
+    from tools import ToolBox
+    from tool_executor import ToolExecutor
+    from recommendation_cache import RecommendationCache
+    from plan_cache import PlanCache
+    toolbox = ToolBox(get_knowledge_base())
+    tool_executor = ToolExecutor(toolbox.get_tool_functions(), max_workers=SHARED_TOOL_WORKERS, events=toolbox.events)
+    recommendation_cache = RecommendationCache(get_knowledge_base(), toolbox.catalog)
+    plan_cache = PlanCache(get_knowledge_base(), toolbox.ranking_engine)
+    return genai.Client(), toolbox, tool_executor, recommendation_cache, plan_cache
+
+def create_agent():
+    """The per-session agent: a thin wrapper around the shared resources."""
+    from llm_agent import LLMAgent
+    client, toolbox, tool_executor, recommendation_cache, plan_cache = get_agent_resources()
+    return LLMAgent(get_knowledge_base(), client=client, toolbox=toolbox, tool_executor=tool_executor,
+                    recommendation_cache=recommendation_cache, plan_cache=plan_cache)
+
 # --- Agent Setup Function ---
 # This is a modified version of the setup logic from main.py, adapted for Streamlit
-def setup_agent(kb, location):
-    """Performs the discovery and populates the KB."""
-    st.write(f"📍 Performing store discovery for location: '{location}'...")
-    all_stores = []
-    all_stores.extend(find_local_stores(location))
-    all_stores.extend(get_national_stores())
-    all_stores.extend(get_international_stores())
-
-    st.write("📡 Verifying communication methods for all discovered stores...")
-    for store in all_stores:
-        verified_methods = verify_communication_methods(store['name'])
-        kb.add_shop(
-            name=store['name'],
-            scope=store['scope'],
-            mcp_enabled=verified_methods.get('mcp_enabled', False),
-            mcp_url=verified_methods.get('mcp_url'),
-            api_enabled=verified_methods.get('api_enabled', False),
-            api_url=verified_methods.get('api_url'),
-            scraping_enabled=True
-        )
-    st.write("✅ Knowledge Base is populated and ready.")
+def discover_stores(location):
+    """
+    Makes the location's stores available in the shared KB. After the first discovery of a location this
+    only reads its saved snapshot, and starts a background refresh when it is stale. Returns (store count, warm).
+    """
+    return load_stores(get_knowledge_base(), location)
+
+def _describe_event(event):
+    """One status line per tool event."""
+    if isinstance(event, ToolCallStarted):
+        target = event.args.get('shop_name')
+        return f"🔧 `{event.name}`" + (f" → {target}" if target else "")
+    if isinstance(event, ToolCallFinished):
+        if event.error:
+            return f"❌ `{event.name}` failed after {event.latency:.2f}s: {event.error}"
+        return f"✔️ `{event.name}` finished in {event.latency:.2f}s"
+    if isinstance(event, ProductsFound):
+        first = event.products[0]
+        return f"🛒 {len(event.products)} product(s) from {event.shop_name}, e.g. {first.get('name') or first.get('title')}"
+    return None
+
+def run_query_live(agent, query):
+    """
+    Renders the agent's events as they happen: tool progress in a status box, the answer
+    token by token below it. Returns the final answer.
+    """
+    status = st.status("🤖 AI Agent is working...", expanded=True)
+    answer_box = st.empty()
+    answer = ""
+    for event in agent.stream_user_query(query):
+        if isinstance(event, AnswerToken):
+            answer += event.text
+            answer_box.markdown(answer)
+        elif isinstance(event, QueryFinished):
+            # The results section below renders the final answer
+            answer_box.empty()
+            status.update(label=f"✅ Done in {event.elapsed:.1f}s", state="complete", expanded=False)
+            return event.answer
+        else:
+            if isinstance(event, ToolCallStarted) and answer:
+                # The streamed text was the model thinking before more tool calls, not the answer
+                status.write(answer)
+                answer = ""
+                answer_box.empty()
+            line = _describe_event(event)
+            if line:
+                status.write(line)
 
 # --- Session State Initialization ---
-# This ensures our agent and KB persist across user interactions
+# Per session only the lightweight agent (configuration), the trace buffer and the last answer are kept
 if 'agent' not in st.session_state:
     st.session_state.agent = None
-    st.session_state.kb = None
     st.session_state.setup_complete = False
-    st.session_state.logs = ""
+    # Bounded: old spans fall out of the ring buffer instead of accumulating for the whole session
+    st.session_state.trace = tracing.TraceBuffer()
     st.session_state.recommendation = ""
 
+# Spans started during this run (and in threads it hands work to) go to this session's buffer
+tracing.use_buffer(st.session_state.trace)
 
 # --- Main Application UI ---
 st.title("🤖 AI Shopping Agent Dashboard")
@@ -64,7 +128,7 @@ st.info(
 with st.expander("Step 1: Initial Agent Setup", expanded=not st.session_state.setup_complete):
     location = st.text_input(
         "Enter your location to find local stores (e.g., 'New York, NY')",
-        ""
+        get_knowledge_base().last_discovery_location() or ""
     )
     
     if st.button("Initialize Agent"):
@@ -72,15 +136,14 @@ with st.expander("Step 1: Initial Agent Setup", expanded=not st.session_state.se
             st.error("Please enter a location.")
         else:
             with st.spinner("Performing first-time setup... This may take a moment."):
-                # Capture print statements as logs
-                log_capture_string = io.StringIO()
-                with redirect_stdout(log_capture_string):
-                    # Initialize KB and Agent, storing them in the session state
-                    st.session_state.kb = KnowledgeBase()
-                    setup_agent(st.session_state.kb, location)
-                    st.session_state.agent = LLMAgent(knowledge_base=st.session_state.kb)
-                
-                st.session_state.logs = log_capture_string.getvalue()
+                st.write(f"📍 Performing store discovery for location: '{location}'...")
+                store_count, warm = discover_stores(location)
+                if warm:
+                    st.write(f"✅ Using {store_count} previously discovered stores; they are refreshed in the background when stale.")
+                else:
+                    st.write(f"✅ Knowledge Base is populated with {store_count} stores and ready.")
+                st.session_state.agent = create_agent()
+
                 st.session_state.setup_complete = True
                 st.success("Agent initialized successfully!")
                 # We don't need a rerun here, Streamlit will handle it.
@@ -98,16 +161,10 @@ if st.session_state.setup_complete:
         if not query:
             st.error("Please enter a product query.")
         else:
-            with st.spinner("🤖 AI Agent is thinking... Calling APIs and analyzing results..."):
-                # Capture logs for this specific query
-                log_capture_string = io.StringIO()
-                with redirect_stdout(log_capture_string):
-                    recommendation = st.session_state.agent.process_user_query(query)
-                
-                # Store results in session state to display them
-                st.session_state.recommendation = recommendation
-                # Prepend new logs to existing logs
-                st.session_state.logs = log_capture_string.getvalue() + "\n" + st.session_state.logs
+            recommendation = run_query_live(st.session_state.agent, query)
+
+            # Store results in session state to display them
+            st.session_state.recommendation = recommendation
 
 # --- Results Section ---
 if st.session_state.recommendation:
@@ -115,7 +172,7 @@ if st.session_state.recommendation:
     st.markdown(st.session_state.recommendation, unsafe_allow_html=True)
 
     with st.expander("View Agent's Thought Process (Logs)"):
-        st.text_area("Logs", st.session_state.logs, height=400, key="logs_textarea")
+        st.text_area("Trace", tracing.format_tree(st.session_state.trace.recent()), height=400, key="logs_textarea")
 
 else:
     if st.session_state.setup_complete:
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from google.genai import types
+from knowledge_base import KnowledgeBase
+from llm_agent import LLMAgent, ERROR_ANSWER
+from tools import ToolBox
+from tool_executor import AsyncToolExecutor
+from conversation import ConversationContext
+from recommendation_cache import RecommendationCache
+from plan_cache import PlanCache
+from events import AnswerToken, QueryFinished
+from tracing import log, span
+
+# Queries running at once per agent; beyond that they wait in the admission queue, which is bounded too
+MAX_CONCURRENT_QUERIES = int(os.getenv("AGENT_MAX_CONCURRENT_QUERIES", "64"))
+MAX_QUEUED_QUERIES = int(os.getenv("AGENT_MAX_QUEUED_QUERIES", "256"))
+# Waiting queries one session may hold, so a single client cannot fill the queue
+MAX_QUEUED_PER_SESSION = 4
+# Assumed query duration for retry_after until real queries have been timed
+INITIAL_QUERY_SECONDS = 10.0
+QUERY_SECONDS_SMOOTHING = 0.2
+
+class AgentSaturatedError(Exception):
+    def __init__(self, message, retry_after):
+        """The agent cannot take the query now; `retry_after` is a rough wait in seconds before trying again."""
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionQueue:
+    def __init__(self, max_concurrent=MAX_CONCURRENT_QUERIES, max_queued=MAX_QUEUED_QUERIES,
+                 max_queued_per_session=MAX_QUEUED_PER_SESSION):
+        """
+        Lets at most `max_concurrent` queries run. Waiting queries are grouped by session and admitted
+        round-robin, so a session with many queries cannot starve the others. A full queue refuses new
+        queries at once with AgentSaturatedError rather than letting latency grow without bound.
+        Belongs to one event loop and needs no locks.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_session = max_queued_per_session
+        self.running = 0
+        self.queued = 0
+        # session id -> its waiting queries (futures), in the order the sessions get their next turn
+        self.waiting = OrderedDict()
+        self.query_seconds = INITIAL_QUERY_SECONDS
+        self.counters = {'admitted': 0, 'waited': 0, 'rejected': 0}
+
+    def retry_after(self):
+        """Seconds until the queue has roughly drained at the current query duration."""
+        return round(self.query_seconds * (self.queued + 1) / self.max_concurrent, 1)
+
+    def _reject(self, reason):
+        self.counters['rejected'] += 1
+        retry_after = self.retry_after()
+        raise AgentSaturatedError(f"{reason}; retry in about {retry_after:.0f}s.", retry_after)
+
+    async def acquire(self, session_id):
+        if self.running < self.max_concurrent and not self.queued:
+            self.running += 1
+            self.counters['admitted'] += 1
+            return
+        waiting = self.waiting.get(session_id)
+        if self.queued >= self.max_queued:
+            self._reject(f"The agent is saturated ({self.running} running, {self.queued} queued)")
+        if waiting and len(waiting) >= self.max_queued_per_session:
+            self._reject(f"Too many queries waiting for this session ({len(waiting)})")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(session_id, deque()).append(future)
+        self.queued += 1
+        self.counters['waited'] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller gave up: pass it on
+                self.release()
+            else:
+                self._forget(session_id, future)
+            raise
+        self.counters['admitted'] += 1
+
+    def _forget(self, session_id, future):
+        waiting = self.waiting.get(session_id)
+        if waiting and future in waiting:
+            waiting.remove(future)
+            self.queued -= 1
+            if not waiting:
+                del self.waiting[session_id]
+
+    def release(self, elapsed=None):
+        """Frees a slot, handing it straight to the next session in turn if any query is waiting."""
+        if elapsed is not None:
+            self.query_seconds += QUERY_SECONDS_SMOOTHING * (elapsed - self.query_seconds)
+        while self.waiting:
+            session_id, waiting = next(iter(self.waiting.items()))
+            future = waiting.popleft()
+            self.queued -= 1
+            if waiting:
+                self.waiting.move_to_end(session_id)
+            else:
+                del self.waiting[session_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def admit(self, session_id):
+        await self.acquire(session_id)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start_time)
+
+    def stats(self):
+        return dict(self.counters, running=self.running, queued=self.queued, sessions_waiting=len(self.waiting),
+                    retry_after=self.retry_after())
+
+class AsyncLLMAgent(LLMAgent):
+    def __init__(self, knowledge_base: KnowledgeBase, client=None, toolbox: ToolBox = None,
+                 recommendation_cache: RecommendationCache = None, async_tool_executor: AsyncToolExecutor = None,
+                 admission: AdmissionQueue = None, plan_cache: PlanCache = None):
+        """
+        The agent loop on asyncio: Gemini is called through the SDK's async client (client.aio) and the
+        tools are coroutines, so one process serves many concurrent queries without a thread each.
+        Queries go through a bounded, per-session fair admission queue.
+        """
+        super().__init__(knowledge_base, client=client, toolbox=toolbox, recommendation_cache=recommendation_cache,
+                         plan_cache=plan_cache)
+        self.async_tool_executor = async_tool_executor or AsyncToolExecutor(self.toolbox.get_async_tool_functions(),
+                                                                            events=self.events)
+        self.admission = admission or AdmissionQueue()
+
+    async def process_user_query_async(self, user_query: str, session_id=None, on_event=None) -> str:
+        """
+        Async process_user_query. Queries of the same `session_id` count against that session's share
+        of the queue; raises AgentSaturatedError at once when the query cannot be queued.
+        """
+        async with self.admission.admit(session_id if session_id is not None else object()):
+            token = self.events.listen(on_event) if on_event else None
+            try:
+                start_time = time.monotonic()
+                with span("query", query=user_query) as query_span:
+                    answer = await asyncio.to_thread(self.recommendations.lookup, user_query)
+                    if answer is not None:
+                        query_span.set(cached=True)
+                        log(f"[LLM Agent] Answering '{user_query}' from the recommendation cache.")
+                        self.events.emit(AnswerToken(answer))
+                    else:
+                        answer = await self._run_query_async(user_query)
+                        if answer != ERROR_ANSWER:
+                            await asyncio.to_thread(self.recommendations.store, user_query, answer,
+                                                    self.toolbox.current_query().sources)
+                self.events.emit(QueryFinished(answer, time.monotonic() - start_time))
+                return answer
+            finally:
+                if token is not None:
+                    self.events.stop_listening(token)
+
+    async def _generate_async(self, contents, config):
+        parts, usage = [], None
+        with span("gemini_round_trip", model=self.model_name) as round_trip:
+            stream = await self.client.aio.models.generate_content_stream(model=self.model_name, contents=contents, config=config)
+            async for chunk in stream:
+                usage = self._absorb_chunk(chunk, parts) or usage
+            round_trip.set(prompt_tokens=usage.prompt_token_count if usage else None,
+                           function_calls=sum(1 for part in parts if part.function_call))
+        return types.Content(role="model", parts=parts), usage
+
+    async def _replay_plan_async(self, user_query: str, stages) -> str:
+        """Async _replay_plan: the stages' calls run as tasks on the async tool executor."""
+        log(f"[LLM Agent] Replaying a recorded plan of {sum(len(stage) for stage in stages)} tool call(s).")
+        context = ConversationContext(self.system_prompt, user_query)
+        try:
+            with span("plan_replay", stages=len(stages)):
+                for calls in stages:
+                    tool_responses = await self.async_tool_executor.run(calls)
+                    if not self._replayed(user_query, context, calls, tool_responses):
+                        return None
+                contents, estimated_tokens = self._synthesis_contents(context)
+                model_content, usage = await self._generate_async(contents, self.final_answer_config)
+                self._record_turn(context, usage, estimated_tokens)
+        except Exception as e:
+            log(f"[LLM Agent] Plan replay failed: {e}")
+            self.plans.invalidate(user_query)
+            return None
+        return self._replayed_answer(user_query, model_content)
+
+    async def _run_query_async(self, user_query: str) -> str:
+        log(f"\n[LLM Agent] Starting to process query: '{user_query}'")
+        self.toolbox.start_query()
+
+        stages = await asyncio.to_thread(self.plans.lookup, user_query)
+        if stages is not None:
+            answer = await self._replay_plan_async(user_query, stages)
+            if answer is not None:
+                return answer
+            self.toolbox.current_query().reset_results()
+
+        context = ConversationContext(self.system_prompt, user_query)
+        config = self.config
+        turns = []
+
+        while True:
+            log("[LLM Agent] Sending request to Gemini...")
+            try:
+                contents, estimated_tokens = context.contents()
+                model_content, usage = await self._generate_async(contents, config)
+                self._record_turn(context, usage, estimated_tokens)
+
+                calls = self._tool_calls(context, model_content)
+                if calls:
+                    tool_responses = await self.async_tool_executor.run(calls)
+                    turns.append((calls, tool_responses))
+                    config = self._add_tool_results(context, calls, tool_responses, config)
+                else:
+                    answer = self._final_answer(model_content)
+                    if answer:
+                        await asyncio.to_thread(self.plans.store, user_query, turns)
+                    return answer
+
+            except Exception as e:
+                log(f"[LLM Agent] An error occurred during generation: {e}")
+                return ERROR_ANSWER
@@ -0,0 +1,204 @@
+"""
+End-to-end benchmark for the LLM agent against local stand-in stores and a scripted Gemini client.
+
+    python benchmarks/bench_agent.py --queries 40 --concurrency 8 --time-scale 0.1
+
+Reports per-query latency percentiles, throughput, tool-call counts and KB writes, and can
+save them as JSON (--output) to compare against a previous run (--baseline).
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from knowledge_base import KnowledgeBase
+from llm_agent import LLMAgent
+from async_agent import AsyncLLMAgent, AdmissionQueue
+from transport import get_async_transport
+from stand_in_stores import StandInStore
+from fake_gemini import ScriptedGeminiClient
+
+# (shop name, scope, profile): a mix of fast API stores and slow scrape-only stores
+DEFAULT_STORES = [
+    ('Amazon', 'international', 'api'),
+    ('ebay', 'international', 'api'),
+    ('AliExpress', 'international', 'scraping'),
+    ('Exito', 'national', 'scraping'),
+    ('Ktronix', 'national', 'api'),
+    ('Panamericana', 'national', 'scraping'),
+]
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def run_benchmark(queries=20, concurrency=4, time_scale=0.1, unique_queries=None, think_time=0.0, seed=7, async_agent=False,
+                  answer_cache=True):
+    tmp_dir = tempfile.mkdtemp(prefix="agent-bench-")
+    with contextlib.redirect_stdout(io.StringIO()):
+        kb = KnowledgeBase(db_file=os.path.join(tmp_dir, "bench_shops.db"))
+        stores, store_specs = [], {}
+        for index, (name, scope, profile) in enumerate(DEFAULT_STORES):
+            store = StandInStore.from_profile(name, profile, time_scale=time_scale, seed=seed + index).start()
+            stores.append(store)
+            store_specs[name] = (store.url, 'api' if profile == 'api' else 'scraping')
+            kb.add_shop(name, scope, api_enabled=profile == 'api', scraping_enabled=True,
+                        api_url=store.url if profile == 'api' else None)
+
+    tool_calls = {}
+    tool_calls_lock = threading.Lock()
+    clients = []
+    shared = {}
+    local = threading.local()
+
+    def agent_for_thread():
+        """One agent per worker thread: the KB and transport are shared, the conversation state is not."""
+        if not hasattr(local, 'agent'):
+            client = ScriptedGeminiClient(store_specs, think_time=think_time)
+            clients.append(client)
+            # Sessions share one recommendation cache and one plan cache, as in the app
+            with tool_calls_lock:
+                agent = LLMAgent(kb, client=client, recommendation_cache=shared.get('recommendations'),
+                                 plan_cache=shared.get('plans'))
+                shared.setdefault('recommendations', agent.recommendations)
+                shared.setdefault('plans', agent.plans)
+                if not answer_cache:
+                    agent.recommendations.max_entries = 0
+            for name, function in list(agent.tool_functions.items()):
+                agent.tool_functions[name] = counted(name, function)
+            local.agent = agent
+        return local.agent
+
+    def counted(name, function):
+        def wrapper(**kwargs):
+            with tool_calls_lock:
+                tool_calls[name] = tool_calls.get(name, 0) + 1
+            return function(**kwargs)
+        return wrapper
+
+    unique_queries = unique_queries or queries
+    query_texts = [f"4k tv model {i % unique_queries}" for i in range(queries)]
+    latencies = []
+
+    def run_query(text):
+        start_time = time.monotonic()
+        agent_for_thread().process_user_query(text)
+        latencies.append(time.monotonic() - start_time)
+
+    def counted_async(name, function):
+        async def wrapper(**kwargs):
+            with tool_calls_lock:
+                tool_calls[name] = tool_calls.get(name, 0) + 1
+            return await function(**kwargs)
+        return wrapper
+
+    async def run_all_async():
+        """Every query in flight at once on one event loop; the admission queue runs `concurrency` of them."""
+        client = ScriptedGeminiClient(store_specs, think_time=think_time)
+        clients.append(client)
+        agent = AsyncLLMAgent(kb, client=client, admission=AdmissionQueue(
+            max_concurrent=concurrency, max_queued=queries, max_queued_per_session=queries))
+        shared['recommendations'] = agent.recommendations
+        shared['plans'] = agent.plans
+        if not answer_cache:
+            agent.recommendations.max_entries = 0
+        tools = agent.async_tool_executor.tool_functions
+        for name, function in list(tools.items()):
+            tools[name] = counted_async(name, function)
+
+        async def run_query_async(index, text):
+            start_time = time.monotonic()
+            await agent.process_user_query_async(text, session_id=index % concurrency)
+            latencies.append(time.monotonic() - start_time)
+
+        await asyncio.gather(*(run_query_async(i, text) for i, text in enumerate(query_texts)))
+        await get_async_transport().close()
+
+    writes_before = kb.conn.total_changes
+    with contextlib.redirect_stdout(io.StringIO()):
+        wall_start = time.monotonic()
+        if async_agent:
+            asyncio.run(run_all_async())
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                list(pool.map(run_query, query_texts))
+        wall_time = time.monotonic() - wall_start
+        kb.flush()
+
+    latencies.sort()
+    report = {
+        'queries': queries,
+        'concurrency': concurrency,
+        'async_agent': async_agent,
+        'time_scale': time_scale,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'throughput_qps': queries / wall_time if wall_time else None,
+        'wall_time': wall_time,
+        'model_calls': sum(client.models.calls for client in clients),
+        'tool_calls': dict(sorted(tool_calls.items())),
+        'kb_row_writes': kb.conn.total_changes - writes_before,
+        'kb_metric_flushes': kb.metrics_writer.flushes,
+        'store_requests': {store.name: store.requests for store in stores},
+        'recommendation_cache': shared['recommendations'].stats() if shared else None,
+        'plan_cache': shared['plans'].stats() if shared else None,
+    }
+    kb.close()
+    for store in stores:
+        store.stop()
+    return report
+
+def compare(report, baseline, tolerance):
+    """Returns the latency/throughput metrics that regressed by more than `tolerance` against the baseline."""
+    regressions = []
+    for key in ('latency_p50', 'latency_p95', 'latency_p99'):
+        if baseline.get(key) and report.get(key) and report[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key}: {report[key]:.3f}s vs baseline {baseline[key]:.3f}s")
+    if baseline.get('throughput_qps') and report.get('throughput_qps') and report['throughput_qps'] < baseline['throughput_qps'] * (1 - tolerance):
+        regressions.append(f"throughput_qps: {report['throughput_qps']:.2f} vs baseline {baseline['throughput_qps']:.2f}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shopping agent against local stand-in stores.")
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--time-scale', type=float, default=0.1, help="Multiplier for the stores' simulated latency.")
+    parser.add_argument('--unique-queries', type=int, default=None, help="Repeat this many distinct queries (exercises caches).")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Simulated model latency per round trip, in seconds.")
+    parser.add_argument('--async-agent', action='store_true', help="Serve all queries from one event loop with AsyncLLMAgent.")
+    parser.add_argument('--no-answer-cache', action='store_true',
+                        help="Never reuse final answers, so repeated queries replay their recorded tool plans.")
+    parser.add_argument('--output', help="Write the report as JSON to this file.")
+    parser.add_argument('--baseline', help="Compare against a previously saved JSON report.")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression against the baseline.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.queries, args.concurrency, args.time_scale, args.unique_queries, args.think_time,
+                           async_agent=args.async_agent, answer_cache=not args.no_answer_cache)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Startup benchmark for the CLI (main.py) and the dashboard (app.py).
+
+    python benchmarks/bench_startup.py --runs 5
+
+Measures each entry point's import time with `python -X importtime`, checks that the heavy modules
+meant to load on first use (Gemini SDK, HTTP client, HTML parser) are not imported at startup, and
+times `python main.py` until its first prompt. Exits non-zero when a measurement exceeds the budget
+in startup_budget.json; --record rewrites that budget from the current measurements.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+AGENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_budget.json")
+# Loaded on first use, never by merely starting an entry point
+DEFERRED_MODULES = ['google.genai', 'httpx', 'lxml', 'tenacity', 'numpy', 'pyarrow']
+FIRST_PROMPT = "Please enter your location"
+FIRST_PROMPT_TIMEOUT = 30.0
+# Recorded budgets leave this much headroom over the measurement, for noisy machines
+RECORD_HEADROOM = 2.0
+SLOWEST_IMPORTS = 8
+
+def _env():
+    # A placeholder key gets main.py past its check; nothing here calls the API
+    return dict(os.environ, PYTHONPATH=AGENT_DIR, GEMINI_API_KEY=os.getenv("GEMINI_API_KEY", "startup-benchmark"))
+
+def import_profile(module, work_dir):
+    """(total import ms, {imported module: cumulative ms}) for importing one entry point in a fresh interpreter."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=work_dir, env=_env(),
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    # Nested imports are reported before their parent; a top-level line closes the group above it,
+    # which separates the entry point's imports from the interpreter's own startup
+    group = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        group[name.strip()] = int(cumulative) / 1000
+        if not name[1:].startswith(" "):
+            if name.strip() == module:
+                return group.pop(module), group
+            group = {}
+    return 0.0, {}
+
+def time_to_first_prompt(work_dir):
+    """Milliseconds from launching main.py until its first prompt is on screen."""
+    start_time = time.monotonic()
+    process = subprocess.Popen([sys.executable, "-u", os.path.join(AGENT_DIR, "main.py")], cwd=work_dir, env=_env(),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    output = ""
+    try:
+        while FIRST_PROMPT not in output:
+            char = process.stdout.read(1)
+            if not char or time.monotonic() - start_time > FIRST_PROMPT_TIMEOUT:
+                raise RuntimeError(f"main.py exited or stalled before its first prompt:\n{output[-2000:]}")
+            output += char
+        return (time.monotonic() - start_time) * 1000
+    finally:
+        process.kill()
+        process.wait()
+
+def _streamlit_available():
+    try:
+        import streamlit  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def run_benchmark(runs=3):
+    """Best of `runs` for every measurement; the best run is the one least disturbed by the machine."""
+    report = {'runs': runs}
+    entry_points = ['main'] + (['app'] if _streamlit_available() else [])
+    with tempfile.TemporaryDirectory(prefix="startup-bench-") as work_dir:
+        for module in entry_points:
+            profiles = [import_profile(module, work_dir) for _ in range(runs)]
+            total, imports = min(profiles, key=lambda profile: profile[0])
+            report[module] = {
+                'import_ms': round(total, 1),
+                'deferred_modules_loaded': sorted(
+                    name for name in DEFERRED_MODULES if any(i == name or i.startswith(name + ".") for i in imports)
+                ),
+                'slowest_imports': dict(sorted(((name, round(ms, 1)) for name, ms in imports.items()),
+                                               key=lambda item: -item[1])[:SLOWEST_IMPORTS]),
+            }
+        report['main']['first_prompt_ms'] = round(min(time_to_first_prompt(work_dir) for _ in range(runs)), 1)
+    if 'app' not in report:
+        report['app'] = None
+    return report
+
+def check(report, budget):
+    """Returns the measurements over budget and the deferred modules that were loaded at startup."""
+    violations = []
+    for entry_point, limits in budget.items():
+        measured = report.get(entry_point)
+        if measured is None:
+            continue
+        for key, limit in limits.items():
+            if measured.get(key) is not None and measured[key] > limit:
+                violations.append(f"{entry_point}.{key}: {measured[key]:.1f}ms over budget {limit:.1f}ms")
+        for name in measured['deferred_modules_loaded']:
+            violations.append(f"{entry_point}: '{name}' is imported at startup")
+    return violations
+
+def record(report, path):
+    budget = {}
+    for entry_point in ('main', 'app'):
+        if report.get(entry_point):
+            budget[entry_point] = {key: round(value * RECORD_HEADROOM) for key, value in report[entry_point].items()
+                                   if key.endswith('_ms')}
+    if os.path.exists(path):
+        with open(path) as f:
+            # Entry points that could not be measured here keep their recorded budget
+            budget = dict(json.load(f), **budget)
+    with open(path, 'w') as f:
+        json.dump(budget, f, indent=2)
+        f.write("\n")
+    return budget
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the CLI and the dashboard.")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--budget', default=BUDGET_FILE, help="Startup budget to check against.")
+    parser.add_argument('--record', action='store_true', help="Write the current measurements (with headroom) as the budget.")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.runs)
+    print(json.dumps(report, indent=2))
+    if args.record:
+        print(f"Recorded budget: {json.dumps(record(report, args.budget))}")
+        return
+
+    with open(args.budget) as f:
+        violations = check(report, json.load(f))
+    for violation in violations:
+        print(f"REGRESSION {violation}")
+    sys.exit(1 if violations else 0)
+
+if __name__ == "__main__":
+    main()
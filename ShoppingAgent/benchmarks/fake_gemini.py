@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import quote_plus
+from google.genai import types
+from conversation import ConversationContext
+
+class ScriptedGeminiClient:
+    def __init__(self, stores, think_time=0.0, min_catalog_offers=3):
+        """
+        Stand-in for genai.Client. It plays the tool plan the real model usually follows:
+        read the KB and the local catalog, query every store (API when it has one, scraping
+        otherwise) unless the catalog had `min_catalog_offers` fresh offers, rank, answer.
+        `stores` maps shop name to (base_url, method); `think_time` simulates model latency.
+        """
+        self.models = _ScriptedModels(stores, think_time, min_catalog_offers)
+        # The SDK's async surface (client.aio.models), playing the same script
+        self.aio = _AsyncScriptedClient(self.models)
+
+class _ScriptedModels:
+    def __init__(self, stores, think_time, min_catalog_offers):
+        self.stores = stores
+        self.think_time = think_time
+        self.min_catalog_offers = min_catalog_offers
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _response(self, parts, contents):
+        usage = types.GenerateContentResponseUsageMetadata(prompt_token_count=ConversationContext.estimate(contents))
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts))],
+            usage_metadata=usage
+        )
+
+    def generate_content_stream(self, model, contents, config=None):
+        """Streams the scripted turn: function calls arrive in one chunk, text word by word."""
+        return self.chunks(self.generate_content(model, contents, config))
+
+    def chunks(self, response):
+        parts = response.candidates[0].content.parts
+        if any(part.function_call for part in parts):
+            yield response
+            return
+        words = response.text.split(" ")
+        for i, word in enumerate(words):
+            text = word if i == len(words) - 1 else word + " "
+            yield types.GenerateContentResponse(
+                candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part.from_text(text=text)]))],
+                usage_metadata=response.usage_metadata if i == len(words) - 1 else None
+            )
+
+    def generate_content(self, model, contents, config=None):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.think_time)
+        return self.turn(contents, config)
+
+    def turn(self, contents, config=None):
+        query = contents[1].parts[0].text
+        turn = sum(1 for content in contents if content.role == "model")
+        # Without tools (a replayed plan or a spent budget) the model answers from the latest results
+        answer_now = config is not None and not config.tools
+        last_results = {}
+        for content in reversed(contents if turn else []):
+            if content.role == "tool":
+                for part in content.parts or []:
+                    if part.function_response and 'result' in part.function_response.response:
+                        last_results[part.function_response.name] = json.loads(part.function_response.response['result'])
+                break
+            if not answer_now:
+                break
+
+        if answer_now and 'rank_products' not in last_results:
+            return self._response([types.Part.from_text(text="No ranked products to recommend.")], contents)
+        if turn == 0:
+            calls = [types.Part.from_function_call(name="get_shop_details_from_kb", args={}),
+                     types.Part.from_function_call(name="search_local_catalog", args={'query': query})]
+        elif 'rank_products' in last_results:
+            ranked = last_results['rank_products'].get('ranked', [])
+            lines = [f"{i}. {p.get('name')} - {p.get('price')} ({p.get('shop_name')})" for i, p in enumerate(ranked, 1)]
+            return self._response([types.Part.from_text(text="\n".join(lines) or "No products found.")], contents)
+        elif 'search_local_catalog' in last_results and last_results['search_local_catalog'].get('fresh', 0) < self.min_catalog_offers:
+            calls = []
+            for shop_name, (base_url, method) in self.stores.items():
+                if method == 'api':
+                    calls.append(types.Part.from_function_call(name="make_api_request", args={
+                        'shop_name': shop_name, 'url': f"{base_url}/api/search", 'params': {'q': query}, 'headers': {}
+                    }))
+                else:
+                    calls.append(types.Part.from_function_call(name="scrape_website", args={
+                        'shop_name': shop_name, 'url': f"{base_url}/search?q={quote_plus(query)}"
+                    }))
+        else:
+            # Fresh enough offers were fetched by the catalog or the stores: rank them
+            calls = [types.Part.from_function_call(name="rank_products", args={'top_k': 3})]
+        return self._response(calls, contents)
+
+class _AsyncScriptedClient:
+    def __init__(self, models):
+        self.models = _AsyncScriptedModels(models)
+
+class _AsyncScriptedModels:
+    def __init__(self, models):
+        self.scripted = models
+
+    async def generate_content_stream(self, model, contents, config=None):
+        with self.scripted.lock:
+            self.scripted.calls += 1
+        await asyncio.sleep(self.scripted.think_time)
+        return _aiter(self.scripted.chunks(self.scripted.turn(contents, config)))
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
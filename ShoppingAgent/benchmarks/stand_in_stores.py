@@ -0,0 +1,107 @@
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# Latency (seconds), failure rate and payload shapes modelled on the simulated methods in legacy/communication.py
+PROFILES = {
+    'mcp': {'latency': (0.1, 0.5), 'failure_rate': 0.02, 'products': 20, 'padding_bytes': 0},
+    'api': {'latency': (0.3, 1.0), 'failure_rate': 0.10, 'products': 20, 'padding_bytes': 0},
+    'scraping': {'latency': (1.5, 4.0), 'failure_rate': 0.30, 'products': 40, 'padding_bytes': 200_000},
+}
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that stop reading early (budgeted scraping) reset the connection; that is expected
+        pass
+
+class StandInStore:
+    def __init__(self, name, latency=(0.3, 1.0), failure_rate=0.1, products=20, padding_bytes=0, time_scale=1.0, seed=None):
+        """
+        A local HTTP store. /api/search answers JSON and /search answers an HTML page with
+        JSON-LD products plus `padding_bytes` of boilerplate. Latency is scaled by `time_scale`
+        so a whole benchmark can run quickly while keeping the stores' relative speeds.
+        """
+        self.name = name
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.products = products
+        self.padding_bytes = padding_bytes
+        self.time_scale = time_scale
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+        self.server = None
+
+    @classmethod
+    def from_profile(cls, name, profile, time_scale=1.0, seed=None):
+        return cls(name, time_scale=time_scale, seed=seed, **PROFILES[profile])
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _draw(self):
+        with self.random_lock:
+            self.requests += 1
+            return self.random.uniform(*self.latency) * self.time_scale, self.random.random() < self.failure_rate
+
+    def _catalog(self, query):
+        return [
+            {'name': f"{self.name} {query} #{i}", 'price': round(100 + 37.5 * i, 2), 'currency': 'USD',
+             'stock': i % 4, 'rating': round(3 + (i % 5) / 2.5, 1)}
+            for i in range(self.products)
+        ]
+
+    def _html(self, query):
+        items = [{'@type': 'ListItem', 'item': {'@type': 'Product', 'name': p['name'],
+                  'offers': {'@type': 'Offer', 'price': p['price'], 'priceCurrency': p['currency']}}}
+                 for p in self._catalog(query)]
+        json_ld = json.dumps({'@context': 'https://schema.org', '@type': 'ItemList', 'itemListElement': items})
+        padding = '<nav>' + 'Menu ' * (self.padding_bytes // 5) + '</nav>'
+        return f'<html><head><script type="application/ld+json">{json_ld}</script></head><body>{padding}</body></html>'
+
+    def start(self):
+        store = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                delay, failed = store._draw()
+                time.sleep(delay)
+                parts = urlsplit(self.path)
+                query = parse_qs(parts.query).get('q', [''])[0]
+                if failed:
+                    body, status, content_type = b'{"error": "unavailable"}', 503, 'application/json'
+                elif parts.path.startswith('/api'):
+                    body, status, content_type = json.dumps({'products': store._catalog(query)}).encode(), 200, 'application/json'
+                else:
+                    body, status, content_type = store._html(query).encode(), 200, 'text/html; charset=utf-8'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _QuietServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name=f"store-{self.name}", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
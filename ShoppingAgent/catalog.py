@@ -0,0 +1,246 @@
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from knowledge_base import KnowledgeBase
+from ranking import parse_price, stock_value, quality_value
+from tracing import log, span
+
+# Offers younger than this are served as current; older ones are still returned, flagged stale, and refreshed
+CATALOG_FRESH_SECONDS = 15 * 60
+# Offers nobody refreshed for this long are dropped
+CATALOG_MAX_AGE = 7 * 24 * 3600
+SEARCH_LIMIT = 20
+TOKEN_RE = re.compile(r'\w+')
+OFFER_COLUMNS = "o.shop_name, o.name, o.price, o.currency, o.stock, o.quality_score, o.url, o.source_key, o.fetched_at"
+
+class ProductCatalog:
+    def __init__(self, kb: KnowledgeBase, fresh_seconds=CATALOG_FRESH_SECONDS, max_age=CATALOG_MAX_AGE):
+        """
+        Local index of the normalized offers the stores returned, kept next to the shops table.
+        Product names are full-text indexed (FTS5) so repeat and similar queries are answered
+        from disk in milliseconds. Each offer remembers the store request it came from, so
+        stale offers can be refreshed in the background by replaying that request.
+        """
+        self.kb = kb
+        self.fresh_seconds = fresh_seconds
+        self.max_age = max_age
+        # Set by the ToolBox: fetch(tool_name, args) replays a store request
+        self.fetch = None
+        self.refresher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="catalog-refresh")
+        self.refreshing = set()
+        self.refreshing_lock = threading.Lock()
+        self.full_text = self.create_tables()
+        self.purge()
+
+    def create_tables(self):
+        """Creates the catalog tables. Returns False when SQLite lacks FTS5 and search falls back to LIKE."""
+        with self.kb.lock, self.kb.conn:
+            self.kb.conn.execute("""
+                                 CREATE TABLE IF NOT EXISTS catalog_offers (
+                                     id INTEGER PRIMARY KEY,
+                                     shop_name TEXT NOT NULL,
+                                     name TEXT NOT NULL,
+                                     price REAL,
+                                     currency TEXT,
+                                     stock REAL,
+                                     quality_score REAL,
+                                     url TEXT,
+                                     source_key TEXT,
+                                     fetched_at REAL NOT NULL,
+                                     UNIQUE (shop_name, name)
+                                 )
+                                 """)
+            self.kb.conn.execute("CREATE INDEX IF NOT EXISTS idx_catalog_offers_price ON catalog_offers (price)")
+            self.kb.conn.execute("CREATE INDEX IF NOT EXISTS idx_catalog_offers_source ON catalog_offers (source_key)")
+            self.kb.conn.execute("""
+                                 CREATE TABLE IF NOT EXISTS catalog_sources (
+                                     source_key TEXT PRIMARY KEY,
+                                     shop_name TEXT NOT NULL,
+                                     tool TEXT NOT NULL,
+                                     args TEXT NOT NULL,
+                                     fetched_at REAL NOT NULL,
+                                     digest TEXT
+                                 )
+                                 """)
+            # Databases created before a column existed are upgraded in place
+            existing_cols = {row[1] for row in self.kb.conn.execute("PRAGMA table_info(catalog_sources)")}
+            if 'digest' not in existing_cols:
+                self.kb.conn.execute("ALTER TABLE catalog_sources ADD COLUMN digest TEXT")
+            try:
+                self.kb.conn.execute("""
+                                     CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+                                         name, shop_name, content='catalog_offers', content_rowid='id',
+                                         tokenize='unicode61 remove_diacritics 2'
+                                     )
+                                     """)
+            except sqlite3.OperationalError:
+                log("[Catalog] SQLite has no FTS5 support; falling back to LIKE search.")
+                return False
+            # Keep the external-content index in step with the offers table
+            self.kb.conn.executescript("""
+                CREATE TRIGGER IF NOT EXISTS catalog_offers_ai AFTER INSERT ON catalog_offers BEGIN
+                    INSERT INTO catalog_fts (rowid, name, shop_name) VALUES (new.id, new.name, new.shop_name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS catalog_offers_ad AFTER DELETE ON catalog_offers BEGIN
+                    INSERT INTO catalog_fts (catalog_fts, rowid, name, shop_name) VALUES ('delete', old.id, old.name, old.shop_name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS catalog_offers_au AFTER UPDATE OF name, shop_name ON catalog_offers BEGIN
+                    INSERT INTO catalog_fts (catalog_fts, rowid, name, shop_name) VALUES ('delete', old.id, old.name, old.shop_name);
+                    INSERT INTO catalog_fts (rowid, name, shop_name) VALUES (new.id, new.name, new.shop_name);
+                END;
+            """)
+            return True
+
+    @staticmethod
+    def source_key(tool, args):
+        return hashlib.sha256(json.dumps([tool, args], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def add_offers(self, shop_name, offers, tool, args, fetched_at=None):
+        """
+        Upserts the offers one store request returned and remembers the request. Offers that the
+        same request returned before but not this time are gone from the store and are removed.
+        The source's digest changes only when the offers themselves change, not when they are re-fetched.
+        `fetched_at` is when the store answered (a cached response's age), now by default; a response
+        no newer than what the catalog already holds for the request changes nothing. Returns the source key.
+        """
+        now = time.time() if fetched_at is None else fetched_at
+        key = self.source_key(tool, args)
+        rows = []
+        for offer in offers:
+            name = offer.get('name') or offer.get('title') or offer.get('productName')
+            if not name:
+                continue
+            price = parse_price(offer.get('price') or offer.get('cost') or offer.get('price_str'))
+            stock = stock_value(offer)
+            has_quality = offer.get('quality_score') is not None or offer.get('rating') is not None
+            rows.append((
+                shop_name, str(name)[:300], None if math.isnan(price) else price, offer.get('currency') or offer.get('priceCurrency'),
+                None if stock == 0.5 else stock, quality_value(offer) if has_quality else None,
+                offer.get('url'), key, now
+            ))
+
+        # What the request returned, independent of when: unchanged data keeps the same digest
+        digest = hashlib.sha256(json.dumps(sorted(row[1:6] for row in rows), default=str).encode('utf-8')).hexdigest()
+
+        with span("kb_write", table="catalog_offers", rows=len(rows)), self.kb.lock, self.kb.conn:
+            known = self.kb.conn.execute("SELECT fetched_at FROM catalog_sources WHERE source_key = ?", (key,)).fetchone()
+            if known and known[0] >= now:
+                return key
+            self.kb.conn.executemany("""
+                                     INSERT INTO catalog_offers (shop_name, name, price, currency, stock, quality_score, url, source_key, fetched_at)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                     ON CONFLICT (shop_name, name) DO UPDATE SET
+                                         price = excluded.price, currency = excluded.currency, stock = excluded.stock,
+                                         quality_score = excluded.quality_score, url = excluded.url,
+                                         source_key = excluded.source_key, fetched_at = excluded.fetched_at
+                                     """, rows)
+            self.kb.conn.execute("DELETE FROM catalog_offers WHERE source_key = ? AND fetched_at < ?", (key, now))
+            self.kb.conn.execute(
+                "INSERT OR REPLACE INTO catalog_sources (source_key, shop_name, tool, args, fetched_at, digest) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, shop_name, tool, json.dumps(args, default=str), now, digest)
+            )
+        return key
+
+    def source_digests(self, source_keys):
+        """{source_key: digest} of the given sources that still exist."""
+        if not source_keys:
+            return {}
+        keys = list(source_keys)
+        with self.kb.reading() as conn:
+            return dict(conn.execute(
+                f"SELECT source_key, digest FROM catalog_sources WHERE source_key IN ({', '.join('?' * len(keys))})", keys
+            ).fetchall())
+
+    def _query(self, tokens, operator, max_price, shop_names, limit, min_fetched_at):
+        filters, params = ["o.fetched_at >= ?"], [min_fetched_at]
+        if max_price is not None:
+            filters.append("o.price <= ?")
+            params.append(max_price)
+        if shop_names:
+            filters.append(f"o.shop_name IN ({', '.join('?' * len(shop_names))})")
+            params.extend(shop_names)
+
+        if self.full_text:
+            match = f" {operator} ".join(f'"{token}"*' for token in tokens)
+            sql = (f"SELECT {OFFER_COLUMNS} FROM catalog_fts JOIN catalog_offers o ON o.id = catalog_fts.rowid "
+                   f"WHERE catalog_fts MATCH ? AND {' AND '.join(filters)} ORDER BY bm25(catalog_fts), o.price LIMIT ?")
+            params = [match] + params
+        else:
+            likes = f" {operator} ".join("o.name LIKE ?" for _ in tokens)
+            sql = (f"SELECT {OFFER_COLUMNS} FROM catalog_offers o WHERE ({likes}) AND {' AND '.join(filters)} "
+                   f"ORDER BY o.price LIMIT ?")
+            params = [f"%{token}%" for token in tokens] + params
+        with self.kb.reading() as conn:
+            return conn.execute(sql, params + [limit]).fetchall()
+
+    def search(self, query, max_price=None, shop_names=None, limit=SEARCH_LIMIT):
+        """
+        Returns offers whose names match the query, best matches first. Offers matching every
+        word come first; if there are not enough, offers matching any word fill the rest.
+        Stale offers are included (flagged) and their source requests are refreshed in the background.
+        Each offer carries the `source_key` of the store request it came from.
+        """
+        tokens = TOKEN_RE.findall(query.lower())
+        if not tokens:
+            return []
+        now = time.time()
+        with span("catalog_search", query=query) as search_span:
+            rows = self._query(tokens, "AND", max_price, shop_names, limit, now - self.max_age)
+            if len(rows) < limit and len(tokens) > 1:
+                seen = {(row[0], row[1]) for row in rows}
+                extra = self._query(tokens, "OR", max_price, shop_names, limit, now - self.max_age)
+                rows += [row for row in extra if (row[0], row[1]) not in seen][:limit - len(rows)]
+            search_span.set(results=len(rows))
+
+        offers, stale_sources = [], set()
+        for shop_name, name, price, currency, stock, quality, url, key, fetched_at in rows:
+            age = now - fetched_at
+            offer = {'shop_name': shop_name, 'name': name, 'price': price, 'currency': currency,
+                     'stock': stock, 'quality_score': quality, 'url': url,
+                     'age_seconds': round(age), 'stale': age >= self.fresh_seconds, 'source_key': key}
+            offers.append({k: v for k, v in offer.items() if v is not None})
+            if offer['stale']:
+                stale_sources.add(key)
+        self.schedule_refresh(stale_sources)
+        return offers
+
+    def schedule_refresh(self, source_keys):
+        """Queues a background replay of each stale source; sources already queued are skipped."""
+        if self.fetch is None:
+            return
+        with self.refreshing_lock:
+            new_keys = [key for key in source_keys if key and key not in self.refreshing]
+            self.refreshing.update(new_keys)
+        for key in new_keys:
+            self.refresher.submit(self._refresh, key)
+
+    def _refresh(self, key):
+        try:
+            with self.kb.reading() as conn:
+                source = conn.execute(
+                    "SELECT shop_name, tool, args, fetched_at FROM catalog_sources WHERE source_key = ?", (key,)
+                ).fetchone()
+            if source is None or time.time() - source[3] < self.fresh_seconds:
+                return
+            log(f"[Catalog] Refreshing stale offers from '{source[0]}' in the background.")
+            self.fetch(source[1], json.loads(source[2]))
+        except Exception as e:
+            log(f"[Catalog] Background refresh failed: {e}")
+        finally:
+            with self.refreshing_lock:
+                self.refreshing.discard(key)
+
+    def purge(self):
+        """Drops offers and sources that have not been refreshed within max_age."""
+        cutoff = time.time() - self.max_age
+        with self.kb.lock, self.kb.conn:
+            self.kb.conn.execute("DELETE FROM catalog_offers WHERE fetched_at < ?", (cutoff,))
+            self.kb.conn.execute("DELETE FROM catalog_sources WHERE fetched_at < ?", (cutoff,))
+
+    def close(self):
+        self.refresher.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,125 @@
+import math
+import threading
+import time
+from tracing import log
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+# Consecutive failures needed to trip a breaker are derived from the method's success rate, within these bounds
+MIN_FAILURE_THRESHOLD = 2
+MAX_FAILURE_THRESHOLD = 10
+# Chance that a healthy method fails that many times in a row; below this we call it down
+FALSE_TRIP_PROBABILITY = 0.01
+BASE_OPEN_SECONDS = 30.0
+MAX_OPEN_SECONDS = 600.0
+
+class CircuitBreaker:
+    def __init__(self):
+        """Breaker for one shop/method pair: closed -> open after repeated failures -> half-open probe -> closed."""
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.open_seconds = BASE_OPEN_SECONDS
+        self.probe_in_flight = False
+
+    def retry_in(self, now):
+        return max(0.0, self.opened_at + self.open_seconds - now) if self.state == OPEN else 0.0
+
+    def blocked(self, now):
+        """True if allow() would refuse a call right now. Read-only: it never takes the half-open probe."""
+        if self.state == OPEN:
+            return self.retry_in(now) > 0
+        return self.state == HALF_OPEN and self.probe_in_flight
+
+    def allow(self, now):
+        """True if a call may go out. After the open period a single half-open probe is let through."""
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probe_in_flight:
+                return False
+            self.probe_in_flight = True
+            return True
+        return self.state == CLOSED
+
+    def release(self):
+        """A half-open probe ended without a verdict (e.g. throttled): let the next call probe instead."""
+        self.probe_in_flight = False
+
+    def record(self, success, threshold, now):
+        self.probe_in_flight = False
+        if success:
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self.open_seconds = BASE_OPEN_SECONDS
+            return
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            # The probe failed: stay away twice as long as last time
+            self.state = OPEN
+            self.opened_at = now
+            self.open_seconds = min(MAX_OPEN_SECONDS, self.open_seconds * 2)
+        elif self.state == CLOSED and self.consecutive_failures >= threshold:
+            self.state = OPEN
+            self.opened_at = now
+
+class BreakerRegistry:
+    def __init__(self, kb):
+        """Per-shop, per-method circuit breakers whose trip thresholds follow the KB's live success rates."""
+        self.kb = kb
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def failure_threshold(self, shop_name, method):
+        """
+        Number of consecutive failures that a method with the KB's recent success rate would produce
+        by chance less than 1% of the time. Reliable methods trip fast; flaky ones get more slack.
+        """
+        stats = self.kb.get_method_stats(shop_name).get(shop_name, {}).get(method)
+        success_rate = stats['success_rate'] if stats else 1.0
+        if success_rate >= 1.0:
+            return MIN_FAILURE_THRESHOLD
+        if success_rate <= 0.0:
+            return MAX_FAILURE_THRESHOLD
+        threshold = math.ceil(math.log(FALSE_TRIP_PROBABILITY) / math.log(1.0 - success_rate))
+        return max(MIN_FAILURE_THRESHOLD, min(MAX_FAILURE_THRESHOLD, threshold))
+
+    def _breaker(self, shop_name, method):
+        return self.breakers.setdefault((shop_name, method), CircuitBreaker())
+
+    def allow(self, shop_name, method):
+        with self.lock:
+            return self._breaker(shop_name, method).allow(time.monotonic())
+
+    def blocked(self, shop_name, method):
+        with self.lock:
+            return self._breaker(shop_name, method).blocked(time.monotonic())
+
+    def retry_in(self, shop_name, method):
+        with self.lock:
+            return self._breaker(shop_name, method).retry_in(time.monotonic())
+
+    def record(self, shop_name, method, success):
+        threshold = self.failure_threshold(shop_name, method) if not success else MIN_FAILURE_THRESHOLD
+        with self.lock:
+            breaker = self._breaker(shop_name, method)
+            before = breaker.state
+            breaker.record(success, threshold, time.monotonic())
+            after = breaker.state
+        if before != after:
+            log(f"[Breaker] {shop_name} ({method}): {before} -> {after}")
+
+    def release(self, shop_name, method):
+        with self.lock:
+            self._breaker(shop_name, method).release()
+
+    def states(self):
+        """{shop_name: {method: {'state', 'retry_in'}}} for every breaker that is not closed."""
+        now = time.monotonic()
+        with self.lock:
+            states = {}
+            for (shop_name, method), breaker in self.breakers.items():
+                if breaker.state != CLOSED:
+                    states.setdefault(shop_name, {})[method] = {
+                        'state': breaker.state, 'retry_in': round(breaker.retry_in(now), 1)
+                    }
+            return states
@@ -0,0 +1,18 @@
+import threading
+
+_loaded = False
+_lock = threading.Lock()
+
+def load_config():
+    """
+    Loads the .env file into the environment, once per process. Entry points call it before
+    anything reads its settings; later calls do nothing.
+    """
+    global _loaded
+    with _lock:
+        if _loaded:
+            return
+        from dotenv import load_dotenv
+        # Searches from this file's directory, where .env lives next to the modules
+        load_dotenv()
+        _loaded = True
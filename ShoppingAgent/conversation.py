@@ -0,0 +1,151 @@
+import json
+from google.genai import types
+
+# Upper bound for the context sent in one Gemini round trip, and for all input tokens of one user query
+CONTEXT_TOKEN_BUDGET = 32000
+REQUEST_TOKEN_BUDGET = 200000
+# How much of a consumed tool result survives compaction
+DIGEST_MAX_PRODUCTS = 10
+DIGEST_MAX_CHARS = 1000
+KB_TOOL_NAME = "get_shop_details_from_kb"
+
+def estimate_tokens(text):
+    """Cheap local token estimate (~4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+def _truncate(text, max_chars=DIGEST_MAX_CHARS):
+    return text if len(text) <= max_chars else text[:max_chars] + f"... [truncated {len(text) - max_chars} chars]"
+
+def _digest_shops(shops):
+    """Keeps only what routing needs from a KB snapshot: capabilities and recent per-method stats."""
+    digest = []
+    for shop in shops:
+        stats = {
+            method: {k: round(v, 3) for k, v in s.items() if k in ('success_rate', 'latency', 'p95') and v is not None}
+            for method, s in (shop.get('method_stats') or {}).items()
+        }
+        digest.append({
+            'name': shop.get('name'),
+            'api_url': shop.get('api_url') if shop.get('api_enabled') else None,
+            'mcp_url': shop.get('mcp_url') if shop.get('mcp_enabled') else None,
+            'stats': stats,
+            'circuit_breakers': shop.get('circuit_breakers') or {}
+        })
+    return digest
+
+def digest_tool_result(function_name, response):
+    """Shrinks a tool response the model has already read to the facts needed for the final answer."""
+    if 'result' not in response:
+        return response
+    raw = response['result']
+    try:
+        data = json.loads(raw) if isinstance(raw, str) else raw
+    except ValueError:
+        return {'result': _truncate(str(raw))}
+
+    if function_name == KB_TOOL_NAME and isinstance(data, list):
+        digest = _digest_shops(data)
+    elif isinstance(data, dict) and isinstance(data.get('products', data.get('offers')), list):
+        # Store tools return 'products'; the local catalog returns 'offers' from several shops
+        products = data.get('products', data.get('offers'))
+        digest = {
+            'url': data.get('url'),
+            'products': [
+                {k: p.get(k) for k in ('name', 'price', 'currency', 'shop_name', 'url') if p.get(k) is not None}
+                for p in products[:DIGEST_MAX_PRODUCTS]
+            ],
+            'omitted_products': max(0, len(products) - DIGEST_MAX_PRODUCTS)
+        }
+    elif isinstance(data, dict) and 'error' in data:
+        digest = {'error': data['error']}
+    else:
+        return {'result': _truncate(raw if isinstance(raw, str) else json.dumps(raw))}
+    return {'result': json.dumps(digest)}
+
+class ConversationContext:
+    def __init__(self, system_prompt, user_query, context_token_budget=CONTEXT_TOKEN_BUDGET,
+                 request_token_budget=REQUEST_TOKEN_BUDGET):
+        """
+        Owns the conversation history of one user query. Tool results are sent in full exactly
+        once; after the model has consumed them they are replaced with compact digests, repeated
+        KB snapshots are deduplicated, and the context is kept within a token budget.
+        """
+        self.context_token_budget = context_token_budget
+        self.request_token_budget = request_token_budget
+        self.entries = [
+            {'kind': 'text', 'content': types.Content(role="user", parts=[types.Part.from_text(text=system_prompt)])},
+            {'kind': 'text', 'content': types.Content(role="user", parts=[types.Part.from_text(text=user_query)])}
+        ]
+        self.input_tokens_used = 0
+        self.turns = 0
+
+    def add_model_turn(self, content):
+        """Appends the model's turn; every tool result before it now counts as consumed."""
+        for entry in self.entries:
+            if entry['kind'] == 'tool':
+                entry['consumed'] = True
+        self.entries.append({'kind': 'text', 'content': content})
+
+    def add_tool_results(self, calls, responses):
+        """Appends the responses of one turn's tool calls, given as parallel lists."""
+        results = [(function_name, response) for (function_name, _), response in zip(calls, responses)]
+        self.entries.append({'kind': 'tool', 'results': results, 'consumed': False})
+
+    def add_user_note(self, text):
+        self.entries.append({'kind': 'text', 'content': types.Content(role="user", parts=[types.Part.from_text(text=text)])})
+
+    def record_usage(self, prompt_tokens):
+        """Adds the input tokens the API reports for a turn to this request's running total."""
+        self.turns += 1
+        self.input_tokens_used += prompt_tokens or 0
+
+    @property
+    def request_budget_exhausted(self):
+        return self.input_tokens_used >= self.request_token_budget
+
+    def _tool_content(self, entry, digest_all, latest_kb_snapshot):
+        parts = []
+        for function_name, response in entry['results']:
+            if function_name == KB_TOOL_NAME and response is not latest_kb_snapshot and 'result' in response:
+                # Only the newest KB snapshot is worth sending; older and repeated ones are superseded
+                response = {'result': json.dumps({'note': 'Superseded by a later KB snapshot.'})}
+            elif entry['consumed'] or digest_all:
+                response = digest_tool_result(function_name, response)
+            parts.append(types.Part.from_function_response(name=function_name, response=response))
+        return types.Content(role="tool", parts=parts)
+
+    def contents(self):
+        """
+        Builds the contents for the next request. If the compacted history is still over the
+        context budget, even unconsumed results are digested before anything is sent.
+        """
+        latest_kb_snapshot = None
+        for entry in self.entries:
+            if entry['kind'] == 'tool':
+                for function_name, response in entry['results']:
+                    if function_name == KB_TOOL_NAME and 'result' in response:
+                        latest_kb_snapshot = response
+
+        for digest_all in (False, True):
+            contents = [
+                self._tool_content(entry, digest_all, latest_kb_snapshot) if entry['kind'] == 'tool' else entry['content']
+                for entry in self.entries
+            ]
+            estimated = self.estimate(contents)
+            if estimated <= self.context_token_budget:
+                break
+        return contents, estimated
+
+    @staticmethod
+    def estimate(contents):
+        """Estimates the token count of a list of Content objects."""
+        total = 0
+        for content in contents:
+            for part in content.parts or []:
+                if part.text:
+                    total += estimate_tokens(part.text)
+                elif part.function_response:
+                    total += estimate_tokens(json.dumps(part.function_response.response, default=str))
+                elif part.function_call:
+                    total += estimate_tokens(json.dumps(part.function_call.args or {}, default=str))
+        return total
@@ -1,14 +1,28 @@
-import requests
 import os
 import re
-from dotenv import load_dotenv
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import load_config
+from tracing import log, span, in_current_context
 
 # Load environment variables from .env file
-load_dotenv()
+load_config()
 
 API_KEY = os.getenv('GOOGLE_PLACES_API_KEY')
 PLACES_API_URL = "https://maps.googleapis.com/maps/api/place/textsearch/json"
 
+# Capability probing limits: total probes in flight, probes per store domain, and how long a probe stays valid
+PROBE_MAX_IN_FLIGHT = 16
+PROBE_PER_HOST_LIMIT = 2
+PROBE_CACHE_TTL = 7 * 24 * 3600
+# A location's saved discovery is used at startup without any network calls; once older than this
+# it is still used, and refreshed in the background
+DISCOVERY_TTL = float(os.getenv("DISCOVERY_TTL", str(24 * 3600)))
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
 # Helper function to clean names for domain guessing
 def _clean_shop_name_for_domain(name):
     """Cleans a shop name to guess its domain name."""
@@ -30,30 +44,42 @@ def _check_endpoint(url):
     Performs a lightweight HEAD request to check if a server exists at the URL.
     Returns True if it gets any response, even an error like 401/403.
     """
+    # The HTTP stack is only loaded once discovery actually goes to the network
+    import httpx
+    from transport import get_transport
     try:
         # Use a short timeout to not hang the discovery process
-        response = requests.head(url, timeout=3, allow_redirects=True)
+        response = get_transport().head(url, timeout=3)
         # Any status code below 500 (Server Error) suggests the endpoint exists,
         # even if it's 401 (Unauthorized) or 403 (Forbidden), which is common for APIs.
         if response.status_code < 500:
-            print(f"    ✓ Found endpoint: {url} (Status: {response.status_code})")
+            log(f"    ✓ Found endpoint: {url} (Status: {response.status_code})")
             return True
-    except requests.exceptions.RequestException:
+    except httpx.HTTPError:
         # This catches timeouts, connection errors, etc.
-        print(f"    ✗ No endpoint found at: {url}")
+        log(f"    ✗ No endpoint found at: {url}")
         pass
     return False
 
+def _store_domain(shop_name):
+    """Guesses a store's domain. We assume a .com TLD for this project, which is a reasonable simplification."""
+    return f"{_clean_shop_name_for_domain(shop_name)}.com"
+
+def _verified_methods(api_url, api_enabled, mcp_url, mcp_enabled):
+    return {
+        'api_enabled': api_enabled,
+        'api_url': api_url,
+        'mcp_enabled': mcp_enabled,
+        'mcp_url': mcp_url if mcp_enabled else None
+    }
+
 # The main verification function
 def verify_communication_methods(shop_name):
     """
     Verifies MCP and API capabilities by checking for common subdomains.
     """
-    print(f"    - Verifying communication methods for '{shop_name}'...")
-    cleaned_name = _clean_shop_name_for_domain(shop_name)
-
-    # We will assume a .com TLD for this project, which is a reasonable simplification.
-    domain = f"{cleaned_name}.com"
+    log(f"    - Verifying communication methods for '{shop_name}'...")
+    domain = _store_domain(shop_name)
 
     # Check for API subdomain
     api_url = f"https://api.{domain}"
@@ -63,19 +89,65 @@ def verify_communication_methods(shop_name):
     mcp_url = f"https://mcp.{domain}"
     mcp_enabled = _check_endpoint(mcp_url)
 
-    return {
-        'api_enabled': api_enabled,
-        'api_url': api_url,
-        'mcp_enabled': mcp_enabled,
-        'mcp_url': mcp_url if mcp_enabled else None
-    }
+    return _verified_methods(api_url, api_enabled, mcp_url, mcp_enabled)
+
+def probe_stores(shop_names, max_in_flight=PROBE_MAX_IN_FLIGHT, per_host_limit=PROBE_PER_HOST_LIMIT):
+    """
+    Verifies the communication methods of many shops concurrently.
+    At most `max_in_flight` probes run at once and at most `per_host_limit` hit the same store domain.
+    Returns a dict of {shop_name: verified_methods}.
+    """
+    if not shop_names:
+        return {}
+    log(f"[Discovery] Probing {len(shop_names)} store(s) concurrently (max {max_in_flight} in flight)...")
+    host_limits = {}
+    host_limits_lock = threading.Lock()
+
+    def limited_check(domain, url):
+        with host_limits_lock:
+            host_limit = host_limits.setdefault(domain, threading.Semaphore(per_host_limit))
+        with host_limit:
+            return _check_endpoint(url)
+
+    pending = {}
+    with span("discovery_probe", shops=len(shop_names)), \
+            ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="probe") as pool:
+        for shop_name in shop_names:
+            domain = _store_domain(shop_name)
+            api_url = f"https://api.{domain}"
+            mcp_url = f"https://mcp.{domain}"
+            pending[shop_name] = (
+                api_url, pool.submit(in_current_context(limited_check), domain, api_url),
+                mcp_url, pool.submit(in_current_context(limited_check), domain, mcp_url)
+            )
+        return {
+            shop_name: _verified_methods(api_url, api_future.result(), mcp_url, mcp_future.result())
+            for shop_name, (api_url, api_future, mcp_url, mcp_future) in pending.items()
+        }
+
+def verify_stores(kb, stores, ttl_seconds=PROBE_CACHE_TTL):
+    """
+    Returns (store_info, verified_methods) pairs for the discovered stores.
+    Probes cached in the Knowledge Base within the TTL are reused; only new or stale stores are probed.
+    """
+    shop_names = list(dict.fromkeys(store['name'] for store in stores))
+    verified = kb.get_fresh_probe_results(shop_names, ttl_seconds)
+    stale_names = [name for name in shop_names if name not in verified]
+    log(f"[Discovery] {len(verified)} store probe(s) reused from cache, {len(stale_names)} to verify.")
+
+    if stale_names:
+        fresh = probe_stores(stale_names)
+        kb.save_probe_results(fresh)
+        verified.update(fresh)
+
+    return [(store, verified[store['name']]) for store in stores]
 
 def get_coordinates_for_location(location_name):
     """
     (Simulation) A real implementation would use a geocoding API.
     For this project, we'll use a hardcoded dictionary for simplicity.
     """
-    print(f"[Discovery] Getting coordinates for '{location_name}'...")
+    log(f"[Discovery] Getting coordinates for '{location_name}'...")
     locations = {
         "new york, ny": "40.7128,-74.0060",
         "san francisco, ca": "37.7749,-122.4194",
@@ -83,19 +155,27 @@ def get_coordinates_for_location(location_name):
     }
     coords = locations.get(location_name.lower())
     if coords:
-        print(f"  - Found coordinates: {coords}")
+        log(f"  - Found coordinates: {coords}")
         return coords
     else:
-        print(f"  - Could not find coordinates for '{location_name}'. Using default.")
+        log(f"  - Could not find coordinates for '{location_name}'. Using default.")
         return "5.06889, -75.51738" # Default to MZLS
 
-def find_local_stores(location_name, radius_metters=50000):
+def find_local_stores(location_name, radius_metters=50000, kb=None):
     """
     Uses the Google Places API to find local electronics stores.
+    Requests go through the shared rate limiter (limits from `kb` when given) and back off when throttled.
     """
+    return _search_places(location_name, radius_metters, kb) or []
+
+def _search_places(location_name, radius_metters=50000, kb=None):
+    """find_local_stores, but None when the search could not be done (as opposed to finding nothing)."""
     if not API_KEY:
-        print("[Discovery] ERROR: GOOGLE_PLACES_API_KEY not found in .env file. Skipping local discovery.")
-        return []
+        log("[Discovery] ERROR: GOOGLE_PLACES_API_KEY not found in .env file. Skipping local discovery.")
+        return None
+    import httpx
+    from transport import get_transport
+    from rate_limit import get_rate_limiter, Throttled, RateLimited
 
     coords = get_coordinates_for_location(location_name)
     params = {
@@ -105,9 +185,14 @@ def find_local_stores(location_name, radius_metters=50000):
         'key': API_KEY
     }
 
-    print(f"[Discovery] Searching for local stores near {location_name}...")
+    log(f"[Discovery] Searching for local stores near {location_name}...")
+    limiter = get_rate_limiter(kb)
     try:
-        response = requests.get(PLACES_API_URL, params=params)
+        for attempt in limiter.attempts():
+            with attempt:
+                limiter.acquire(PLACES_API_URL)
+                response = get_transport().get(PLACES_API_URL, params=params)
+                limiter.check(PLACES_API_URL, response)
         response.raise_for_status()
         results = response.json().get('results',[])
 
@@ -119,33 +204,98 @@ def find_local_stores(location_name, radius_metters=50000):
                 'scope': 'local'
             })
 
-        print(f"    - Found {len(stores)} local stores.")
+        log(f"    - Found {len(stores)} local stores.")
         return stores
-    except requests.exceptions.RequestException as e:
-        print(f"[Discovery] ERROR: Could not connect to Google Places API. {e}")
-        return []
+    except (Throttled, RateLimited) as e:
+        log(f"[Discovery] Google Places API is rate limiting us; skipping local discovery for now. {e}")
+        return None
+    except httpx.HTTPError as e:
+        log(f"[Discovery] ERROR: Could not connect to Google Places API. {e}")
+        return None
     except Exception as e:
-        print(f"[Discovery] ERROR: An error occurred during local discovery. {e}")
-        return []
+        log(f"[Discovery] ERROR: An error occurred during local discovery. {e}")
+        return None
 
 def get_national_stores():
     """Returns a curated list of prominent national stores."""
-    print("[Discovery] Getting curated list of national stores...")
+    log("[Discovery] Getting curated list of national stores...")
     stores = [
         {'name': 'Panamericana', 'scope': 'national'},
         {'name': 'Exito', 'scope': 'national'},
         {'name': 'Ktronix', 'scope': 'national'},
     ]
-    print(f"  - Found {len(stores)} national stores.")
+    log(f"  - Found {len(stores)} national stores.")
     return stores
 
 def get_international_stores():
     """Returns a curated list of prominent international stores."""
-    print("[Discovery] Getting curated list of international stores...")
+    log("[Discovery] Getting curated list of international stores...")
     stores = [
         {'name': 'Amazon', 'scope': 'international'},
         {'name': 'AliExpress', 'scope': 'international'},
         {'name': 'ebay', 'scope': 'international'}
     ]
-    print(f"  - Found {len(stores)} international stores.")
+    log(f"  - Found {len(stores)} international stores.")
+    return stores
+
+def location_key(location_name):
+    """'New York,  NY ' and 'new york, ny' share one snapshot."""
+    return " ".join(location_name.lower().split())
+
+def discover_location(kb, location_name):
+    """
+    Runs the full discovery for a location (Places, curated lists, capability probes) and saves it as
+    the location's snapshot in the KB, retiring the stores that were not found again. Returns the stores.
+    """
+    key = location_key(location_name)
+    with span("discovery", location=key):
+        local_stores = _search_places(location_name, kb=kb)
+        if local_stores is None:
+            # Places is unavailable: keep the local stores found last time instead of retiring them
+            snapshot = kb.get_discovery_snapshot(key)
+            local_stores = [store for store in (snapshot['stores'] if snapshot else []) if store['scope'] == 'local']
+        stores = local_stores + get_national_stores() + get_international_stores()
+        retired = kb.save_discovery(key, location_name, verify_stores(kb, stores))
+    log(f"[Discovery] Saved {len(stores)} store(s) for '{location_name}'"
+        + (f"; retired {len(retired)}." if retired else "."))
     return stores
+
+def refresh_in_background(kb, location_name):
+    """Re-discovers a location on a daemon thread. Returns the thread, or None if a refresh is already running."""
+    key = location_key(location_name)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return None
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            discover_location(kb, location_name)
+        except Exception as e:
+            log(f"[Discovery] Background refresh for '{location_name}' failed: {e}")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    thread = threading.Thread(target=in_current_context(refresh), name="discovery-refresh", daemon=True)
+    thread.start()
+    return thread
+
+def load_stores(kb, location_name, ttl=DISCOVERY_TTL):
+    """
+    Makes a location's stores available in the KB. A saved snapshot is used as is, without network
+    calls, and refreshed in the background once older than `ttl`; only a location without one (or
+    whose shops have left the KB) is discovered before returning.
+    Returns (number of stores, whether the snapshot was used).
+    """
+    snapshot = kb.get_discovery_snapshot(location_key(location_name))
+    known = {shop['name'] for shop in kb.get_all_shops()}
+    if not snapshot or not snapshot['stores'] or any(store['name'] not in known for store in snapshot['stores']):
+        log(f"[Discovery] No saved discovery for '{location_name}'; discovering stores now.")
+        return len(discover_location(kb, location_name)), False
+
+    age = time.time() - snapshot['discovered_at']
+    log(f"[Discovery] Using the {len(snapshot['stores'])} store(s) saved for '{location_name}' {age / 3600:.1f}h ago.")
+    if age > ttl:
+        refresh_in_background(kb, location_name)
+    return len(snapshot['stores']), True
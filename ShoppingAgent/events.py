@@ -0,0 +1,74 @@
+import contextvars
+import threading
+from dataclasses import dataclass
+from tracing import log
+
+@dataclass
+class ToolCallStarted:
+    name: str
+    args: dict
+
+@dataclass
+class ToolCallFinished:
+    name: str
+    latency: float
+    error: str = None
+
+@dataclass
+class ProductsFound:
+    """Offers a store tool returned, as soon as the tool finishes (before the model has seen them)."""
+    shop_name: str
+    products: list
+
+@dataclass
+class AnswerToken:
+    """
+    A chunk of model text as it streams in. Text from a turn that then requests tools was
+    the model thinking aloud; a ToolCallStarted follows and the text is not part of the answer.
+    """
+    text: str
+
+@dataclass
+class QueryFinished:
+    answer: str
+    elapsed: float
+
+# Listeners of the query running in this context (tool threads inherit it); see EventBus.listen
+_context_listeners = contextvars.ContextVar("event_listeners", default=())
+
+class EventBus:
+    def __init__(self):
+        """
+        Delivers agent events synchronously on the emitting thread, to subscribers (every event)
+        and to listeners of the current context (only the events of their own query).
+        """
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers = self.subscribers + [callback]
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not callback]
+
+    def listen(self, callback):
+        """
+        Delivers the events emitted in the current context, e.g. one query and the tool threads
+        it starts, to `callback`. With a shared agent, each session only sees its own events.
+        Returns a token for stop_listening().
+        """
+        return _context_listeners.set(_context_listeners.get() + (callback,))
+
+    def stop_listening(self, token):
+        _context_listeners.reset(token)
+
+    def emit(self, event):
+        # Subscribers are copied on write, so emitting never holds the lock while callbacks run
+        for callback in self.subscribers + list(_context_listeners.get()):
+            try:
+                callback(event)
+            except Exception as e:
+                log(f"[Events] Subscriber failed on {type(event).__name__}: {e}")
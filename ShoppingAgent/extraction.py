@@ -0,0 +1,243 @@
+import json
+import re
+from tracing import span
+
+# Stop reading a page once this much HTML has been parsed or this many products were found
+SCRAPE_BYTE_BUDGET = 1_500_000
+SCRAPE_ITEM_BUDGET = 25
+# Visible text kept for the LLM when a page has no recognizable products
+FALLBACK_TEXT_CHARS = 3000
+
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'svg', 'nav', 'header', 'footer', 'template'}
+CARD_CLASS_RE = re.compile(r'\bproduct[-_]?(card|item|tile|box|pod|grid-item)?\b', re.IGNORECASE)
+# Prices with the currency before the amount are tried first; an amount followed by a currency code must
+# stand on its own, so the digits at the end of a product name are never taken for it
+PRICE_PREFIX_RE = re.compile(r'(?:US\$|COP|USD|EUR|[$€£])\s?\d[\d.,]*')
+PRICE_SUFFIX_RE = re.compile(r'(?<![\w.,])\d[\d.,]*\s?(?:COP|USD|EUR)\b')
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5'}
+
+def _offer_fields(offers):
+    """Pulls price, currency and availability out of a JSON-LD offers value (dict, list or AggregateOffer)."""
+    if isinstance(offers, list):
+        offers = offers[0] if offers else {}
+    if not isinstance(offers, dict):
+        return {}
+    return {
+        'price': offers.get('price', offers.get('lowPrice')),
+        'currency': offers.get('priceCurrency'),
+        'availability': str(offers.get('availability', '')).rsplit('/', 1)[-1] or None
+    }
+
+def _json_ld_products(node):
+    """Yields every schema.org Product found in a JSON-LD document, including inside @graph and ItemList."""
+    if isinstance(node, list):
+        for item in node:
+            yield from _json_ld_products(item)
+        return
+    if not isinstance(node, dict):
+        return
+    node_type = node.get('@type')
+    types = node_type if isinstance(node_type, list) else [node_type]
+    if 'Product' in types:
+        rating = node.get('aggregateRating') or {}
+        product = {
+            'name': node.get('name'),
+            'url': node.get('url'),
+            'rating': rating.get('ratingValue') if isinstance(rating, dict) else None,
+            'source': 'json-ld'
+        }
+        product.update(_offer_fields(node.get('offers')))
+        yield product
+    for key in ('@graph', 'itemListElement'):
+        if key in node:
+            yield from _json_ld_products(node[key])
+    if 'item' in node and isinstance(node['item'], (dict, list)):
+        yield from _json_ld_products(node['item'])
+
+class _ProductTarget:
+    """
+    lxml parser target that sees the page as a stream of start/end/data events, so no tree is
+    ever built. It collects JSON-LD, microdata and OpenGraph products, plus product-card guesses.
+    """
+    def __init__(self, item_budget):
+        self.item_budget = item_budget
+        self.structured = []
+        self.cards = []
+        self.opengraph = {}
+        self.text = []
+        self.text_chars = 0
+        self.depth = 0
+        self.skip_depth = None
+        self.json_ld = None
+        # Open microdata Products and itemprop captures, as (depth, object) pairs
+        self.microdata = []
+        self.captures = []
+        self.card = None
+
+    @property
+    def done(self):
+        return len(self.structured) + len(self.cards) >= self.item_budget
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        tag = tag.lower() if isinstance(tag, str) else ''
+        if tag == 'script' and attrib.get('type', '').lower() == 'application/ld+json':
+            self.json_ld = []
+        if self.skip_depth is None and tag in SKIPPED_TAGS:
+            self.skip_depth = self.depth
+        if tag == 'meta':
+            self._meta(attrib)
+
+        if 'itemscope' in attrib and attrib.get('itemtype', '').endswith('/Product'):
+            self.microdata.append((self.depth, {'source': 'microdata'}))
+        itemprop = attrib.get('itemprop')
+        if itemprop and self.microdata:
+            value = attrib.get('content') or (attrib.get('href') if tag in ('a', 'link') and itemprop == 'url' else None)
+            if value is not None:
+                self._set_microdata(itemprop, value)
+            elif tag != 'meta':
+                self.captures.append((self.depth, itemprop, []))
+
+        if self.card is None and self.skip_depth is None and CARD_CLASS_RE.search(attrib.get('class', '')):
+            self.card = {'depth': self.depth, 'name': None, 'url': None, 'text': [], 'in_heading': None}
+        if self.card is not None:
+            # Text of neighbouring elements must not run together
+            self.card['text'].append(' ')
+            if tag == 'a' and not self.card['url'] and attrib.get('href'):
+                self.card['url'] = attrib.get('href')
+                if not self.card['name'] and attrib.get('title'):
+                    self.card['name'] = attrib.get('title').strip()
+            if tag in HEADING_TAGS and self.card['in_heading'] is None:
+                self.card['in_heading'] = self.depth
+
+    def end(self, tag):
+        if self.json_ld is not None and isinstance(tag, str) and tag.lower() == 'script':
+            self._json_ld(''.join(self.json_ld))
+            self.json_ld = None
+        while self.captures and self.captures[-1][0] == self.depth:
+            _, itemprop, chunks = self.captures.pop()
+            self._set_microdata(itemprop, ' '.join(''.join(chunks).split()))
+        if self.microdata and self.microdata[-1][0] == self.depth:
+            _, product = self.microdata.pop()
+            if product.get('name'):
+                self.structured.append(product)
+        if self.card is not None:
+            self.card['text'].append(' ')
+            if self.card['in_heading'] == self.depth:
+                self.card['in_heading'] = False
+            if self.card['depth'] == self.depth:
+                self._close_card()
+        if self.skip_depth == self.depth:
+            self.skip_depth = None
+        self.depth -= 1
+
+    def data(self, data):
+        if self.json_ld is not None:
+            self.json_ld.append(data)
+            return
+        for capture in self.captures:
+            capture[2].append(data)
+        if self.skip_depth is not None:
+            return
+        if self.card is not None:
+            self.card['text'].append(data)
+            if self.card['in_heading'] and not self.card['name'] and data.strip():
+                self.card['name'] = ' '.join(data.split())
+        if self.text_chars < FALLBACK_TEXT_CHARS:
+            chunk = ' '.join(data.split())
+            if chunk:
+                self.text.append(chunk)
+                self.text_chars += len(chunk) + 1
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        return None
+
+    def _meta(self, attrib):
+        prop = attrib.get('property', '')
+        if prop in ('og:title', 'og:url', 'og:type', 'product:price:amount', 'og:price:amount',
+                    'product:price:currency', 'og:price:currency'):
+            self.opengraph[prop] = attrib.get('content')
+
+    def _json_ld(self, raw):
+        try:
+            document = json.loads(raw)
+        except ValueError:
+            return
+        self.structured.extend(_json_ld_products(document))
+
+    def _set_microdata(self, itemprop, value):
+        product = self.microdata[-1][1]
+        field = {'priceCurrency': 'currency', 'ratingValue': 'rating', 'lowPrice': 'price'}.get(itemprop, itemprop)
+        if field in ('name', 'price', 'currency', 'availability', 'url', 'rating') and not product.get(field):
+            product[field] = value.rsplit('/', 1)[-1] if field == 'availability' else value
+
+    def _close_card(self):
+        card, self.card = self.card, None
+        text = ' '.join(''.join(card['text']).split())
+        price = PRICE_PREFIX_RE.search(text) or PRICE_SUFFIX_RE.search(text)
+        if card['name'] and price:
+            self.cards.append({'name': card['name'], 'price': price.group(0), 'url': card['url'], 'source': 'card'})
+
+    def products(self):
+        """Structured data wins; card heuristics and OpenGraph are only used when it is missing."""
+        products = [p for p in self.structured if p.get('name')]
+        if not products:
+            products = self.cards
+        if not products and self.opengraph.get('og:title') and (
+                self.opengraph.get('og:type') == 'product' or self.opengraph.get('product:price:amount') or self.opengraph.get('og:price:amount')):
+            products = [{
+                'name': self.opengraph.get('og:title'),
+                'price': self.opengraph.get('product:price:amount') or self.opengraph.get('og:price:amount'),
+                'currency': self.opengraph.get('product:price:currency') or self.opengraph.get('og:price:currency'),
+                'url': self.opengraph.get('og:url'),
+                'source': 'opengraph'
+            }]
+        return [{k: v for k, v in p.items() if v is not None} for p in products[:self.item_budget]]
+
+class ProductExtractor:
+    def __init__(self, encoding=None, byte_budget=SCRAPE_BYTE_BUDGET, item_budget=SCRAPE_ITEM_BUDGET):
+        """Incremental extraction: feed() the page chunk by chunk as it downloads, then take result()."""
+        # lxml is loaded with the first page scraped, not at startup
+        from lxml import etree
+        self.target = _ProductTarget(item_budget)
+        self.parser = etree.HTMLParser(target=self.target, encoding=encoding, remove_comments=True)
+        self.byte_budget = byte_budget
+        self.bytes_read = 0
+        self.truncated = False
+
+    def feed(self, chunk):
+        """Parses one chunk. Returns True once either budget is reached and reading should stop."""
+        self.parser.feed(chunk)
+        self.bytes_read += len(chunk)
+        if self.bytes_read >= self.byte_budget or self.target.done:
+            self.truncated = True
+        return self.truncated
+
+    def result(self):
+        from lxml import etree
+        try:
+            self.parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        result = {'products': self.target.products(), 'bytes_read': self.bytes_read, 'truncated': self.truncated}
+        if not result['products']:
+            result['text'] = ' '.join(self.target.text)[:FALLBACK_TEXT_CHARS]
+        return result
+
+def extract_products(chunks, encoding=None, byte_budget=SCRAPE_BYTE_BUDGET, item_budget=SCRAPE_ITEM_BUDGET):
+    """
+    Incrementally parses an HTML byte stream and returns a compact extraction result:
+    {'products': [...], 'bytes_read': n, 'truncated': bool}, plus a short 'text' excerpt
+    when no products were recognized. Reading stops as soon as either budget is reached.
+    """
+    with span("html_parse") as parse_span:
+        extractor = ProductExtractor(encoding, byte_budget, item_budget)
+        for chunk in chunks:
+            if extractor.feed(chunk):
+                break
+        result = extractor.result()
+        parse_span.set(bytes_read=result['bytes_read'], products=len(result['products']), truncated=result['truncated'])
+    return result
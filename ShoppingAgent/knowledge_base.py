@@ -1,16 +1,75 @@
 import sqlite3
 import os
+import hashlib
+import json
+import atexit
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from metrics_writer import MetricsWriter
+from tracing import log, span
+from shop_stats import ewma_terms, histogram_increments, histogram_percentiles, HISTOGRAM_DECAY
 
 DB_FILE = "shops.db"
+# Read-only connections shared by all threads; reads never wait for the writer in WAL mode
+READER_POOL_SIZE = int(os.getenv("KB_READER_POOL_SIZE", "4"))
 
 class KnowledgeBase:
-    def __init__(self) -> None:
-        self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    def __init__(self, db_file=DB_FILE, reader_pool_size=READER_POOL_SIZE) -> None:
+        """
+        Process-wide, thread-safe Knowledge Base. All writes go through one connection guarded by
+        `lock`; reads check out one of a small pool of read-only connections, so any number of
+        sessions can read concurrently while a write is in progress.
+        """
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        # WAL lets readers keep going while the metrics writer commits
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Tools run in parallel threads and share this connection, so every write is serialized
+        self.lock = threading.RLock()
+        # An in-memory database is private to its connection, so it has no separate readers
+        self.reader_pool_size = reader_pool_size if db_file != ":memory:" else 0
+        self.readers = queue.LifoQueue()
+        self.reader_count = 0
+        self.reader_lock = threading.Lock()
         self.create_table()
+        self.create_stats_tables()
+        self.create_host_limits_table()
+        self.create_discovery_tables()
+        # Performance samples are buffered and written in batches instead of one commit per tool call
+        self.metrics_writer = MetricsWriter(self)
+        self.closed = False
+        atexit.register(self.close)
+
+    @contextmanager
+    def reading(self):
+        """Checks out a read-only connection for the duration of the block."""
+        if not self.reader_pool_size:
+            with self.lock:
+                yield self.conn
+            return
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self.reader_lock:
+                can_open = self.reader_count < self.reader_pool_size
+                if can_open:
+                    self.reader_count += 1
+            if can_open:
+                conn = sqlite3.connect(self.db_file, check_same_thread=False)
+                conn.execute("PRAGMA query_only = ON")
+            else:
+                conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
 
     def create_table(self) -> None:
         """Creates the shops table if it doesn't exists."""
-        with self.conn:
+        with self.lock, self.conn:
             self.conn.execute("""
                               CREATE TABLE IF NOT EXISTS shops (
                                   id INTEGER PRIMARY KEY,
@@ -28,69 +87,388 @@ class KnowledgeBase:
                                   api_success_rate REAL DEFAULT 1.0,
                                   scraping_latency REAL DEFAULT 0.0,
                                   scraping_success_rate REAL DEFAULT 1.0,
-                                  total_requests INTEGER DEFAULT 0
+                                  total_requests INTEGER DEFAULT 0,
+                                  cache_hits INTEGER DEFAULT 0
+                              )
+                              """)
+            # Databases created before a column existed are upgraded in place
+            existing_cols = {row[1] for row in self.conn.execute("PRAGMA table_info(shops)")}
+            if 'cache_hits' not in existing_cols:
+                self.conn.execute("ALTER TABLE shops ADD COLUMN cache_hits INTEGER DEFAULT 0")
+            # Capability probes are slow network round trips, so their outcome is kept with a timestamp
+            self.conn.execute("""
+                              CREATE TABLE IF NOT EXISTS probe_cache (
+                                  shop_name TEXT PRIMARY KEY,
+                                  mcp_enabled BOOLEAN,
+                                  mcp_url TEXT,
+                                  api_enabled BOOLEAN,
+                                  api_url TEXT,
+                                  probed_at REAL NOT NULL
+                              )
+                              """)
+
+    def create_stats_tables(self) -> None:
+        """Per-shop, per-method statistics: own request counts, EWMAs and a decaying latency histogram."""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                              CREATE TABLE IF NOT EXISTS method_stats (
+                                  shop_name TEXT NOT NULL,
+                                  method TEXT NOT NULL,
+                                  requests INTEGER DEFAULT 0,
+                                  successes INTEGER DEFAULT 0,
+                                  latency_samples INTEGER DEFAULT 0,
+                                  ewma_success REAL DEFAULT 1.0,
+                                  ewma_latency REAL DEFAULT 0.0,
+                                  updated_at REAL,
+                                  throttled INTEGER DEFAULT 0,
+                                  last_throttled_at REAL,
+                                  cancelled INTEGER DEFAULT 0,
+                                  PRIMARY KEY (shop_name, method)
+                              )
+                              """)
+            # Throttles (429) are counted apart from requests, so rate limiting never reads as unreliability
+            existing_cols = {row[1] for row in self.conn.execute("PRAGMA table_info(method_stats)")}
+            if 'throttled' not in existing_cols:
+                self.conn.execute("ALTER TABLE method_stats ADD COLUMN throttled INTEGER DEFAULT 0")
+                self.conn.execute("ALTER TABLE method_stats ADD COLUMN last_throttled_at REAL")
+            # Hedged attempts cancelled because another method won are likewise kept out of the requests
+            if 'cancelled' not in existing_cols:
+                self.conn.execute("ALTER TABLE method_stats ADD COLUMN cancelled INTEGER DEFAULT 0")
+            self.conn.execute("""
+                              CREATE TABLE IF NOT EXISTS latency_histogram (
+                                  shop_name TEXT NOT NULL,
+                                  method TEXT NOT NULL,
+                                  bucket INTEGER NOT NULL,
+                                  weight REAL NOT NULL,
+                                  PRIMARY KEY (shop_name, method, bucket)
+                              )
+                              """)
+
+    def create_host_limits_table(self) -> None:
+        """Per-host request limits (requests per second, burst) for the rate limiter."""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                              CREATE TABLE IF NOT EXISTS host_limits (
+                                  host TEXT PRIMARY KEY,
+                                  rate REAL NOT NULL,
+                                  burst REAL NOT NULL
                               )
                               """)
 
+    def create_discovery_tables(self) -> None:
+        """The stores found by the last discovery of each location, so a restart does not redo it."""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                              CREATE TABLE IF NOT EXISTS discovery_snapshots (
+                                  location TEXT PRIMARY KEY,
+                                  location_name TEXT,
+                                  discovered_at REAL NOT NULL
+                              )
+                              """)
+            self.conn.execute("""
+                              CREATE TABLE IF NOT EXISTS discovered_stores (
+                                  location TEXT NOT NULL,
+                                  shop_name TEXT NOT NULL,
+                                  scope TEXT,
+                                  seen_at REAL NOT NULL,
+                                  PRIMARY KEY (location, shop_name)
+                              )
+                              """)
+
+    def get_host_limits(self):
+        """{host: (rate, burst)} for every host with a configured limit."""
+        with self.reading() as conn:
+            return {host: (rate, burst) for host, rate, burst in conn.execute("SELECT host, rate, burst FROM host_limits")}
+
+    def set_host_limit(self, host, rate, burst):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO host_limits (host, rate, burst) VALUES (?, ?, ?)", (host.lower(), rate, burst))
+
     def add_shop(self, name, scope, mcp_enabled=False, api_enabled=False, scraping_enabled=True, mcp_url=None, api_url=None):
         """
         Adds a new shop if it doesn't exist. Uses INSERT OR IGNORE to prevent
         crashing on duplicate names.
         """
-        with self.conn:
+        with self.lock, self.conn:
             cursor = self.conn.execute(
                 "INSERT OR IGNORE INTO shops (name, scope, mcp_enabled, api_enabled, scraping_enabled, mcp_url, api_url) VALUES (?, ?, ?, ?, ?, ?, ?)",
                 (name, scope, mcp_enabled, api_enabled, scraping_enabled, mcp_url, api_url)
             )
             # The cursor.rowcount will be 1 if a row was inserted, and 0 if it was ignored.
             if cursor.rowcount > 0:
-                print(f"[KB] Added Shop: {name}")
+                log(f"[KB] Added Shop: {name}")
             else:
-                print(f"[KB] Shop '{name}' already exists. Ignoring duplicate.")
+                log(f"[KB] Shop '{name}' already exists. Ignoring duplicate.")
 
     def get_all_shops(self):
         """Retrieves all shops and their details from the database."""
-        cursor = self.conn.execute("SELECT * FROM shops")
-        # Converse rows to dictionaries for easier access
-        rows = cursor.fetchall()
-        cols = [column[0] for column in cursor.description]
+        with self.reading() as conn:
+            cursor = conn.execute("SELECT * FROM shops")
+            # Converse rows to dictionaries for easier access
+            rows = cursor.fetchall()
+            cols = [column[0] for column in cursor.description]
         return [dict(zip(cols, row)) for row in rows]
 
     def get_shop_by_name(self, name):
         """Retrieves a single shop by its name."""
-        cursor = self.conn.execute("SELECT * FROM shops WHERE name = ?", (name,))
-        row = cursor.fetchone()
+        with self.reading() as conn:
+            cursor = conn.execute("SELECT * FROM shops WHERE name = ?", (name,))
+            row = cursor.fetchone()
+            cols = [column[0] for column in cursor.description]
         if not row:
             return None
-        cols = [column[0] for column in cursor.description]
         return dict(zip(cols, row))
 
-    def update_shop_performance(self, shop_name, method, latency, success):
-        """Updates the performance metrics for a shop's communication method using a moving average"""
-        shop = self.get_shop_by_name(shop_name)
-        if not shop:
-            print(f"[KB] Could not find shop '{shop_name}' to update.")
-            return None
+    def shops_version(self):
+        """
+        Stamp of the known shops and their capabilities (not their performance). It changes when a
+        shop is added or removed or its endpoints change, i.e. when a search would now go elsewhere.
+        """
+        with self.reading() as conn:
+            rows = conn.execute(
+                "SELECT name, scope, mcp_enabled, api_enabled, scraping_enabled, mcp_url, api_url FROM shops ORDER BY name"
+            ).fetchall()
+        return hashlib.sha256(json.dumps(rows).encode('utf-8')).hexdigest()[:16]
 
-        total_requests = shop['total_requests'] + 1
+    def update_shop_performance(self, shop_name, method, latency, success, cached=False, throttled=False,
+                                cancelled=False):
+        """
+        Records a performance sample for a shop's communication method. The sample is written
+        behind the caller's back by the metrics writer; call flush() to force it to disk.
+        Cached answers are counted as cache hits only, so they do not skew the network averages.
+        Throttled calls (the store rate limited us) are counted separately, not as failures, and so
+        are cancelled calls (a hedged attempt stopped because another method answered first).
+        """
+        self.metrics_writer.record(shop_name, method, latency, success, cached, throttled, cancelled)
+        if cancelled:
+            log(f"[KB] Recorded cancelled attempt for '{shop_name}' ({method}); not counted as a failure.")
+        elif throttled:
+            log(f"[KB] Recorded throttling by '{shop_name}' ({method}); not counted as a failure.")
+        elif cached:
+            log(f"[KB] Cache hit for '{shop_name}' ({method}): served in {latency:.3f}s")
+        else:
+            log(f"[KB] Recorded performance for '{shop_name}' ({method}): Success={success}, Latency={latency:.2f}s")
 
-        # Get current metrics
-        old_latency = shop[f'{method}_latency']
-        old_success_rate = shop[f'{method}_success_rate']
+    def apply_performance_batch(self, batch):
+        """
+        Folds aggregated samples ({(shop_name, method): aggregate}) into the per-method stats in one
+        transaction. Every update is computed inside SQL, so concurrent writers cannot lose samples.
+        The shops table keeps mirroring each method's EWMA so older readers see per-method values.
+        """
+        now = time.time()
+        with span("kb_write", pairs=len(batch)), self.lock, self.conn:
+            for (shop_name, method), agg in batch.items():
+                if method not in ('mcp', 'api', 'scraping'):
+                    continue
+                if not self.conn.execute("SELECT 1 FROM shops WHERE name = ?", (shop_name,)).fetchone():
+                    log(f"[KB] Could not find shop '{shop_name}' to update.")
+                    continue
+                if agg['requests']:
+                    self._apply_method_samples(shop_name, method, agg['samples'], now)
+                if agg['throttled']:
+                    self.conn.execute(
+                        """INSERT INTO method_stats (shop_name, method, throttled, last_throttled_at) VALUES (?, ?, ?, ?)
+                           ON CONFLICT (shop_name, method) DO UPDATE SET
+                               throttled = throttled + excluded.throttled, last_throttled_at = excluded.last_throttled_at""",
+                        (shop_name, method, agg['throttled'], now)
+                    )
+                if agg['cancelled']:
+                    self.conn.execute(
+                        """INSERT INTO method_stats (shop_name, method, cancelled) VALUES (?, ?, ?)
+                           ON CONFLICT (shop_name, method) DO UPDATE SET cancelled = cancelled + excluded.cancelled""",
+                        (shop_name, method, agg['cancelled'])
+                    )
+                self.conn.execute(
+                    f"""UPDATE shops SET
+                        {method}_latency = COALESCE((SELECT ewma_latency FROM method_stats WHERE shop_name = ? AND method = ?), {method}_latency),
+                        {method}_success_rate = COALESCE((SELECT ewma_success FROM method_stats WHERE shop_name = ? AND method = ?), {method}_success_rate),
+                        total_requests = total_requests + ?,
+                        cache_hits = cache_hits + ?
+                        WHERE name = ?""",
+                    (shop_name, method, shop_name, method, agg['requests'], agg['cache_hits'], shop_name)
+                )
+        log(f"[KB] Flushed performance samples for {len(batch)} shop/method pair(s).")
 
-        # Calculate new moving average
-        # Succes is 1, Failure is 0
-        success_val = 1 if success else 0
-        new_success_rate = ((old_success_rate * (total_requests - 1)) + success_val) / total_requests
-        new_latency = ((old_latency * (total_requests - 1)) + latency) / total_requests if success else old_latency
+    def _apply_method_samples(self, shop_name, method, samples, now):
+        """Upserts one method's counters and EWMAs, then decays and extends its latency histogram."""
+        success_decay, success_addend, success_initial = ewma_terms([1.0 if ok else 0.0 for _, ok in samples])
+        # Latency only follows successful calls; failures mostly measure our own timeouts
+        latencies = [latency for latency, ok in samples if ok]
+        latency_decay, latency_addend, latency_initial = ewma_terms(latencies) if latencies else (1.0, 0.0, 0.0)
+        successes = len(latencies)
+        self.conn.execute(
+            """INSERT INTO method_stats (shop_name, method, requests, successes, latency_samples, ewma_success, ewma_latency, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT (shop_name, method) DO UPDATE SET
+                   requests = requests + excluded.requests,
+                   successes = successes + excluded.successes,
+                   ewma_success = ewma_success * ? + ?,
+                   ewma_latency = CASE
+                       WHEN excluded.latency_samples = 0 THEN ewma_latency
+                       WHEN latency_samples = 0 THEN excluded.ewma_latency
+                       ELSE ewma_latency * ? + ? END,
+                   latency_samples = latency_samples + excluded.latency_samples,
+                   updated_at = excluded.updated_at""",
+            (shop_name, method, len(samples), successes, successes, success_initial, latency_initial, now,
+             success_decay, success_addend, latency_decay, latency_addend)
+        )
+        if not latencies:
+            return
+        self.conn.execute(
+            "UPDATE latency_histogram SET weight = weight * ? WHERE shop_name = ? AND method = ?",
+            (HISTOGRAM_DECAY ** len(latencies), shop_name, method)
+        )
+        self.conn.executemany(
+            """INSERT INTO latency_histogram (shop_name, method, bucket, weight) VALUES (?, ?, ?, ?)
+               ON CONFLICT (shop_name, method, bucket) DO UPDATE SET weight = weight + excluded.weight""",
+            [(shop_name, method, bucket, count) for bucket, count in histogram_increments(latencies).items()]
+        )
+        self.conn.execute(
+            "DELETE FROM latency_histogram WHERE shop_name = ? AND method = ? AND weight < 0.01", (shop_name, method)
+        )
+
+    def get_method_stats(self, shop_name=None):
+        """
+        Returns {shop_name: {method: stats}} with request counts, EWMA success rate and latency,
+        and p50/p95/p99 latencies from the histogram. Methods without samples are omitted.
+        """
+        where, args = ("WHERE shop_name = ?", (shop_name,)) if shop_name else ("", ())
+        with self.reading() as conn:
+            cursor = conn.execute(f"SELECT * FROM method_stats {where}", args)
+            cols = [column[0] for column in cursor.description]
+            rows = [dict(zip(cols, row)) for row in cursor.fetchall()]
+            histogram_rows = conn.execute(
+                f"SELECT shop_name, method, bucket, weight FROM latency_histogram {where}", args
+            ).fetchall()
+        histograms = {}
+        for name, method, bucket, weight in histogram_rows:
+            histograms.setdefault((name, method), {})[bucket] = weight
 
-        with self.conn:
+        stats = {}
+        for row in rows:
+            method_stats = {
+                'requests': row['requests'],
+                'successes': row['successes'],
+                'success_rate': min(1.0, row['ewma_success']),
+                'latency': row['ewma_latency'],
+                'updated_at': row['updated_at'],
+                'throttled': row['throttled'] or 0,
+                'last_throttled_at': row['last_throttled_at'],
+                'cancelled': row['cancelled'] or 0
+            }
+            method_stats.update(histogram_percentiles(histograms.get((row['shop_name'], row['method']), {})))
+            stats.setdefault(row['shop_name'], {})[row['method']] = method_stats
+        return stats
+
+    def flush(self):
+        """Writes every buffered performance sample now."""
+        self.metrics_writer.flush()
+
+    def close(self):
+        """Shutdown hook: flushes buffered samples and closes the connection. Safe to call twice."""
+        if self.closed:
+            return
+        self.closed = True
+        self.metrics_writer.close()
+        with self.lock:
+            self.conn.close()
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+
+    def get_discovery_snapshot(self, location):
+        """{'location_name', 'discovered_at', 'stores': [{'name', 'scope', 'seen_at'}]} for a location key, or None."""
+        with self.reading() as conn:
+            snapshot = conn.execute(
+                "SELECT location_name, discovered_at FROM discovery_snapshots WHERE location = ?", (location,)
+            ).fetchone()
+            if snapshot is None:
+                return None
+            stores = conn.execute(
+                "SELECT shop_name, scope, seen_at FROM discovered_stores WHERE location = ? ORDER BY shop_name", (location,)
+            ).fetchall()
+        return {
+            'location_name': snapshot[0],
+            'discovered_at': snapshot[1],
+            'stores': [{'name': name, 'scope': scope, 'seen_at': seen_at} for name, scope, seen_at in stores]
+        }
+
+    def last_discovery_location(self):
+        """The location name of the most recent discovery, or None."""
+        with self.reading() as conn:
+            row = conn.execute("SELECT location_name FROM discovery_snapshots ORDER BY discovered_at DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def save_discovery(self, location, location_name, verified_stores):
+        """
+        Replaces a location's snapshot with the (store_info, verified_methods) pairs of a fresh discovery,
+        in one transaction. Known shops get their current capabilities, new ones are added, and shops
+        of the previous snapshot that were not found again are retired, with their stats and probes,
+        unless another location has them. Returns the names of the retired shops.
+        """
+        now = time.time()
+        names = {store['name'] for store, _ in verified_stores}
+        with self.lock, self.conn:
+            previous = {row[0] for row in self.conn.execute(
+                "SELECT shop_name FROM discovered_stores WHERE location = ?", (location,)
+            )}
+            self.conn.executemany(
+                """INSERT INTO shops (name, scope, mcp_enabled, api_enabled, scraping_enabled, mcp_url, api_url)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(name) DO UPDATE SET scope = excluded.scope, mcp_enabled = excluded.mcp_enabled,
+                       api_enabled = excluded.api_enabled, mcp_url = excluded.mcp_url, api_url = excluded.api_url""",
+                [(store['name'], store['scope'], m.get('mcp_enabled', False), m.get('api_enabled', False), True,
+                  m.get('mcp_url'), m.get('api_url')) for store, m in verified_stores]
+            )
+            self.conn.execute("DELETE FROM discovered_stores WHERE location = ?", (location,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO discovered_stores (location, shop_name, scope, seen_at) VALUES (?, ?, ?, ?)",
+                [(location, store['name'], store['scope'], store.get('seen_at', now)) for store, _ in verified_stores]
+            )
             self.conn.execute(
-                f"""UPDATE shops SET
-                    {method}_latency = ?,
-                    {method}_success_rate = ?,
-                    total_requests = ?
-                    WHERE name = ?""",
-                (new_latency, new_success_rate, total_requests, shop_name)
+                "INSERT OR REPLACE INTO discovery_snapshots (location, location_name, discovered_at) VALUES (?, ?, ?)",
+                (location, location_name, now)
+            )
+            retired = [
+                name for name in sorted(previous - names)
+                if not self.conn.execute("SELECT 1 FROM discovered_stores WHERE shop_name = ?", (name,)).fetchone()
+            ]
+            self.conn.executemany("DELETE FROM shops WHERE name = ?", [(name,) for name in retired])
+            # Their stats and probes go with them, so a shop rediscovered later starts from scratch
+            for table in ('method_stats', 'latency_histogram', 'probe_cache'):
+                self.conn.executemany(f"DELETE FROM {table} WHERE shop_name = ?", [(name,) for name in retired])
+        for name in retired:
+            log(f"[KB] Retired shop '{name}': no longer found near {location_name}.")
+        return retired
+
+    def get_fresh_probe_results(self, shop_names, ttl_seconds):
+        """Returns the cached capability probes for the given shops that are younger than the TTL."""
+        if not shop_names:
+            return {}
+        placeholders = ", ".join("?" for _ in shop_names)
+        with self.reading() as conn:
+            cursor = conn.execute(
+                f"SELECT * FROM probe_cache WHERE shop_name IN ({placeholders}) AND probed_at >= ?",
+                (*shop_names, time.time() - ttl_seconds)
+            )
+            cols = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        results = {}
+        for row in rows:
+            probe = dict(zip(cols, row))
+            results[probe['shop_name']] = {
+                'api_enabled': bool(probe['api_enabled']),
+                'api_url': probe['api_url'],
+                'mcp_enabled': bool(probe['mcp_enabled']),
+                'mcp_url': probe['mcp_url']
+            }
+        return results
+
+    def save_probe_results(self, probe_results):
+        """Stores freshly probed capabilities ({shop_name: verified_methods}) in a single transaction."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO probe_cache (shop_name, mcp_enabled, mcp_url, api_enabled, api_url, probed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(name, m['mcp_enabled'], m['mcp_url'], m['api_enabled'], m['api_url'], now) for name, m in probe_results.items()]
             )
-        print(f"[KB] Updated performance for '{shop_name}' ({method}): Success={success}, Latency={latency:.2f}s")
+        log(f"[KB] Cached capability probes for {len(probe_results)} shop(s).")
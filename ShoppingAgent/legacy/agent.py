@@ -1,8 +1,16 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from knowledge_base import KnowledgeBase
 from orchestrator import ShopCommunicationOrchestrator
 from processing import normalize_data, make_decision
+from normalization import concat_batches
 from discovery import find_local_stores, get_national_stores, get_international_stores, verify_communication_methods
 
+# Fan-out search: stop once the provisional top-k has not changed for STABLE_SECONDS, or at the deadline
+FAN_OUT_TOP_K = 3
+STABLE_SECONDS = 3.0
+SEARCH_DEADLINE = 20.0
+
 class AIAgent:
     def __init__(self):
         print("[Agent] Initializing...")
@@ -18,7 +26,7 @@ class AIAgent:
         print(f"\n[Agent] Performing initial store discovery for location: '{user_location}'...")
 
         all_discovered_stores = []
-        all_discovered_stores.extend(find_local_stores(user_location))
+        all_discovered_stores.extend(find_local_stores(user_location, kb=self.kb))
         all_discovered_stores.extend(get_national_stores())
         all_discovered_stores.extend(get_international_stores())
 
@@ -38,12 +46,21 @@ class AIAgent:
         self.is_setup_complete = True
         print("[Agent] Initial setup complete. Knowledge Base is populated.")
 
-    def search_products(self, query, preferences):
-        """The main function to handle a user's search query."""
+    def search_products(self, query, preferences, fan_out=False):
+        """
+        The main function to handle a user's search query. With `fan_out`, all shops are queried
+        concurrently and the ranking of the last provisional result is returned.
+        """
         if not self.is_setup_complete:
             print("[Agent] ERROR: Agent has not been set up. Please run initial setup.")
             return []
 
+        if fan_out:
+            result = {'ranked': []}
+            for result in self.search_products_streaming(query, preferences, top_k=None):
+                pass
+            return result['ranked']
+
         print(f"\n[Agent] Starting new search for '{query}'...")
         all_shops = self.kb.get_all_shops()
         raw_product_data = []
@@ -63,6 +80,68 @@ class AIAgent:
         print("\n[Agent] Search concluded. Returning ranked results.")
         return ranked_products
         
+    def search_products_streaming(self, query, preferences, top_k=FAN_OUT_TOP_K,
+                                  stable_seconds=STABLE_SECONDS, deadline=SEARCH_DEADLINE):
+        """
+        Queries every shop concurrently and yields a provisional ranking each time a shop answers:
+        {'ranked', 'shops_done', 'shops_total', 'final'}. Each batch is normalized as it arrives.
+        Stops early once the top-k has stayed the same for `stable_seconds` or `deadline` passes;
+        shops that have not answered by then are left out. `top_k=None` ranks every product.
+        """
+        if not self.is_setup_complete:
+            print("[Agent] ERROR: Agent has not been set up. Please run initial setup.")
+            return
+
+        print(f"\n[Agent] Starting fan-out search for '{query}'...")
+        all_shops = self.kb.get_all_shops()
+        start_time = time.monotonic()
+        # The orchestrator's own pool runs hedged attempts; shops get a separate one so they cannot starve it
+        pool = ThreadPoolExecutor(max_workers=max(1, len(all_shops)), thread_name_prefix="fan-out")
+        pending = {pool.submit(self.orchestrator.fetch_products_from_shop, shop['name'], query): shop['name']
+                   for shop in all_shops}
+        normalized_batches, ranked = [], []
+        top_ids, stable_since = None, start_time
+
+        try:
+            while pending:
+                now = time.monotonic()
+                timeout = start_time + deadline - now
+                if top_ids:
+                    timeout = min(timeout, stable_since + stable_seconds - now)
+                if timeout <= 0:
+                    reason = "deadline reached" if now - start_time >= deadline else f"top-{top_k} stable for {stable_seconds:.1f}s"
+                    print(f"[Agent] Stopping early ({reason}); {len(pending)} shop(s) still pending.")
+                    break
+
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                batch = []
+                for future in done:
+                    shop_name = pending.pop(future)
+                    try:
+                        batch.extend(future.result() or [])
+                    except Exception as e:
+                        print(f"    ! Fetch from {shop_name} failed: {e}")
+                if not done:
+                    continue
+
+                if batch:
+                    normalized_batches.append(normalize_data(batch))
+                    ranked = make_decision(concat_batches(normalized_batches), preferences, k=top_k)
+                    new_ids = [(p['shop_name'], p['id'] or p['name']) for p in ranked[:top_k or len(ranked)]]
+                    if new_ids != top_ids:
+                        top_ids, stable_since = new_ids, time.monotonic()
+                if pending:
+                    yield {'ranked': ranked, 'shops_done': len(all_shops) - len(pending),
+                           'shops_total': len(all_shops), 'final': False}
+        finally:
+            # Shops that are still running finish in the background and keep reporting to the KB
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        print(f"\n[Agent] Fan-out search concluded in {time.monotonic() - start_time:.2f}s "
+              f"({len(all_shops) - len(pending)}/{len(all_shops)} shops answered).")
+        yield {'ranked': ranked, 'shops_done': len(all_shops) - len(pending),
+               'shops_total': len(all_shops), 'final': True}
+
     def display_shop_performance(self):
         """Shows the learned performance metrics for all shops."""
         if not self.is_setup_complete:
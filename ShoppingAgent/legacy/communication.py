@@ -6,11 +6,26 @@ import random
 KNOWN_API_STORES = ['Best Buy', 'Walmart', 'B&H Photo Video', 'Amazon']
 KNOWN_MCP_STORES = ['Amazon'] # Let's pretend only Amazon has adopted MCP
 
-def fetch_mcp(shop_name, query):
+def _simulate_latency(latency, cancel_event):
+    """
+    Sleeps for the simulated latency, or until the call is cancelled (e.g. a hedged request won).
+    Returns (cancelled, time actually spent).
+    """
+    if cancel_event is None:
+        time.sleep(latency)
+        return False, latency
+    start_time = time.monotonic()
+    cancelled = cancel_event.wait(latency)
+    return cancelled, time.monotonic() - start_time if cancelled else latency
+
+def fetch_mcp(shop_name, query, cancel_event=None):
     """Simulates fetching data from a shop's MCP endpoint."""
     print(f"  > Attempting MCP connection to {shop_name} for '{query}'...")
     latency = random.uniform(0.1, 0.5) # MCP is fast
-    time.sleep(latency)
+    cancelled, latency = _simulate_latency(latency, cancel_event)
+    if cancelled:
+        print(f"  ✗ MCP call to {shop_name} cancelled.")
+        return None, latency, False
     
     # Fail realistically if the shop isn't known to have MCP
     if shop_name not in KNOWN_MCP_STORES:
@@ -29,11 +44,14 @@ def fetch_mcp(shop_name, query):
         print(f"  ✗ MCP Failed for {shop_name}")
         return None, latency, False
 
-def fetch_api(shop_name, query):
+def fetch_api(shop_name, query, cancel_event=None):
     """Simulates fetching data from a shop's REST API."""
     print(f"  > Attempting API connection to {shop_name} for '{query}'...")
     latency = random.uniform(0.3, 1.0) # API is a bit slower
-    time.sleep(latency)
+    cancelled, latency = _simulate_latency(latency, cancel_event)
+    if cancelled:
+        print(f"  ✗ API call to {shop_name} cancelled.")
+        return None, latency, False
 
     # Fail realistically if the shop isn't known to have an API handler
     if shop_name not in KNOWN_API_STORES:
@@ -51,11 +69,14 @@ def fetch_api(shop_name, query):
         print(f"  ✗ API Failed for {shop_name}")
         return None, latency, False
 
-def fetch_web_scrape(shop_name, query):
+def fetch_web_scrape(shop_name, query, cancel_event=None):
     """Simulates fetching data via web scraping."""
     print(f"  > Attempting Web Scrape on {shop_name} for '{query}'...")
     latency = random.uniform(1.5, 4.0) # Scraping is slow and brittle
-    time.sleep(latency)
+    cancelled, latency = _simulate_latency(latency, cancel_event)
+    if cancelled:
+        print(f"  ✗ Scrape of {shop_name} cancelled.")
+        return None, latency, False
 
     # Simulate a lower success rate for scraping
     if random.random() < 0.70:
@@ -1,13 +1,23 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from communication import fetch_mcp, fetch_api, fetch_web_scrape
+from circuit_breaker import BreakerRegistry
+
+# Hedge delay used for a method that has no latency history yet
+DEFAULT_HEDGE_DELAY = 1.0
 
 class ShopCommunicationOrchestrator:
-    def __init__(self, knowledge_base) -> None:
+    def __init__(self, knowledge_base, hedging=True, max_workers=16) -> None:
         self.kb = knowledge_base
         self.methods = {
             'mcp': fetch_mcp,
             'api': fetch_api,
             'scraping': fetch_web_scrape
         }
+        # With hedging, a method that is slower than its learned p95 gets raced against the next-best one
+        self.hedging = hedging
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self.breakers = BreakerRegistry(knowledge_base)
 
     def fetch_products_from_shop(self, shop_name, query):
         """
@@ -26,10 +36,25 @@ class ShopCommunicationOrchestrator:
         if shop_details['api_enabled']: available_methods.append('api')
         if shop_details['scraping_enabled']: available_methods.append('scraping')
 
-        # Calculate a performance score for each method
+        # Skip methods whose circuit breaker is open. Planning only looks: the half-open probe is
+        # taken by allow() right before an attempt starts, so methods never tried keep it free
+        open_methods = [m for m in available_methods if self.breakers.blocked(shop_name, m)]
+        if open_methods:
+            print(f"    - Circuit open, skipping: {open_methods}")
+        available_methods = [m for m in available_methods if m not in open_methods]
+
+        # Calculate a performance score for each method from its own recent stats
+        method_stats = self.kb.get_method_stats(shop_name).get(shop_name, {})
+
         def calculate_score(method):
-            latency = shop_details[f'{method}_latency']
-            success_rate = shop_details[f'{method}_success_rate']
+            stats = method_stats.get(method)
+            if stats:
+                latency = stats['latency']
+                success_rate = stats['success_rate']
+            else:
+                # Untried methods keep the optimistic defaults so they get explored
+                latency = shop_details[f'{method}_latency']
+                success_rate = shop_details[f'{method}_success_rate']
             # We want high success rate and low latency. Add 0.01 to avoid division by zero.
             return success_rate / (latency + 0.01)
 
@@ -37,13 +62,24 @@ class ShopCommunicationOrchestrator:
         sorted_methods = sorted(available_methods, key=calculate_score, reverse=True)
         print(f"    - Prioritized methods: {sorted_methods}")
 
+        if self.hedging:
+            data = self._fetch_hedged(shop_name, query, sorted_methods, method_stats)
+            if data:
+                return data
+            print(f"    ! Failed to retrieve data from {shop_name} using all available methods.")
+            return []
+
         # Execution loop
         for method in sorted_methods:
+            if not self.breakers.allow(shop_name, method):
+                print(f"    - Circuit open, skipping: {method}")
+                continue
             fetch_function = self.methods[method]
             data, latency, success = fetch_function(shop_name, query)
 
             # CRITICAL: Update the knowledge base with the performance of this attempt
             self.kb.update_shop_performance(shop_name, method, latency, success)
+            self.breakers.record(shop_name, method, success)
 
             if success and data:
                 print(f"    - Succesfully retrieved data using {method}.")
@@ -54,3 +90,70 @@ class ShopCommunicationOrchestrator:
 
         print(f"    ! Failed to retrieve data from {shop_name} using all available methods.")
         return []
+
+    def _attempt(self, shop_name, query, method, cancel_event):
+        """Runs one method and always reports its outcome to the KB, even if another attempt already won."""
+        data, latency, success = self.methods[method](shop_name, query, cancel_event=cancel_event)
+        # A loser cancelled by the winning attempt is counted apart, so racing never lowers its EWMA
+        cancelled = cancel_event.is_set() and not success
+        self.kb.update_shop_performance(shop_name, method, latency, success, cancelled=cancelled)
+        # ...and losing a race says nothing about the endpoint's health, so the breaker only frees its probe
+        if cancelled:
+            self.breakers.release(shop_name, method)
+        else:
+            self.breakers.record(shop_name, method, success)
+        return data, success
+
+    def _fetch_hedged(self, shop_name, query, sorted_methods, method_stats):
+        """
+        Starts the preferred method; if it has not answered within its learned p95 latency (or fails),
+        starts the next-best method too and takes whichever succeeds first. Healthy methods answer
+        before their p95 ~95% of the time, so hedging adds only a few percent of extra load.
+        """
+        cancel_event = threading.Event()
+        remaining = list(sorted_methods)
+        pending = {}
+
+        def launch():
+            # The breaker is asked only now, when the attempt really starts
+            while remaining:
+                method = remaining.pop(0)
+                if not self.breakers.allow(shop_name, method):
+                    print(f"    - Circuit open, skipping: {method}")
+                    continue
+                print(f"    - Starting {method} for {shop_name}.")
+                pending[self.pool.submit(self._attempt, shop_name, query, method, cancel_event)] = method
+                return method
+            return None
+
+        newest = launch()
+        try:
+            while pending:
+                p95 = (method_stats.get(newest) or {}).get('p95')
+                hedge_delay = (p95 or DEFAULT_HEDGE_DELAY) if remaining else None
+                done, _ = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+
+                if not done:
+                    print(f"    - {newest} exceeded its p95 ({hedge_delay:.2f}s); hedging.")
+                    newest = launch() or newest
+                    continue
+
+                for future in done:
+                    method = pending.pop(future)
+                    data, success = future.result()
+                    if success and data:
+                        print(f"    - Succesfully retrieved data using {method}.")
+                        for item in data:
+                            item['shop_name'] = shop_name
+                        return data
+                # A failure frees its slot: fall back to the next method right away
+                if remaining and len(pending) == 0:
+                    newest = launch() or newest
+            return []
+        finally:
+            # Losing attempts stop early and report themselves to the KB; one that never got to
+            # run cannot, so the probe its breaker handed out is freed here
+            cancel_event.set()
+            for future, method in pending.items():
+                if future.cancel():
+                    self.breakers.release(shop_name, method)
@@ -1,30 +1,55 @@
 import os
 import json
+import queue
+import threading
+import time
 from google import genai
 from google.genai import types
 from knowledge_base import KnowledgeBase
 from tools import ToolBox
+from tool_executor import ToolExecutor
+from conversation import ConversationContext
+from events import EventBus, AnswerToken, QueryFinished
+from recommendation_cache import RecommendationCache
+from plan_cache import PlanCache, succeeded
+from tracing import log, span, in_current_context
+
+ERROR_ANSWER = "I'm sorry, I encountered an issue while processing your request. Please try again."
 
 class LLMAgent:
-    def __init__(self, knowledge_base: KnowledgeBase):
+    def __init__(self, knowledge_base: KnowledgeBase, client=None, toolbox: ToolBox = None, tool_executor: ToolExecutor = None,
+                 recommendation_cache: RecommendationCache = None, plan_cache: PlanCache = None):
         """
         Initializes the agent using the NEW google-genai SDK.
+        A ready-made client (e.g. a scripted stand-in for benchmarks) can be passed in instead.
+        A server shares one client, toolbox and tool executor between all sessions; the agent
+        itself then only holds configuration, and each query's state lives in its own context.
         """
-        if not os.getenv("GEMINI_API_KEY"):
+        if client is None and not os.getenv("GEMINI_API_KEY"):
             raise ValueError("GEMINI_API_KEY not found in .env file.")
 
         # CORRECT: Initialize the client as per the migration guide.
         # The new SDK uses a client object to make API calls.
-        self.client = genai.Client()
+        self.client = client or genai.Client()
 
-        self.toolbox = ToolBox(knowledge_base)
-        self.tool_functions = self.toolbox.get_tool_functions()
+        # Tool progress, products and answer tokens are published here as they happen
+        self.toolbox = toolbox or ToolBox(knowledge_base, events=EventBus())
+        self.events = self.toolbox.events
+        # Tool calls from the same Gemini turn are independent, so they run concurrently.
+        self.tool_executor = tool_executor or ToolExecutor(self.toolbox.get_tool_functions(), events=self.events)
+        self.tool_functions = self.tool_executor.tool_functions
+        # Repeat and near-identical queries are answered without the model while their data is unchanged
+        self.recommendations = recommendation_cache or RecommendationCache(knowledge_base, self.toolbox.catalog)
+        # Queries with a known tool plan replay it and only ask the model for the final answer
+        self.plans = plan_cache or PlanCache(knowledge_base, self.toolbox.ranking_engine)
         
         # CORRECT: Tools are passed in the GenerateContentConfig.
         # The new SDK uses a GenerateContentConfig object to pass configuration, including tools.
         self.config = types.GenerateContentConfig(
             tools=list(self.tool_functions.values())
         )
+        # Used once a query has spent its token budget: the model must answer with what it has
+        self.final_answer_config = types.GenerateContentConfig()
 
         # The model name should include the 'models/' prefix. This is correct.
         self.model_name = 'models/gemini-2.5-flash' 
@@ -38,89 +63,239 @@ class LLMAgent:
         1.  **Read from KB (ALWAYS Step 1):**
             - At the start of every new user query, your absolute first action must be `get_shop_details_from_kb()`. This gives you the current state of all known stores, their capabilities, and their performance metrics.
 
-        2.  **Plan & Act (Step 2):**
+        2.  **Check the local catalog:**
+            - Call `search_local_catalog` with the product keywords of the request (you may call it together with `get_shop_details_from_kb`). It returns in milliseconds.
+            - If it returns enough fresh offers (not `stale`) for what the user asked, skip the store calls and go straight to `rank_products`.
+
+        3.  **Plan & Act:**
             - Analyze the KB data and the user's request.
             - Formulate a plan, prioritizing the best-performing methods (Scraping > API > MCP). Use the latency and success rates from the KB to inform your choice.
+            - Each shop's `method_stats` holds the recent success rate, latency and p50/p95/p99 latency of every method. Prefer these over the older per-shop columns.
+            - Do not plan calls to methods listed in a shop's `circuit_breakers`; they are down and will be rejected immediately.
+            - `throttled` in `method_stats` counts calls the store rate-limited; that is not unreliability. A tool result with `throttled` means try that shop later; one with `budget_exhausted` means answer with what you have.
             - Execute the appropriate communication tool (`fetch_products_via_mcp`, `make_http_get_request`, or `scrape_and_summarize_website_text`).
             - **CRITICAL:** The output from these tools is a JSON string containing `result`, `success`, and `latency`. You MUST parse this JSON to get the data.
 
-        3.  **Synthesize & Respond (Step 4):**
+        4.  **Synthesize & Respond:**
             - After updating the KB, analyze the `result` data you received.
-            - If you need to search other stores, go back to Step 2 and repeat the cycle.
+            - If you need to search other stores, go back to step 3 and repeat the cycle.
+            - To compare the offers you collected, call `rank_products` with weights that reflect the user's priorities instead of ranking long lists yourself.
             - Once you have enough information, present the top 3 products to the user, unless they ask for a different number.
 
         By following this Read-Act-Write cycle, you constantly learn and improve your own performance.
         """
 
-    def process_user_query(self, user_query: str) -> str:
+    def stream_user_query(self, user_query: str):
+        """
+        Runs the query on a worker thread and yields its events (ToolCallStarted, ToolCallFinished,
+        ProductsFound, AnswerToken) as they happen, ending with QueryFinished carrying the answer.
+        """
+        events = queue.Queue()
+        finished = threading.Event()
+
+        def put(event):
+            if isinstance(event, QueryFinished):
+                finished.set()
+            events.put(event)
+
+        def run():
+            start_time = time.monotonic()
+            try:
+                self.process_user_query(user_query, put)
+            except Exception as e:
+                log(f"[LLM Agent] The query worker failed: {e}")
+            finally:
+                # Whatever ended the worker, the generator below must see the query finish
+                if not finished.is_set():
+                    events.put(QueryFinished(ERROR_ANSWER, time.monotonic() - start_time))
+
+        worker = threading.Thread(target=in_current_context(run), name="agent-query", daemon=True)
+        worker.start()
+        while True:
+            event = events.get()
+            yield event
+            if isinstance(event, QueryFinished):
+                break
+        worker.join()
+
+    def _absorb_chunk(self, chunk, parts):
+        """Adds a streamed chunk's parts to `parts`, publishing its text. Returns the chunk's usage metadata, if any."""
+        if chunk.candidates and chunk.candidates[0].content:
+            for part in chunk.candidates[0].content.parts or []:
+                if part.text and not part.thought:
+                    self.events.emit(AnswerToken(part.text))
+                    # Keep the history compact: consecutive text chunks become one part
+                    if parts and parts[-1].text and not parts[-1].thought and not parts[-1].thought_signature and not part.thought_signature:
+                        parts[-1] = types.Part.from_text(text=parts[-1].text + part.text)
+                        continue
+                parts.append(part)
+        return chunk.usage_metadata
+
+    def _generate(self, contents, config):
+        """
+        Streams one model turn, publishing its text as AnswerToken events as it arrives.
+        Returns the assembled model content and the usage metadata of the turn.
+        """
+        parts, usage = [], None
+        with span("gemini_round_trip", model=self.model_name) as round_trip:
+            stream = self.client.models.generate_content_stream(model=self.model_name, contents=contents, config=config)
+            for chunk in stream:
+                usage = self._absorb_chunk(chunk, parts) or usage
+            round_trip.set(prompt_tokens=usage.prompt_token_count if usage else None,
+                           function_calls=sum(1 for part in parts if part.function_call))
+        return types.Content(role="model", parts=parts), usage
+
+    def process_user_query(self, user_query: str, on_event=None) -> str:
         """
         Processes the user's query using a manually managed chat history and the correct tool-calling loop.
+        `on_event`, if given, receives this query's events; the answer is also returned as before.
         """
-        print(f"\n[LLM Agent] Starting to process query: '{user_query}'")
-        
-        # Manually manage conversation history as a list of Content objects
-        # The new SDK uses genai.to_content() to convert text to Content objects
-        conversation_history = [
-            types.Content(role="user", parts=[types.Part.from_text(text=self.system_prompt)]),
-            types.Content(role="user", parts=[types.Part.from_text(text=user_query)])
-        ]
+        token = self.events.listen(on_event) if on_event else None
+        try:
+            start_time = time.monotonic()
+            with span("query", query=user_query) as query_span:
+                answer = self.recommendations.lookup(user_query)
+                if answer is not None:
+                    query_span.set(cached=True)
+                    log(f"[LLM Agent] Answering '{user_query}' from the recommendation cache.")
+                    self.events.emit(AnswerToken(answer))
+                else:
+                    answer = self._run_query(user_query)
+                    if answer != ERROR_ANSWER:
+                        self.recommendations.store(user_query, answer, self.toolbox.current_query().sources)
+            self.events.emit(QueryFinished(answer, time.monotonic() - start_time))
+            return answer
+        finally:
+            if token is not None:
+                self.events.stop_listening(token)
+
+    def _run_query(self, user_query: str) -> str:
+        log(f"\n[LLM Agent] Starting to process query: '{user_query}'")
+        self.toolbox.start_query()
+
+        stages = self.plans.lookup(user_query)
+        if stages is not None:
+            answer = self._replay_plan(user_query, stages)
+            if answer is not None:
+                return answer
+            # Plan from scratch, without the offers the abandoned replay gathered but within the same budget
+            self.toolbox.current_query().reset_results()
+
+        # The conversation context compacts consumed tool results and enforces the token budgets
+        context = ConversationContext(self.system_prompt, user_query)
+        config = self.config
+        # Each turn's (calls, responses), recorded as the plan for later queries like this one
+        turns = []
 
         while True:
-            print("[LLM Agent] Sending request to Gemini...")
+            log("[LLM Agent] Sending request to Gemini...")
             try:
-                # CORRECT: API call through the client object.
-                # The `generate_content` method is on the `client.models` object.
-                response = self.client.models.generate_content(
-                    model=self.model_name,
-                    contents=conversation_history,
-                    config=self.config
-                )
-
-                # The old check 'response.candidates[0].finish_reason == types.FinishReason.TOOL_CALL' is incorrect.
-                # The new, correct way is to directly check if 'response.function_calls' exists and has content.
-                if response.function_calls:
-                    print("[LLM Agent] Gemini is requesting a tool call.")
-                    # Append the model's request to the history
-                    conversation_history.append(response.candidates[0].content)
-
-                    # Getting function calls is now done via response.function_calls
-                    function_calls = response.function_calls
-                    
-                    # Construct the tool response using types.Part.from_function_response
-                    tool_response_parts = []
-                    for call in function_calls:
-                        function_name = call.name
-                        function_args = dict(call.args)
-                        print(f"  - Tool: {function_name}, Arguments: {function_args}")
-
-                        if function_name in self.tool_functions:
-                            tool_function = self.tool_functions[function_name]
-                            try:
-                                tool_output = tool_function(**function_args)
-                                tool_response_parts.append(
-                                    types.Part.from_function_response(
-                                        name=function_name,
-                                        response={'result': tool_output}
-                                    )
-                                )
-                            except Exception as e:
-                                print(f"[LLM Agent] Error executing tool {function_name}: {e}")
-                                tool_response_parts.append(
-                                    types.Part.from_function_response(
-                                        name=function_name,
-                                        response={'error': str(e)}
-                                    )
-                                )
-                    
-                    print("[LLM Agent] Tools executed. Sending results back to Gemini.")
-                    # Append the tool results as a new Content object to the history
-                    conversation_history.append(types.Content(role="tool", parts=tool_response_parts))
+                contents, estimated_tokens = context.contents()
+
+                # The turn is streamed so the final answer reaches the user token by token
+                model_content, usage = self._generate(contents, config)
 
+                self._record_turn(context, usage, estimated_tokens)
+
+                # A turn that contains function calls is a tool request; anything else is the final answer
+                calls = self._tool_calls(context, model_content)
+                if calls:
+                    # Run every call of this turn in parallel; responses come back in call order
+                    tool_responses = self.tool_executor.run(calls)
+                    turns.append((calls, tool_responses))
+                    config = self._add_tool_results(context, calls, tool_responses, config)
                 else:
-                    # The model has finished its reasoning
-                    print("[LLM Agent] Gemini has provided the final answer.")
-                    return response.text.strip()
-            
+                    answer = self._final_answer(model_content)
+                    if answer:
+                        self.plans.store(user_query, turns)
+                    return answer
+
             except Exception as e:
-                print(f"[LLM Agent] An error occurred during generation: {e}")
-                return "I'm sorry, I encountered an issue while processing your request. Please try again."
+                log(f"[LLM Agent] An error occurred during generation: {e}")
+                return ERROR_ANSWER
+
+    def _replay_plan(self, user_query: str, stages) -> str:
+        """
+        Runs a recorded plan stage by stage, each stage's calls in parallel, then asks the model once
+        for the final answer. Returns None, dropping the plan, when a call fails or no answer comes back.
+        """
+        log(f"[LLM Agent] Replaying a recorded plan of {sum(len(stage) for stage in stages)} tool call(s).")
+        context = ConversationContext(self.system_prompt, user_query)
+        try:
+            with span("plan_replay", stages=len(stages)):
+                for calls in stages:
+                    tool_responses = self.tool_executor.run(calls)
+                    if not self._replayed(user_query, context, calls, tool_responses):
+                        return None
+                contents, estimated_tokens = self._synthesis_contents(context)
+                model_content, usage = self._generate(contents, self.final_answer_config)
+                self._record_turn(context, usage, estimated_tokens)
+        except Exception as e:
+            log(f"[LLM Agent] Plan replay failed: {e}")
+            self.plans.invalidate(user_query)
+            return None
+        return self._replayed_answer(user_query, model_content)
+
+    def _replayed(self, user_query, context, calls, tool_responses):
+        """Adds a replayed stage to the history as if the model had requested it. False if any call failed."""
+        failed = [name for (name, _), response in zip(calls, tool_responses) if not succeeded(name, response)]
+        if failed:
+            log(f"[LLM Agent] Replayed call(s) {', '.join(failed)} failed; planning from scratch.")
+            self.plans.invalidate(user_query)
+            return False
+        context.add_model_turn(types.Content(role="model", parts=[
+            types.Part.from_function_call(name=name, args=args) for name, args in calls
+        ]))
+        context.add_tool_results(calls, tool_responses)
+        return True
+
+    def _synthesis_contents(self, context):
+        log("[LLM Agent] Plan replayed. Asking Gemini for the final answer.")
+        context.add_user_note("These tool results cover the request. Do not call more tools; give your final answer.")
+        return context.contents()
+
+    def _replayed_answer(self, user_query, model_content):
+        answer = self._final_answer(model_content)
+        if not answer:
+            self.plans.invalidate(user_query)
+            return None
+        return answer
+
+    def _record_turn(self, context, usage, estimated_tokens):
+        prompt_tokens = usage.prompt_token_count if usage and usage.prompt_token_count else estimated_tokens
+        context.record_usage(prompt_tokens)
+        log(f"[LLM Agent] Turn {context.turns}: {prompt_tokens} input tokens "
+              f"(estimated {estimated_tokens}, {context.input_tokens_used} used by this query).")
+
+    def _tool_calls(self, context, model_content):
+        """The (name, args) tool calls the model requested this turn; the request joins the history."""
+        function_calls = [part.function_call for part in model_content.parts if part.function_call]
+        if not function_calls:
+            return []
+        log("[LLM Agent] Gemini is requesting a tool call.")
+        # Append the model's request to the history
+        context.add_model_turn(model_content)
+
+        calls = []
+        for call in function_calls:
+            function_args = dict(call.args or {})
+            log(f"  - Tool: {call.name}, Arguments: {function_args}")
+            calls.append((call.name, function_args))
+        return calls
+
+    def _add_tool_results(self, context, calls, tool_responses, config):
+        """Adds the tool results to the history. Returns the config for the next turn."""
+        log("[LLM Agent] Tools executed. Sending results back to Gemini.")
+        context.add_tool_results(calls, tool_responses)
+
+        if context.request_budget_exhausted and config is self.config:
+            log("[LLM Agent] Token budget for this query reached. Asking for the final answer.")
+            context.add_user_note("The token budget for this request is used up. "
+                                  "Do not call more tools; give your final answer with the data you already have.")
+            return self.final_answer_config
+        return config
+
+    def _final_answer(self, model_content):
+        # The model has finished its reasoning
+        log("[LLM Agent] Gemini has provided the final answer.")
+        return "".join(part.text for part in model_content.parts if part.text and not part.thought).strip()
@@ -1,42 +1,31 @@
 import os
-from dotenv import load_dotenv
-from knowledge_base import KnowledgeBase
-from discovery import find_local_stores, get_national_stores, get_international_stores, verify_communication_methods
-from llm_agent import LLMAgent
+import importlib
+import threading
+from config import load_config
+
+# Settings in .env must reach the environment before the modules below read them
+load_config()
 
-# Load environment variables from a .env file
-load_dotenv()
+from knowledge_base import KnowledgeBase
+from discovery import load_stores
 
 def perform_initial_setup(kb: KnowledgeBase):
     """
-    Performs the 'First Use' phase by discovering, verifying
-    and adding stores to the Knowledge Base.
+    Performs the 'First Use' phase: makes the stores of the user's location available in the
+    Knowledge Base. A location discovered before starts at once from its saved snapshot
+    (refreshed in the background when stale); a new one is discovered and verified now.
     """
-    location = input("Please enter your location to find local stores (e.g., 'New York, NY'): ")
-    print(f"\n[Setup] Performing store discovery for location: '{location}'...")
+    last_location = kb.last_discovery_location()
+    prompt = "Please enter your location to find local stores (e.g., 'New York, NY')"
+    location = input(f"{prompt} [{last_location}]: " if last_location else f"{prompt}: ").strip() or last_location or ""
+    print(f"\n[Setup] Loading stores for location: '{location}'...")
 
-    all_discovered_stores = []
-    all_discovered_stores.extend(find_local_stores(location))
-    all_discovered_stores.extend(get_national_stores())
-    all_discovered_stores.extend(get_international_stores())
+    store_count, warm = load_stores(kb, location)
 
-    print(f"\n[Setup] Verifying communication methods for all discovered stores...")
-    for store_info in all_discovered_stores:
-        # --- VERIFICATION STEP ---
-        # In a real app, you might have more robust checks here
-        verified_methods = verify_communication_methods(store_info['name'])
-
-        kb.add_shop(
-            name=store_info['name'],
-            scope=store_info['scope'],
-            mcp=verified_methods.get('mcp', False),
-            mcp_url=verified_methods.get('mcp_url'),
-            api=verified_methods.get('api', False),
-            api_url=verified_methods.get('api_url'),
-            scraping=True
-        )
-
-    print("\n[Setup] Initial setup complete. Knowledge Base is populated.")
+    if warm:
+        print(f"\n[Setup] Using {store_count} previously discovered stores. Knowledge Base is ready.")
+    else:
+        print(f"\n[Setup] Initial setup complete. Knowledge Base is populated with {store_count} stores.")
 
 
 def main():
@@ -47,6 +36,10 @@ def main():
         print("\nFATAL ERROR: GEMINI_API_KEY environment variable not set.")
         return
 
+    # The agent's modules (the Gemini SDK above all) take a while to import: load them while the user types
+    preload = threading.Thread(target=importlib.import_module, args=("llm_agent",), name="preload-agent", daemon=True)
+    preload.start()
+
     # 1. Initialize the Knowledge Base
     kb = KnowledgeBase()
 
@@ -55,6 +48,8 @@ def main():
     
     # 3. Initialize the LLM Agent, giving it the populated Knowledge Base
     print("\n[Main] Initializing the AI Shopping Assistant with discovered store data...")
+    preload.join()
+    from llm_agent import LLMAgent
     llm_agent = LLMAgent(kb)
     print("[Main] AI Assistant is ready.")
 
@@ -66,6 +61,11 @@ def main():
         query = input("> ")
 
         if query.lower() == 'quit':
+            from transport import get_transport
+            for origin, stats in get_transport().metrics().items():
+                print(f"[Transport] {origin}: {stats['requests']} request(s), {stats['reused_connections']} reused connection(s)")
+            # Write any buffered performance samples before leaving
+            kb.close()
             print("Goodbye!")
             break
         
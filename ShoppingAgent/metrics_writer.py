@@ -0,0 +1,103 @@
+import threading
+from tracing import log
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_PENDING = 100
+# Samples of failed writes are kept for the next flush, up to this many; the oldest beyond it are dropped
+MAX_RETAINED = 10_000
+
+class MetricsWriter:
+    def __init__(self, kb, flush_interval=DEFAULT_FLUSH_INTERVAL, max_pending=DEFAULT_MAX_PENDING, max_retained=MAX_RETAINED):
+        """
+        Write-behind buffer for shop performance samples. Samples are aggregated in memory and
+        written by a background thread in one transaction, either every `flush_interval` seconds
+        or as soon as `max_pending` samples are waiting. A failed write (e.g. the database is
+        locked) puts its samples back for the next flush instead of losing them.
+        """
+        self.kb = kb
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retained = max_retained
+        self.pending = []
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        # Serializes flushes so the periodic thread and an explicit flush() never interleave
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="kb-metrics-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, shop_name, method, latency, success, cached=False, throttled=False, cancelled=False):
+        """Queues one sample; never touches the database on the caller's thread."""
+        with self.lock:
+            self.pending.append((shop_name, method, latency, success, cached, throttled, cancelled))
+            if len(self.pending) >= self.max_pending:
+                self.wake.set()
+
+    def _run(self):
+        while not self.stopped:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Nothing may end this thread: without it, queued samples would pile up unwritten
+                log(f"[MetricsWriter] Flush failed: {e}")
+
+    def flush(self):
+        """Aggregates the queued samples per (shop, method) and writes them in a single batch."""
+        with self.flush_lock:
+            with self.lock:
+                samples, self.pending = self.pending, []
+            if not samples:
+                return 0
+
+            batch = {}
+            for shop_name, method, latency, success, cached, throttled, cancelled in samples:
+                agg = batch.setdefault((shop_name, method), {
+                    'requests': 0, 'successes': 0, 'latency_sum': 0.0, 'cache_hits': 0, 'throttled': 0,
+                    'cancelled': 0, 'samples': []
+                })
+                if cached:
+                    agg['cache_hits'] += 1
+                    continue
+                if throttled:
+                    agg['throttled'] += 1
+                    continue
+                if cancelled:
+                    agg['cancelled'] += 1
+                    continue
+                agg['requests'] += 1
+                agg['samples'].append((latency, success))
+                if success:
+                    agg['successes'] += 1
+                    agg['latency_sum'] += latency
+
+            try:
+                self.kb.apply_performance_batch(batch)
+            except Exception as e:
+                self._requeue(samples)
+                self.failed_flushes += 1
+                log(f"[MetricsWriter] Writing {len(samples)} sample(s) failed; retrying on the next flush. {e}")
+                return 0
+            self.flushes += 1
+            return len(samples)
+
+    def _requeue(self, samples):
+        with self.lock:
+            self.pending = samples + self.pending
+            overflow = len(self.pending) - self.max_retained
+            if overflow > 0:
+                del self.pending[:overflow]
+                self.dropped += overflow
+                log(f"[MetricsWriter] Dropped the {overflow} oldest unwritten sample(s).")
+
+    def close(self):
+        """Stops the background thread and writes whatever is still queued."""
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
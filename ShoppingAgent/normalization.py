@@ -0,0 +1,241 @@
+import re
+import threading
+import numpy as np
+import pyarrow as pa
+from ranking import parse_price
+from review_scoring import score_products
+
+TARGET_CURRENCY = 'USD'
+# Offline reference rates in units per US dollar. Approximate on purpose: ranking needs comparable
+# magnitudes across stores, not a quote, and normalization must not wait on the network.
+FX_RATES = {'USD': 1.0, 'COP': 4000.0, 'EUR': 0.92, 'GBP': 0.79, 'MXN': 17.0, 'BRL': 5.0, 'CAD': 1.36}
+# Decimal separator of each currency's usual price format; the other of '.' and ',' groups thousands
+DECIMAL_SEPARATORS = {'COP': ',', 'EUR': ',', 'BRL': ',', 'USD': '.', 'GBP': '.', 'MXN': '.', 'CAD': '.'}
+# Currency of prices that do not name one ('$' alone is ambiguous): Colombian stores quote pesos
+SHOP_CURRENCIES = {'Panamericana': 'COP', 'Exito': 'COP', 'Ktronix': 'COP'}
+# Currencies quoted without cents: a price with cents at a store assumed to use one is a dollar price
+ZERO_DECIMAL_CURRENCIES = {'COP'}
+# A price in a store's assumed currency worth less than this (in TARGET_CURRENCY) is not trusted:
+# it is flagged as ambiguous and left out of price comparisons instead of ranking as nearly free
+MIN_PLAUSIBLE_PRICE = 1.0
+CURRENCY_RE = re.compile(r'US\$|R\$|USD|COP|EUR|GBP|MXN|BRL|CAD|€|£', re.IGNORECASE)
+CURRENCY_SYMBOLS = {'us$': 'USD', 'r$': 'BRL', '€': 'EUR', '£': 'GBP'}
+NUMBER_RE = re.compile(r'\d[\d.,]*')
+CENTS_RE = re.compile(r'[.,]\d{1,2}$')
+
+SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('name', pa.string()),
+    ('shop_name', pa.string()),
+    ('price', pa.float64()),
+    ('currency', pa.string()),
+    ('original_price', pa.float64()),
+    ('original_currency', pa.string()),
+    ('quality_score', pa.float64()),
+    ('currency_ambiguous', pa.bool_()),
+])
+
+class SourceAdapter:
+    def __init__(self, name, signature, id=(), title=(), price=(), currency=(), reviews=()):
+        """
+        Field names one source schema uses for each output column, in order of preference. An adapter
+        applies to records that have all of its `signature` fields.
+        """
+        self.name = name
+        self.signature = frozenset(signature)
+        self.fields = {'id': id, 'name': title, 'price': price, 'currency': currency, 'reviews': reviews}
+
+    def compile(self, keys):
+        """{column: field} for records with exactly these keys, resolved once per schema."""
+        return {column: next((f for f in candidates if f in keys), None) for column, candidates in self.fields.items()}
+
+class AdapterRegistry:
+    def __init__(self, adapters=()):
+        """Source adapters, tried in registration order. Compiled field maps are cached per record key set."""
+        self.adapters = list(adapters)
+        self.compiled = {}
+        self.lock = threading.Lock()
+
+    def register(self, adapter):
+        with self.lock:
+            self.adapters.append(adapter)
+            self.compiled.clear()
+        return adapter
+
+    def field_map(self, record):
+        keys = tuple(record)
+        field_map = self.compiled.get(keys)
+        if field_map is None:
+            adapter = next((a for a in self.adapters if a.signature <= set(keys)), self.adapters[-1])
+            field_map = adapter.compile(keys)
+            with self.lock:
+                self.compiled[keys] = field_map
+        return field_map
+
+# The three legacy sources (MCP, REST API, scraped pages) and the offers the tools extract from pages
+DEFAULT_ADAPTERS = AdapterRegistry([
+    SourceAdapter('mcp', ['product_id'], id=['product_id'], title=['name'], price=['price'],
+                  currency=['currency'], reviews=['reviews']),
+    SourceAdapter('api', ['sku'], id=['sku'], title=['productName', 'name'], price=['cost', 'price'],
+                  currency=['currency'], reviews=['customer_feedback', 'reviews']),
+    SourceAdapter('scraped', ['title'], id=['id', 'sku'], title=['title'], price=['price_str', 'price'],
+                  currency=['currency'], reviews=['reviews_text', 'reviews']),
+    SourceAdapter('generic', [], id=['id', 'product_id', 'sku'], title=['name', 'title', 'productName'],
+                  price=['price', 'cost', 'price_str'], currency=['currency', 'priceCurrency'],
+                  reviews=['reviews', 'customer_feedback', 'reviews_text']),
+])
+
+def has_cents(price):
+    """Whether a price is quoted with a fractional part: '199.99', '1.299,90' or 149.5."""
+    if isinstance(price, str):
+        match = NUMBER_RE.search(price)
+        return bool(match and CENTS_RE.search(match.group(0).rstrip('.,')))
+    return isinstance(price, float) and not price.is_integer()
+
+def parse_locale_price(text, currency):
+    """
+    Number in a price string, read with the currency's separators: '1.299.900' COP is 1299900 and
+    '1.299,90' EUR is 1299.9. A last separator followed by only one or two digits is a decimal point
+    in any currency, so '199.99' stays 199.99 even at a store that quotes pesos. Unknown currencies
+    fall back to ranking.parse_price's heuristics.
+    """
+    match = NUMBER_RE.search(text)
+    if not match:
+        return np.nan
+    number = match.group(0).rstrip('.,')
+    decimal = DECIMAL_SEPARATORS.get(currency)
+    if decimal is None:
+        return parse_price(number)
+    last = max(number.rfind('.'), number.rfind(','))
+    if last >= 0 and len(number) - last - 1 <= 2:
+        decimal = number[last]
+    thousands = '.' if decimal == ',' else ','
+    try:
+        return float(number.replace(thousands, '').replace(decimal, '.'))
+    except ValueError:
+        return parse_price(number)
+
+class NormalizationPipeline:
+    def __init__(self, adapters=DEFAULT_ADAPTERS, target_currency=TARGET_CURRENCY, fx_rates=None, shop_currencies=None):
+        """
+        Maps raw offers from any registered source into one Arrow RecordBatch. Columns are built
+        in one pass, prices are parsed once per distinct string and converted to the target currency
+        as a single vector operation, and review scores are computed as one batch.
+        """
+        self.adapters = adapters
+        self.target_currency = target_currency
+        self.fx_rates = dict(FX_RATES, **(fx_rates or {}))
+        self.shop_currencies = dict(SHOP_CURRENCIES, **(shop_currencies or {}))
+
+    def _currency(self, declared, price, shop_name):
+        """(currency, assumed): assumed is True when only the store's usual currency says so."""
+        if declared:
+            return str(declared).upper(), False
+        if isinstance(price, str):
+            marker = CURRENCY_RE.search(price)
+            if marker:
+                found = marker.group(0).lower()
+                return CURRENCY_SYMBOLS.get(found, found.upper()), False
+        if shop_name in self.shop_currencies:
+            currency = self.shop_currencies[shop_name]
+            if currency in ZERO_DECIMAL_CURRENCIES and has_cents(price):
+                return self.target_currency, False
+            return currency, True
+        return self.target_currency, False
+
+    def _price(self, record, fields, parsed):
+        """
+        (price as quoted, currency, ambiguous) of one raw offer; `parsed` caches parsed strings per
+        (text, currency). Ambiguous prices are in an assumed currency and implausibly low in it.
+        """
+        raw_price = record.get(fields['price']) if fields['price'] else None
+        currency, assumed = self._currency(record.get(fields['currency']) if fields['currency'] else None, raw_price,
+                                           record.get('shop_name'))
+        if isinstance(raw_price, (int, float)):
+            price = float(raw_price)
+        elif raw_price is None:
+            return np.nan, currency, False
+        else:
+            key = (raw_price, currency)
+            if key not in parsed:
+                parsed[key] = parse_locale_price(str(raw_price), currency)
+            price = parsed[key]
+        ambiguous = assumed and price * self.fx_rates[self.target_currency] / self.fx_rates.get(currency, np.nan) < MIN_PLAUSIBLE_PRICE
+        return price, currency, bool(ambiguous)
+
+    def _convert(self, prices, currencies, ambiguous):
+        """
+        (prices in the target currency, currency of each converted price) as one vector operation.
+        Ambiguous prices convert to NaN, so they never win on price.
+        """
+        # Units per dollar of each row's currency over the target's; NaN leaves unknown currencies unconverted
+        rate_by_currency = {c: self.fx_rates.get(c, np.nan) / self.fx_rates[self.target_currency] for c in set(currencies)}
+        rates = np.fromiter((rate_by_currency[c] for c in currencies), dtype=float, count=len(currencies))
+        convertible = ~np.isnan(rates)
+        converted = np.where(convertible, prices / np.where(convertible, rates, 1.0), prices)
+        target = np.array(currencies, dtype=object)
+        target[convertible] = self.target_currency
+        converted[ambiguous] = np.nan
+        return converted, target
+
+    def comparable_prices(self, raw_records):
+        """Prices of the raw offers in the target currency (NaN where missing), without building a batch."""
+        parsed = {}
+        prices = np.empty(len(raw_records))
+        ambiguous = np.zeros(len(raw_records), dtype=bool)
+        currencies = []
+        for i, record in enumerate(raw_records):
+            prices[i], currency, ambiguous[i] = self._price(record, self.adapters.field_map(record), parsed)
+            currencies.append(currency)
+        return self._convert(prices, currencies, ambiguous)[0]
+
+    def normalize(self, raw_records):
+        """
+        RecordBatch (see SCHEMA) of the raw offers. Unknown currencies keep their price and get no conversion;
+        ambiguous prices keep their original price and are flagged, with no converted price.
+        """
+        count = len(raw_records)
+        ids, names, shops, currencies, reviews = [], [], [], [], []
+        prices = np.empty(count)
+        ambiguous = np.zeros(count, dtype=bool)
+        parsed = {}
+        for i, record in enumerate(raw_records):
+            fields = self.adapters.field_map(record)
+            get = record.get
+            shop_name = get('shop_name')
+            prices[i], currency, ambiguous[i] = self._price(record, fields, parsed)
+            record_id = get(fields['id']) if fields['id'] else None
+            ids.append(None if record_id is None else str(record_id))
+            title = get(fields['name']) if fields['name'] else None
+            names.append(None if title is None else str(title))
+            shops.append(shop_name)
+            currencies.append(currency)
+            reviews.append(get(fields['reviews']) if fields['reviews'] else None)
+
+        converted, target = self._convert(prices, currencies, ambiguous)
+
+        return pa.RecordBatch.from_arrays([
+            pa.array(ids, pa.string()),
+            pa.array(names, pa.string()),
+            pa.array(shops, pa.string()),
+            pa.array(converted, pa.float64(), from_pandas=True),
+            pa.array(target, pa.string()),
+            pa.array(prices, pa.float64(), from_pandas=True),
+            pa.array(currencies, pa.string()),
+            pa.array(score_products(reviews), pa.float64()),
+            pa.array(ambiguous, pa.bool_()),
+        ], schema=SCHEMA)
+
+_default_pipeline = NormalizationPipeline()
+
+def normalize_batch(raw_records):
+    """Normalizes raw offers from any source into a RecordBatch priced in TARGET_CURRENCY."""
+    return _default_pipeline.normalize(raw_records)
+
+def comparable_prices(raw_records):
+    """Prices of raw offers from any source in TARGET_CURRENCY, as a NumPy array."""
+    return _default_pipeline.comparable_prices(raw_records)
+
+def concat_batches(batches):
+    """One Arrow table over several normalized batches, without copying them."""
+    return pa.Table.from_batches(batches, schema=SCHEMA)
@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from knowledge_base import KnowledgeBase
+from ranking import RankingEngine
+from conversation import KB_TOOL_NAME
+from recommendation_cache import normalize_query
+
+DEFAULT_TTL = 30 * 60
+MAX_ENTRIES = 256
+# Shop reliabilities are compared in steps of this size, so EWMA noise does not count as a ranking change
+RELIABILITY_STEP = 0.1
+# Tools that only read what the other calls of the query collected; they run after them
+DEPENDENT_TOOLS = {'rank_products'}
+
+def succeeded(function_name, response):
+    """Whether a tool call did its job: no error, and the local catalog and the ranking actually had offers."""
+    if 'result' not in response:
+        return False
+    try:
+        data = json.loads(response['result']) if isinstance(response['result'], str) else response['result']
+    except ValueError:
+        return True
+    if not isinstance(data, dict):
+        return True
+    if 'error' in data:
+        return False
+    if function_name == 'search_local_catalog':
+        return data.get('fresh', 0) > 0
+    if function_name == 'rank_products':
+        return data.get('candidates', 0) > 0
+    return True
+
+def plan_stages(calls):
+    """
+    Orders recorded calls for replay: every independent call in a first stage, run in parallel, then
+    the calls that read what they collected (ranking). Repeated identical calls run once.
+    """
+    unique = {(name, json.dumps(args, sort_keys=True, default=str)): (name, args) for name, args in calls}
+    independent = [call for call in unique.values() if call[0] not in DEPENDENT_TOOLS]
+    dependent = [call for call in unique.values() if call[0] in DEPENDENT_TOOLS]
+    return [stage for stage in (independent, dependent) if stage]
+
+class PlanCache:
+    def __init__(self, kb: KnowledgeBase, ranking_engine: RankingEngine, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES):
+        """
+        Tool plans the model produced, keyed by normalized query. A later query with the same intent
+        replays the plan's calls directly and asks the model only for the final answer. A plan is
+        only offered while the KB's shops and their reliability ranking are what they were when it
+        was recorded, since those are what the model planned from.
+        """
+        self.kb = kb
+        self.ranking_engine = ranking_engine
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'ranking_changed': 0, 'failed_replays': 0}
+
+    def shop_ranking(self):
+        """Stamp of the known shops ordered by their current reliability."""
+        shop_info = self.ranking_engine.shop_info()
+        order = sorted(shop_info, key=lambda name: (-round(shop_info[name][0] / RELIABILITY_STEP), name))
+        return self.kb.shops_version(), tuple(order)
+
+    def lookup(self, query):
+        """The replay stages recorded for the query, or None when there is no plan or it no longer fits the KB."""
+        key = normalize_query(query)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry['stored_at'] > self.ttl:
+            with self.lock:
+                self.counters['misses'] += 1
+            return None
+        if entry['ranking'] != self.shop_ranking():
+            with self.lock:
+                self.entries.pop(key, None)
+                self.counters['ranking_changed'] += 1
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+        return entry['stages']
+
+    def store(self, query, turns):
+        """
+        Records the plan of a query the model answered. `turns` holds each turn's (calls, responses);
+        calls that failed are left out, since the model only worked around them.
+        """
+        key = normalize_query(query)
+        calls = [call for calls, responses in turns for call, response in zip(calls, responses)
+                 if succeeded(call[0], response)]
+        # A plan that only read the KB gathered nothing worth replaying
+        if not key or all(name == KB_TOOL_NAME for name, _ in calls):
+            return
+        entry = {'stages': plan_stages(calls), 'ranking': self.shop_ranking(), 'stored_at': time.time()}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, query):
+        """Drops the query's plan after a replay of it failed."""
+        with self.lock:
+            if self.entries.pop(normalize_query(query), None) is not None:
+                self.counters['failed_replays'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
@@ -0,0 +1,177 @@
+import re
+import numpy as np
+
+# How well each shipping scope serves the user: local pickup beats cross-border shipping
+SCOPE_SCORES = {'local': 1.0, 'national': 0.7, 'international': 0.4}
+DEFAULT_WEIGHTS = {'price': 0.5, 'quality': 0.3, 'stock': 0.1, 'reliability': 0.1, 'shipping': 0.0}
+NEUTRAL_QUALITY = 5.0
+IN_STOCK_WORDS = {'yes', 'true', 'instock', 'in stock', 'available', 'limitedavailability'}
+OUT_OF_STOCK_WORDS = {'no', 'false', 'outofstock', 'out of stock', 'soldout', 'discontinued'}
+GROUPED_THOUSANDS_RE = re.compile(r'^\d{1,3}([.,]\d{3})+$')
+
+def parse_price(value):
+    """Best-effort numeric price from a number or a formatted string such as '$ 1.299.900' or '1,299.99'."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value is None:
+        return np.nan
+    text = re.sub(r'[^\d.,]', '', str(value))
+    if not text:
+        return np.nan
+    if GROUPED_THOUSANDS_RE.match(text):
+        text = text.replace('.', '').replace(',', '')
+    elif ',' in text and '.' in text:
+        # The separator that appears last is the decimal one
+        text = text.replace('.', '').replace(',', '.') if text.rfind(',') > text.rfind('.') else text.replace(',', '')
+    else:
+        text = text.replace(',', '.')
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+def stock_value(record):
+    """1.0 in stock, 0.0 out of stock, 0.5 when the source does not say."""
+    for key in ('stock', 'in_stock', 'available', 'availability'):
+        value = record.get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return 1.0 if value else 0.0
+        if isinstance(value, (int, float)):
+            return 1.0 if value > 0 else 0.0
+        word = str(value).strip().lower()
+        if word in IN_STOCK_WORDS:
+            return 1.0
+        if word in OUT_OF_STOCK_WORDS:
+            return 0.0
+    return 0.5
+
+def quality_value(record):
+    """Quality on a 0-10 scale: an explicit quality_score, or a 0-5 star rating doubled."""
+    if record.get('quality_score') is not None:
+        return float(record['quality_score'])
+    try:
+        return float(record['rating']) * 2 if record.get('rating') is not None else NEUTRAL_QUALITY
+    except (TypeError, ValueError):
+        return NEUTRAL_QUALITY
+
+def _min_max(values, invert=False):
+    """Scales a column to [0, 1]; missing values score 0 and a constant column scores 1."""
+    result = np.zeros(len(values))
+    known = ~np.isnan(values)
+    if not known.any():
+        return result
+    low, high = values[known].min(), values[known].max()
+    if high == low:
+        result[known] = 1.0
+    else:
+        result[known] = (values[known] - low) / (high - low)
+        if invert:
+            result[known] = 1.0 - result[known]
+    return result
+
+class _ArrowRows:
+    """Row access to an Arrow table or RecordBatch; a row only becomes a dict when it is read."""
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def __getitem__(self, index):
+        return self.table.slice(index, 1).to_pylist()[0]
+
+def _arrow_column(table, name, default):
+    """Float column as a NumPy array (nulls become NaN), or `default` everywhere when the table lacks it."""
+    if name not in table.schema.names:
+        return np.full(table.num_rows, default)
+    return np.asarray(table.column(name).to_numpy(zero_copy_only=False), dtype=float)
+
+class CandidateTable:
+    def __init__(self, records, shop_info=None, prices=None):
+        """
+        Column-oriented view of candidate offers. Every criterion is one NumPy array, so scoring
+        is a handful of vector operations regardless of how many offers there are. Prices are
+        converted to normalization.TARGET_CURRENCY first, unless the caller passes them already converted.
+        """
+        shop_info = shop_info or {}
+        self.records = records
+        if prices is None:
+            # Imported here: normalization builds on this module's price parsing
+            from normalization import comparable_prices
+            # Scaling is only meaningful in one currency: a peso price must not look 4000x dearer than a dollar one
+            prices = comparable_prices(records)
+        self.price = np.asarray(prices, dtype=float)
+        self.quality = np.fromiter((quality_value(r) for r in records), dtype=float, count=len(records))
+        self.stock = np.fromiter((stock_value(r) for r in records), dtype=float, count=len(records))
+        shops = [shop_info.get(r.get('shop_name'), (1.0, 0.5)) for r in records]
+        self.reliability = np.fromiter((s[0] for s in shops), dtype=float, count=len(records))
+        self.shipping = np.fromiter((s[1] for s in shops), dtype=float, count=len(records))
+
+    @classmethod
+    def from_arrow(cls, table, shop_info=None):
+        """
+        Candidate table over normalized Arrow data (a Table or RecordBatch, see normalization.SCHEMA).
+        The criteria are read column-wise and no per-row dicts are built except for the winners.
+        """
+        shop_info = shop_info or {}
+        candidates = cls.__new__(cls)
+        candidates.records = _ArrowRows(table)
+        candidates.price = _arrow_column(table, 'price', np.nan)
+        quality = _arrow_column(table, 'quality_score', NEUTRAL_QUALITY)
+        candidates.quality = np.where(np.isnan(quality), NEUTRAL_QUALITY, quality)
+        candidates.stock = _arrow_column(table, 'stock', 0.5)
+        shops = [shop_info.get(name, (1.0, 0.5)) for name in table.column('shop_name').to_pylist()]
+        candidates.reliability = np.fromiter((s[0] for s in shops), dtype=float, count=len(shops))
+        candidates.shipping = np.fromiter((s[1] for s in shops), dtype=float, count=len(shops))
+        return candidates
+
+    def __len__(self):
+        return len(self.records)
+
+class RankingEngine:
+    def __init__(self, kb=None):
+        """Deterministic, vectorized ranking of offers. The KB, when given, supplies shop reliability and scope."""
+        self.kb = kb
+
+    def shop_info(self):
+        """{shop_name: (reliability, shipping_score)} from the KB's recent per-method success rates."""
+        if self.kb is None:
+            return {}
+        method_stats = self.kb.get_method_stats()
+        info = {}
+        for shop in self.kb.get_all_shops():
+            rates = [s['success_rate'] for s in method_stats.get(shop['name'], {}).values()]
+            reliability = max(rates) if rates else max(shop['api_success_rate'], shop['mcp_success_rate'], shop['scraping_success_rate'])
+            info[shop['name']] = (reliability, SCOPE_SCORES.get(shop['scope'], 0.5))
+        return info
+
+    def score(self, table, weights=None):
+        """Weighted sum of the normalized criteria; price is inverted because cheaper is better."""
+        weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        return (weights['price'] * _min_max(table.price, invert=True)
+                + weights['quality'] * _min_max(table.quality)
+                + weights['stock'] * table.stock
+                + weights['reliability'] * table.reliability
+                + weights['shipping'] * table.shipping)
+
+    def rank(self, records, weights=None, k=3):
+        """
+        Returns the top-k records (copies with a 'rank_score'), best first. Only the k winners
+        are sorted: argpartition selects them in linear time. `records` may be a list of dicts,
+        a CandidateTable, or normalized Arrow data.
+        """
+        if not records:
+            return []
+        if isinstance(records, CandidateTable):
+            table = records
+        elif isinstance(records, list):
+            table = CandidateTable(records, self.shop_info())
+        else:
+            table = CandidateTable.from_arrow(records, self.shop_info())
+        scores = self.score(table, weights)
+        k = min(k, len(table))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(table) else np.arange(len(table))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [dict(table.records[i], rank_score=float(scores[i])) for i in top]
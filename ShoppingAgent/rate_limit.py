@@ -0,0 +1,221 @@
+import asyncio
+import email.utils
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import httpx
+from tenacity import (Retrying, AsyncRetrying, retry_if_exception, stop_after_attempt, stop_before_delay,
+                      wait_random_exponential)
+from tracing import log
+
+# Default per-host limit; hosts listed in the KB's host_limits table get their own
+DEFAULT_HOST_RATE = float(os.getenv("HOST_RATE_LIMIT", "5"))
+DEFAULT_HOST_BURST = float(os.getenv("HOST_RATE_BURST", "10"))
+# After a throttle the host's rate is halved, down to this floor, and recovers step by step on success
+MIN_HOST_RATE = 0.2
+RECOVERY_STEP = 0.1
+# Pause after a 429 that did not say how long to wait
+DEFAULT_THROTTLE_PAUSE = 2.0
+# A tool call never queues behind its own host's limiter for longer than this
+MAX_LIMITER_WAIT = 5.0
+# Network attempts per request; a Retry-After longer than MAX_RETRY_AFTER is not waited out
+MAX_ATTEMPTS = 3
+MAX_RETRY_AFTER = 8.0
+BACKOFF_MULTIPLIER = 0.25
+MAX_BACKOFF = 4.0
+# A request's retries end within this many seconds, inside the tool executor's 20s call timeout:
+# a retry only starts if its wait and its own timeout still fit, so no call outlives its tool call
+RETRY_DEADLINE = float(os.getenv("RETRY_DEADLINE", "18"))
+# Network requests (retries included) one query may send to stores
+QUERY_REQUEST_BUDGET = int(os.getenv("QUERY_REQUEST_BUDGET", "40"))
+
+class Throttled(Exception):
+    def __init__(self, host, status, retry_after=None):
+        """The host answered 429 (or 503 with Retry-After): it is limiting us, not failing."""
+        super().__init__(f"{host} is rate limiting requests (HTTP {status})"
+                         + (f"; retry after {retry_after:.0f}s" if retry_after is not None else ""))
+        self.host = host
+        self.status = status
+        self.retry_after = retry_after
+
+class RateLimited(Exception):
+    def __init__(self, host, retry_in):
+        """Our own limiter would hold the request back too long, so it was not sent."""
+        super().__init__(f"Too many requests to {host} right now; retry in {retry_in:.1f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+class BudgetExhausted(Exception):
+    pass
+
+def host_of(url):
+    return urlsplit(url).netloc.lower()
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RequestBudget:
+    def __init__(self, limit=QUERY_REQUEST_BUDGET):
+        """Network requests one query may still send; shared by the query's concurrent tool calls."""
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if self.used >= self.limit:
+                raise BudgetExhausted(f"This query has used its budget of {self.limit} store requests.")
+            self.used += 1
+
+    def refund(self):
+        with self.lock:
+            self.used = max(0, self.used - 1)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        """`rate` requests per second on average, with bursts of up to `burst`."""
+        self.configured_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, now, max_wait):
+        """
+        Takes a token and returns how long to wait before sending. The balance may go negative: each
+        caller then waits for its own future token. Returns None, taking nothing, if that is beyond max_wait.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(self.blocked_until - now, 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+    def throttled(self, now, retry_after):
+        """The host pushed back: pause until it allows requests again and halve our rate."""
+        self.blocked_until = max(self.blocked_until, now + (retry_after if retry_after is not None else DEFAULT_THROTTLE_PAUSE))
+        self.rate = max(MIN_HOST_RATE, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        self.rate = min(self.configured_rate, self.rate + self.configured_rate * RECOVERY_STEP)
+
+def _retryable(error):
+    # Transport hiccups and throttles with a short enough Retry-After are worth another attempt
+    if isinstance(error, Throttled):
+        return error.retry_after is None or error.retry_after <= MAX_RETRY_AFTER
+    return isinstance(error, httpx.TransportError)
+
+class HostRateLimiter:
+    def __init__(self, kb=None):
+        """
+        Per-host token buckets for store and Places requests, plus the retry policy around them.
+        Limits come from the KB's host_limits table when a KB is attached, otherwise the defaults.
+        """
+        self.kb = kb
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.jitter = wait_random_exponential(multiplier=BACKOFF_MULTIPLIER, max=MAX_BACKOFF)
+
+    def _bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            limits = self.kb.get_host_limits().get(host) if self.kb is not None else None
+            bucket = self.buckets[host] = TokenBucket(*(limits or (DEFAULT_HOST_RATE, DEFAULT_HOST_BURST)))
+        return bucket
+
+    def reload(self):
+        """Applies changed KB limits: buckets are rebuilt on their next use."""
+        with self.lock:
+            self.buckets.clear()
+
+    def _reserve(self, url, budget, max_wait):
+        if budget is not None:
+            budget.spend()
+        host = host_of(url)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self._bucket(host)
+            wait = bucket.reserve(now, max_wait)
+            retry_in = max(bucket.blocked_until - now, 1 / bucket.rate)
+        if wait is None:
+            if budget is not None:
+                budget.refund()
+            raise RateLimited(host, retry_in)
+        return wait
+
+    def acquire(self, url, budget=None, max_wait=MAX_LIMITER_WAIT):
+        """Blocks until a request to the URL's host may go out. Raises RateLimited or BudgetExhausted instead of waiting too long."""
+        wait = self._reserve(url, budget, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, url, budget=None, max_wait=MAX_LIMITER_WAIT):
+        wait = self._reserve(url, budget, max_wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def check(self, url, response):
+        """Raises Throttled for 429, and for 503 with Retry-After; otherwise lets the host's rate recover."""
+        status = response.status_code
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        host = host_of(url)
+        if status == 429 or (status == 503 and retry_after is not None):
+            with self.lock:
+                self._bucket(host).throttled(time.monotonic(), retry_after)
+            log(f"[RateLimit] {host} throttled us (HTTP {status}); backing off.")
+            raise Throttled(host, status, retry_after)
+        with self.lock:
+            self._bucket(host).succeeded()
+
+    def _wait(self, retry_state):
+        """Jittered exponential backoff, but never sooner than the host's Retry-After."""
+        error = retry_state.outcome.exception()
+        retry_after = getattr(error, 'retry_after', None) or 0.0
+        return max(self.jitter(retry_state), retry_after)
+
+    def _stop(self, attempt_timeout):
+        return stop_after_attempt(MAX_ATTEMPTS) | stop_before_delay(max(0.0, RETRY_DEADLINE - attempt_timeout))
+
+    def attempts(self, attempt_timeout=0.0):
+        """
+        Retry loop for one request whose attempts each time out after `attempt_timeout` seconds;
+        each attempt calls acquire() and check() itself:
+            for attempt in limiter.attempts():
+                with attempt:
+                    limiter.acquire(url, budget)
+                    response = transport.get(url)
+                    limiter.check(url, response)
+        """
+        return Retrying(stop=self._stop(attempt_timeout), wait=self._wait, retry=retry_if_exception(_retryable), reraise=True)
+
+    def attempts_async(self, attempt_timeout=0.0):
+        return AsyncRetrying(stop=self._stop(attempt_timeout), wait=self._wait, retry=retry_if_exception(_retryable), reraise=True)
+
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+def get_rate_limiter(kb=None) -> HostRateLimiter:
+    """Returns the process-wide limiter, attaching `kb` as its source of per-host limits if it has none yet."""
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = HostRateLimiter(kb)
+        elif kb is not None and _shared_limiter.kb is None:
+            _shared_limiter.kb = kb
+            _shared_limiter.reload()
+        return _shared_limiter
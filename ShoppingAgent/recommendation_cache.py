@@ -0,0 +1,114 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from knowledge_base import KnowledgeBase
+from catalog import ProductCatalog
+
+DEFAULT_TTL = 10 * 60
+MAX_ENTRIES = 256
+# Token-set overlap (Jaccard) from which a different wording may reuse an answer, e.g. 0.8. Off unless
+# ANSWER_SIMILARITY_THRESHOLD is set: by default only queries that normalize identically share an answer
+SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_SIMILARITY_THRESHOLD")) if os.getenv("ANSWER_SIMILARITY_THRESHOLD") else None
+TOKEN_RE = re.compile(r'\w+')
+# Filler words that do not change what is being searched for (English and Spanish)
+STOP_WORDS = {
+    'a', 'an', 'the', 'i', 'me', 'my', 'want', 'need', 'looking', 'find', 'show', 'get', 'buy', 'please',
+    'some', 'any', 'for', 'of', 'to', 'and', 'with', 'is', 'are', 'can', 'you', 'best',
+    'el', 'la', 'los', 'las', 'un', 'una', 'de', 'del', 'para', 'por', 'con', 'y', 'quiero', 'busco', 'mejor',
+}
+
+def query_tokens(query):
+    """The significant words of a query, ignoring case, order, repetition and filler words."""
+    return frozenset(token for token in TOKEN_RE.findall(query.lower()) if token not in STOP_WORDS)
+
+def normalize_query(query):
+    """'4K TV, cheap!' and 'cheap 4k tv' both become '4k cheap tv'."""
+    return " ".join(sorted(query_tokens(query)))
+
+def _similarity(a, b):
+    """Jaccard overlap of two token sets; 0 when they differ in a number (size, price, model), which changes the product."""
+    if any(any(c.isdigit() for c in token) for token in a ^ b):
+        return 0.0
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+class RecommendationCache:
+    def __init__(self, kb: KnowledgeBase, catalog: ProductCatalog, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES,
+                 similarity_threshold=SIMILARITY_THRESHOLD):
+        """
+        Final answers keyed by normalized query. Each entry remembers the KB's shops version and the
+        digest of every catalog source its offers came from; it is only served while the TTL holds
+        and none of that data has changed, so an answer is never reused after its prices moved.
+        """
+        self.kb = kb
+        self.catalog = catalog
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'similar_hits': 0, 'misses': 0, 'invalidated': 0}
+
+    def _candidates(self, key, tokens):
+        """The exact entry first, then sufficiently similar ones, most similar first."""
+        with self.lock:
+            candidates = [self.entries[key]] if key in self.entries else []
+            if self.similarity_threshold is not None:
+                similar = [(_similarity(tokens, entry['tokens']), entry) for k, entry in self.entries.items() if k != key]
+                similar = [pair for pair in similar if pair[0] >= self.similarity_threshold]
+                candidates += [entry for _, entry in sorted(similar, key=lambda pair: -pair[0])]
+        return candidates
+
+    def _is_valid(self, entry, now, shops_version):
+        if now - entry['stored_at'] > self.ttl or entry['shops_version'] != shops_version:
+            return False
+        return not entry['sources'] or self.catalog.source_digests(entry['sources']) == entry['sources']
+
+    def lookup(self, query):
+        """Returns the cached answer for the query (or a near-identical one), or None."""
+        tokens = query_tokens(query)
+        if not tokens:
+            return None
+        key = " ".join(sorted(tokens))
+        candidates = self._candidates(key, tokens)
+        if not candidates:
+            with self.lock:
+                self.counters['misses'] += 1
+            return None
+
+        now = time.time()
+        shops_version = self.kb.shops_version()
+        for entry in candidates:
+            if self._is_valid(entry, now, shops_version):
+                with self.lock:
+                    if entry['key'] in self.entries:
+                        self.entries.move_to_end(entry['key'])
+                    self.counters['hits' if entry['key'] == key else 'similar_hits'] += 1
+                return entry['answer']
+            with self.lock:
+                if self.entries.pop(entry['key'], None) is not None:
+                    self.counters['invalidated'] += 1
+        with self.lock:
+            self.counters['misses'] += 1
+        return None
+
+    def store(self, query, answer, source_keys):
+        """Caches the answer together with the current digests of the catalog sources it was based on."""
+        tokens = query_tokens(query)
+        if not tokens or not answer:
+            return
+        key = " ".join(sorted(tokens))
+        entry = {
+            'key': key, 'tokens': tokens, 'answer': answer, 'stored_at': time.time(),
+            'shops_version': self.kb.shops_version(), 'sources': self.catalog.source_digests(source_keys)
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries))
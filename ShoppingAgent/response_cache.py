@@ -0,0 +1,164 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from knowledge_base import KnowledgeBase
+from tracing import log
+
+DEFAULT_TTL = 15 * 60
+# Per-shop freshness overrides in seconds; shops not listed use DEFAULT_TTL
+SHOP_TTLS = {
+    'Amazon': 10 * 60,
+    'ebay': 5 * 60,
+}
+MEMORY_MAX_ENTRIES = 256
+DISK_MAX_BYTES = 50 * 1024 * 1024
+# Injected credentials must never become part of a cache key
+IGNORED_PARAMS = {'apiKey'}
+
+class ResponseCache:
+    def __init__(self, kb: KnowledgeBase, shop_ttls=None, default_ttl=DEFAULT_TTL,
+                 memory_max_entries=MEMORY_MAX_ENTRIES, disk_max_bytes=DISK_MAX_BYTES):
+        """
+        Two-tier cache for store responses: an in-memory LRU in front of a persistent
+        table stored in the Knowledge Base's SQLite database.
+        """
+        self.kb = kb
+        self.shop_ttls = dict(SHOP_TTLS if shop_ttls is None else shop_ttls)
+        self.default_ttl = default_ttl
+        self.memory_max_entries = memory_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'revalidations': 0, 'stores': 0, 'evictions': 0}
+        self.create_table()
+
+    def create_table(self):
+        with self.kb.lock, self.kb.conn:
+            self.kb.conn.execute("""
+                                 CREATE TABLE IF NOT EXISTS response_cache (
+                                     key TEXT PRIMARY KEY,
+                                     shop_name TEXT NOT NULL,
+                                     body TEXT NOT NULL,
+                                     etag TEXT,
+                                     last_modified TEXT,
+                                     stored_at REAL NOT NULL,
+                                     last_access REAL NOT NULL,
+                                     size INTEGER NOT NULL
+                                 )
+                                 """)
+
+    @staticmethod
+    def make_key(shop_name, url, params=None):
+        """Builds a stable key from the shop, the URL and the normalized request parameters."""
+        normalized_params = sorted(
+            (str(name), str(value)) for name, value in (params or {}).items() if name not in IGNORED_PARAMS
+        )
+        raw_key = json.dumps([shop_name, url.strip(), normalized_params])
+        return hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+    def ttl_for(self, shop_name):
+        return self.shop_ttls.get(shop_name, self.default_ttl)
+
+    def lookup(self, key, shop_name):
+        """
+        Returns (entry, fresh). A stale entry is still returned so its ETag/Last-Modified
+        can be used for a conditional request; (None, False) means nothing is cached.
+        """
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+
+        if entry is None:
+            entry = self._load_from_disk(key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        fresh = entry is not None and time.time() - entry['stored_at'] < self.ttl_for(shop_name)
+        with self.lock:
+            self.counters['hits' if fresh else 'misses'] += 1
+        return entry, fresh
+
+    def conditional_headers(self, entry):
+        """Revalidation headers for a stale entry."""
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, key, shop_name, body, etag=None, last_modified=None):
+        """Caches a response body (a JSON string) with its validators."""
+        now = time.time()
+        entry = {'body': body, 'etag': etag, 'last_modified': last_modified, 'stored_at': now}
+        self._remember(key, entry)
+        with self.kb.lock, self.kb.conn:
+            self.kb.conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, shop_name, body, etag, last_modified, stored_at, last_access, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, shop_name, body, etag, last_modified, now, now, len(body))
+            )
+        with self.lock:
+            self.counters['stores'] += 1
+        self._evict_disk()
+
+    def mark_revalidated(self, key):
+        """A 304 Not Modified answer restarts the entry's TTL without re-downloading the body."""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                entry['stored_at'] = now
+            self.counters['revalidations'] += 1
+        with self.kb.lock, self.kb.conn:
+            self.kb.conn.execute(
+                "UPDATE response_cache SET stored_at = ?, last_access = ? WHERE key = ?", (now, now, key)
+            )
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, memory_entries=len(self.memory))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _remember(self, key, entry):
+        """Puts an entry at the most-recently-used end of the memory tier, evicting the LRU entry if full."""
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_max_entries:
+                self.memory.popitem(last=False)
+
+    def _load_from_disk(self, key):
+        with self.kb.lock:
+            row = self.kb.conn.execute(
+                "SELECT body, etag, last_modified, stored_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            with self.kb.conn:
+                self.kb.conn.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        return {'body': row[0], 'etag': row[1], 'last_modified': row[2], 'stored_at': row[3]}
+
+    def _evict_disk(self):
+        """Drops the least recently used persistent entries until the table fits in its byte budget."""
+        with self.kb.lock:
+            total_size = self.kb.conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+            if total_size <= self.disk_max_bytes:
+                return
+            victims = []
+            for key, size in self.kb.conn.execute("SELECT key, size FROM response_cache ORDER BY last_access ASC"):
+                if total_size <= self.disk_max_bytes:
+                    break
+                victims.append((key,))
+                total_size -= size
+            with self.kb.conn:
+                self.kb.conn.executemany("DELETE FROM response_cache WHERE key = ?", victims)
+        with self.lock:
+            for (key,) in victims:
+                self.memory.pop(key, None)
+            self.counters['evictions'] += len(victims)
+        log(f"[Cache] Evicted {len(victims)} response(s) to stay under {self.disk_max_bytes} bytes.")
@@ -0,0 +1,155 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+NEUTRAL_SCORE = 5.0
+# Quality points (0-10 scale) per unit of lexicon weight
+POINTS_PER_UNIT = 1.5
+MAX_CACHED_REVIEWS = 50_000
+# Sentiment words and their weights; English and Spanish, since the stores are both
+LEXICON = {
+    'amazing': 1.5, 'incredible': 1.5, 'perfect': 1.5, 'excellent': 1.5, 'fantastic': 1.5, 'outstanding': 1.5,
+    'great': 1.0, 'good': 1.0, 'love': 1.0, 'loved': 1.0, 'awesome': 1.0, 'recommend': 1.0, 'recommended': 1.0,
+    'nice': 0.7, 'solid': 0.7, 'worth': 0.7, 'happy': 0.7, 'fine': 0.4,
+    'bad': -1.0, 'poor': -1.0, 'disappointing': -1.0, 'disappointed': -1.0, 'bulky': -1.0, 'flimsy': -1.0,
+    'broke': -1.0, 'broken': -1.0, 'returned': -0.7, 'refund': -0.7, 'noisy': -0.7, 'slow': -0.5,
+    'terrible': -1.5, 'awful': -1.5, 'horrible': -1.5, 'worst': -1.5, 'useless': -1.5, 'defective': -1.5, 'waste': -1.5,
+    'excelente': 1.5, 'increíble': 1.5, 'perfecto': 1.5, 'perfecta': 1.5, 'genial': 1.0, 'bueno': 1.0, 'buena': 1.0,
+    'buen': 1.0, 'recomendado': 1.0, 'malo': -1.0, 'mala': -1.0, 'decepcionante': -1.0, 'defectuoso': -1.5,
+    'pésimo': -1.5, 'pésima': -1.5,
+}
+# Multiply the next sentiment word of the clause
+INTENSIFIERS = {
+    'very': 1.5, 'really': 1.3, 'extremely': 1.8, 'super': 1.5, 'so': 1.3, 'absolutely': 1.6, 'incredibly': 1.6,
+    'muy': 1.5, 'súper': 1.5, 'bastante': 1.2,
+    'slightly': 0.5, 'somewhat': 0.6, 'bit': 0.6, 'kinda': 0.6, 'poco': 0.6,
+}
+# Flip (and soften) the sentiment words that follow within the clause: "not bad" is mildly positive
+NEGATORS = {
+    'not', 'no', 'never', 'nothing', 'hardly', 'without', "don't", "doesn't", "didn't", "isn't", "wasn't",
+    "aren't", "won't", "can't", 'cannot', 'nunca', 'sin', 'ni',
+}
+NEGATION_FACTOR = -0.5
+NEGATION_SCOPE = 3
+# Punctuation and contrast words end a clause, and with it any pending negation or intensifier
+CLAUSE_BREAKS = {'.', '!', '?', ';', ',', 'but', 'pero', 'aunque'}
+TOKEN_RE = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?|[.!?;,]")
+_MISSING = object()
+
+def sentiment(text):
+    """
+    Lexicon sentiment of one review in a single pass over its tokens. Returns (sum of weights, number of
+    sentiment words): whole words only, so 'goodbye' is not 'good'.
+    """
+    total, hits = 0.0, 0
+    negated_for, multiplier = 0, 1.0
+    for token in TOKEN_RE.findall(text.lower().replace('\u2019', "'")):
+        weight = LEXICON.get(token)
+        if weight is not None:
+            if negated_for:
+                weight *= NEGATION_FACTOR
+            total += weight * multiplier
+            hits += 1
+            multiplier = 1.0
+        elif token in CLAUSE_BREAKS:
+            negated_for, multiplier = 0, 1.0
+            continue
+        elif token in NEGATORS:
+            negated_for = NEGATION_SCOPE + 1
+        elif token in INTENSIFIERS:
+            multiplier *= INTENSIFIERS[token]
+        if negated_for:
+            negated_for -= 1
+    return total, hits
+
+def _review_parts(review):
+    """(text, star rating or None) of one review in any of the sources' shapes."""
+    if isinstance(review, dict):
+        text = review.get('comment') or review.get('text') or review.get('body') or review.get('review') or ''
+        rating = review.get('rating') if review.get('rating') is not None else review.get('stars')
+        try:
+            rating = float(rating) if rating is not None else None
+        except (TypeError, ValueError):
+            rating = None
+        return str(text), rating
+    return ('' if review is None else str(review)), None
+
+def _as_review_list(reviews):
+    """Review lists, `customer_feedback` dicts and a bare `reviews_text` string all become a list."""
+    if reviews is None:
+        return []
+    if isinstance(reviews, (str, dict)):
+        return [reviews]
+    return list(reviews)
+
+class ReviewScorer:
+    def __init__(self, max_cached=MAX_CACHED_REVIEWS):
+        """
+        Scores reviews on the 0-10 quality scale. A review's score is cached under a hash of its text
+        and rating, so re-scoring the same products (re-fetched offers, repeated queries) costs lookups.
+        """
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(text, rating):
+        return hashlib.blake2b(f"{rating}\x00{text}".encode('utf-8'), digest_size=16).digest()
+
+    @staticmethod
+    def _score(text, rating):
+        """None when the review carries no signal (no rating and no sentiment words)."""
+        total, hits = sentiment(text) if text else (0.0, 0)
+        text_score = max(0.0, min(10.0, NEUTRAL_SCORE + POINTS_PER_UNIT * total)) if hits else None
+        if rating is None:
+            return text_score
+        # Ratings are 0-5 stars; the comment, when it says something, moves the score half way
+        rating_score = max(0.0, min(10.0, rating * 2))
+        return rating_score if text_score is None else (rating_score + text_score) / 2
+
+    def score_reviews(self, reviews):
+        """Scores of many reviews in one call, in order; None for reviews without any signal."""
+        parts = [_review_parts(review) for review in reviews]
+        keys = [self._key(text, rating) for text, rating in parts]
+        with self.lock:
+            scores = [self.cache.get(key, _MISSING) for key in keys]
+            # Hits become the most recently used, so eviction drops the least recently used reviews
+            for key, score in zip(keys, scores):
+                if score is not _MISSING:
+                    self.cache.move_to_end(key)
+        missing = {}
+        for i, score in enumerate(scores):
+            if score is _MISSING:
+                if keys[i] not in missing:
+                    missing[keys[i]] = self._score(*parts[i])
+                scores[i] = missing[keys[i]]
+        if missing:
+            with self.lock:
+                self.cache.update(missing)
+                while len(self.cache) > self.max_cached:
+                    self.cache.popitem(last=False)
+        return scores
+
+    def score_products(self, review_lists):
+        """
+        Quality score of each product from its reviews: the mean over the reviews that carry a signal,
+        or the neutral score. All reviews of all products are scored as one batch.
+        """
+        review_lists = [_as_review_list(reviews) for reviews in review_lists]
+        flat_scores = self.score_reviews([review for reviews in review_lists for review in reviews])
+        results, start = [], 0
+        for reviews in review_lists:
+            scores = [s for s in flat_scores[start:start + len(reviews)] if s is not None]
+            start += len(reviews)
+            results.append(sum(scores) / len(scores) if scores else NEUTRAL_SCORE)
+        return results
+
+_default_scorer = ReviewScorer()
+
+def score_products(review_lists):
+    return _default_scorer.score_products(review_lists)
+
+def quality_score(reviews):
+    """0-10 quality of one product from its reviews (list of strings, `customer_feedback` dicts or `reviews_text`)."""
+    return _default_scorer.score_products([reviews])[0]
@@ -0,0 +1,59 @@
+import math
+
+# Weight of the newest sample in the moving averages; ~10 samples are enough to follow a change
+EWMA_ALPHA = 0.2
+# Latency histogram buckets grow geometrically from 1 ms upwards, each 25% wider than the one before
+HISTOGRAM_BASE = 1.25
+HISTOGRAM_MIN_LATENCY = 0.001
+# Existing histogram weight is multiplied by this for every new sample, so old behaviour fades out
+HISTOGRAM_DECAY = 0.99
+PERCENTILES = (0.50, 0.95, 0.99)
+
+def latency_bucket(latency):
+    """Maps a latency in seconds to its log-scale histogram bucket."""
+    return int(math.floor(math.log(max(latency, HISTOGRAM_MIN_LATENCY) / HISTOGRAM_MIN_LATENCY, HISTOGRAM_BASE)))
+
+def bucket_upper_bound(bucket):
+    """Upper latency edge of a bucket, in seconds."""
+    return HISTOGRAM_MIN_LATENCY * HISTOGRAM_BASE ** (bucket + 1)
+
+def ewma_terms(values, alpha=EWMA_ALPHA):
+    """
+    Folds an ordered batch of samples into constants for a single in-SQL update:
+    new = old * decay + addend for an existing average, or `initial` when there is no history yet.
+    """
+    decay, addend = 1.0, 0.0
+    for value in values:
+        decay *= 1 - alpha
+        addend = addend * (1 - alpha) + alpha * value
+    initial = values[0]
+    for value in values[1:]:
+        initial = initial * (1 - alpha) + alpha * value
+    return decay, addend, initial
+
+def histogram_increments(latencies):
+    """Counts a batch of latencies per bucket."""
+    increments = {}
+    for latency in latencies:
+        bucket = latency_bucket(latency)
+        increments[bucket] = increments.get(bucket, 0) + 1
+    return increments
+
+def histogram_percentiles(histogram, percentiles=PERCENTILES):
+    """
+    Reads percentiles from a {bucket: weight} histogram. Each value is the upper edge of the
+    bucket holding that percentile, or None while the histogram is empty.
+    """
+    total = sum(histogram.values())
+    if total <= 0:
+        return {f"p{int(q * 100)}": None for q in percentiles}
+    buckets = sorted(histogram.items())
+    result = {}
+    for q in percentiles:
+        threshold, running = q * total, 0.0
+        for bucket, weight in buckets:
+            running += weight
+            if running >= threshold:
+                break
+        result[f"p{int(q * 100)}"] = bucket_upper_bound(bucket)
+    return result
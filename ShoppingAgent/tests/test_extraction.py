@@ -0,0 +1,11 @@
+from extraction import extract_products
+
+def _card_price(html):
+    return extract_products([html.encode('utf-8')])['products'][0]['price']
+
+def test_digits_in_the_name_are_not_taken_for_the_price():
+    assert _card_price('<div class="product-card"><h2>Item 0</h2><p>COP 1.000</p></div>') == 'COP 1.000'
+    assert _card_price('<div class="product-card"><h2>Item 0</h2><p>1.000 COP</p></div>') == '1.000 COP'
+
+def test_text_of_neighbouring_elements_is_kept_apart():
+    assert _card_price('<div class="product-card"><h2>TV 55</h2><span>$</span><span>1.299.900</span></div>') == '$ 1.299.900'
@@ -0,0 +1,49 @@
+import math
+from normalization import normalize_batch, comparable_prices, parse_locale_price
+
+def _row(record):
+    return normalize_batch([record]).to_pylist()[0]
+
+def test_dollar_price_with_cents_at_a_peso_store_is_usd():
+    row = _row({'title': 'Headphones', 'price_str': '$199.99', 'shop_name': 'Exito'})
+    assert row['original_currency'] == 'USD'
+    assert row['price'] == 199.99
+    assert not row['currency_ambiguous']
+
+def test_grouped_peso_price_is_converted():
+    row = _row({'title': 'Laptop', 'price_str': '$1.299.900', 'shop_name': 'Exito'})
+    assert row['original_currency'] == 'COP'
+    assert row['original_price'] == 1299900
+    assert math.isclose(row['price'], 1299900 / 4000.0)
+
+def test_numeric_price_at_a_peso_store_uses_the_store_currency():
+    row = _row({'sku': 'K1', 'cost': 1299900, 'shop_name': 'Ktronix'})
+    assert row['original_currency'] == 'COP'
+    assert math.isclose(row['price'], 1299900 / 4000.0)
+
+def test_implausibly_low_peso_prices_are_flagged():
+    for record in ({'title': 'Cable', 'price_str': '2.500', 'shop_name': 'Exito'},
+                   {'sku': 'K2', 'cost': 150.0, 'shop_name': 'Ktronix'}):
+        row = _row(record)
+        assert row['currency_ambiguous']
+        assert row['price'] is None
+
+def test_declared_currency_is_never_flagged():
+    row = _row({'product_id': 'P1', 'name': 'Cable', 'price': '2.500', 'currency': 'COP', 'shop_name': 'Exito'})
+    assert not row['currency_ambiguous']
+    assert math.isclose(row['price'], 2500 / 4000.0)
+
+def test_comparable_prices_match_the_batch():
+    records = [{'title': 'A', 'price_str': '$199.99', 'shop_name': 'Exito'},
+               {'sku': 'B', 'cost': 1299900, 'shop_name': 'Ktronix'},
+               {'sku': 'C', 'cost': 150.0, 'shop_name': 'Ktronix'}]
+    prices = comparable_prices(records)
+    assert prices[0] == 199.99
+    assert math.isclose(prices[1], 1299900 / 4000.0)
+    assert math.isnan(prices[2])
+
+def test_trailing_one_or_two_digits_are_decimals_in_any_currency():
+    assert parse_locale_price('199.99', 'COP') == 199.99
+    assert parse_locale_price('1.299.900', 'COP') == 1299900
+    assert parse_locale_price('1.299,90', 'EUR') == 1299.9
+    assert parse_locale_price('1,5', 'USD') == 1.5
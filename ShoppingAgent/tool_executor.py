@@ -0,0 +1,124 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from events import EventBus, ToolCallStarted, ToolCallFinished
+from tracing import log, span, in_current_context
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_CALL_TIMEOUT = 20.0
+# Tool calls in flight at once across every query of an async agent
+DEFAULT_MAX_ASYNC_CALLS = 256
+
+class ToolExecutor:
+    def __init__(self, tool_functions: dict, max_workers=DEFAULT_MAX_WORKERS, call_timeout=DEFAULT_CALL_TIMEOUT, events: EventBus = None):
+        """
+        Runs the tool calls requested in a single model turn concurrently on a bounded thread pool.
+        Every call gets its own timeout and its own error, so one slow or broken store
+        cannot stall or break the rest of the turn.
+        """
+        self.tool_functions = tool_functions
+        self.events = events or EventBus()
+        self.call_timeout = call_timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+
+    def _invoke(self, function_name, function_args):
+        """
+        Runs one tool and returns its output together with its own wall-clock time.
+        Start and finish events come from the worker, so they arrive in completion order.
+        """
+        self.events.emit(ToolCallStarted(function_name, function_args))
+        start_time = time.monotonic()
+        try:
+            with span("tool_call", tool=function_name, shop=function_args.get('shop_name')):
+                output = self.tool_functions[function_name](**function_args)
+        except Exception as e:
+            self.events.emit(ToolCallFinished(function_name, time.monotonic() - start_time, error=str(e)))
+            raise
+        latency = time.monotonic() - start_time
+        self.events.emit(ToolCallFinished(function_name, latency))
+        return output, latency
+
+    def run(self, calls):
+        """
+        Executes a list of (function_name, function_args) pairs and returns one response
+        dict per call, in the same order as the calls: {'result': ...} or {'error': ...}.
+        """
+        futures = []
+        for function_name, function_args in calls:
+            if function_name not in self.tool_functions:
+                futures.append(None)
+                continue
+            # Each call runs under the caller's current span
+            futures.append(self.pool.submit(in_current_context(self._invoke), function_name, function_args))
+
+        # All calls share the same start, so the whole turn is bounded by the slowest call.
+        deadline = time.monotonic() + self.call_timeout
+        responses = []
+        for (function_name, _), future in zip(calls, futures):
+            if future is None:
+                log(f"[ToolExecutor] Unknown tool requested: {function_name}")
+                responses.append({'error': f"Unknown tool '{function_name}'."})
+                continue
+            try:
+                output, latency = future.result(timeout=max(0.0, deadline - time.monotonic()))
+                log(f"[ToolExecutor] {function_name} finished in {latency:.2f}s")
+                responses.append({'result': output})
+            except FutureTimeoutError:
+                future.cancel()
+                log(f"[ToolExecutor] {function_name} timed out after {self.call_timeout:.0f}s")
+                responses.append({'error': f"Tool '{function_name}' timed out after {self.call_timeout:.0f}s."})
+            except Exception as e:
+                log(f"[ToolExecutor] Error executing tool {function_name}: {e}")
+                responses.append({'error': str(e)})
+        return responses
+
+    def shutdown(self):
+        """Releases the worker threads without waiting for calls that already timed out."""
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class AsyncToolExecutor:
+    def __init__(self, tool_functions: dict, max_concurrent_calls=DEFAULT_MAX_ASYNC_CALLS, call_timeout=DEFAULT_CALL_TIMEOUT,
+                 events: EventBus = None):
+        """
+        ToolExecutor for coroutine tools (ToolBox.get_async_tool_functions): a turn's calls run as
+        concurrent tasks instead of pool threads, with the same per-call timeout, errors and events.
+        """
+        self.tool_functions = tool_functions
+        self.events = events or EventBus()
+        self.call_timeout = call_timeout
+        self.max_concurrent_calls = max_concurrent_calls
+        self.semaphores = {}
+
+    def _semaphore(self):
+        # asyncio primitives belong to one event loop
+        loop = asyncio.get_running_loop()
+        if loop not in self.semaphores:
+            self.semaphores = {loop: asyncio.Semaphore(self.max_concurrent_calls)}
+        return self.semaphores[loop]
+
+    async def _invoke(self, function_name, function_args):
+        if function_name not in self.tool_functions:
+            log(f"[ToolExecutor] Unknown tool requested: {function_name}")
+            return {'error': f"Unknown tool '{function_name}'."}
+        async with self._semaphore():
+            self.events.emit(ToolCallStarted(function_name, function_args))
+            start_time = time.monotonic()
+            try:
+                with span("tool_call", tool=function_name, shop=function_args.get('shop_name')):
+                    output = await asyncio.wait_for(self.tool_functions[function_name](**function_args), self.call_timeout)
+            except asyncio.TimeoutError:
+                self.events.emit(ToolCallFinished(function_name, time.monotonic() - start_time, error="timeout"))
+                log(f"[ToolExecutor] {function_name} timed out after {self.call_timeout:.0f}s")
+                return {'error': f"Tool '{function_name}' timed out after {self.call_timeout:.0f}s."}
+            except Exception as e:
+                self.events.emit(ToolCallFinished(function_name, time.monotonic() - start_time, error=str(e)))
+                log(f"[ToolExecutor] Error executing tool {function_name}: {e}")
+                return {'error': str(e)}
+        latency = time.monotonic() - start_time
+        self.events.emit(ToolCallFinished(function_name, latency))
+        log(f"[ToolExecutor] {function_name} finished in {latency:.2f}s")
+        return {'result': output}
+
+    async def run(self, calls):
+        """Async ToolExecutor.run: one response dict per (function_name, function_args) call, in call order."""
+        return list(await asyncio.gather(*(self._invoke(name, args) for name, args in calls)))
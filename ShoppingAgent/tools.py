@@ -1,89 +1,430 @@
-import requests
+import asyncio
 import json
 import time
 import os
-from bs4 import BeautifulSoup
+import threading
+import contextvars
 from knowledge_base import KnowledgeBase
+from transport import get_transport, get_async_transport
+from response_cache import ResponseCache
+from extraction import extract_products, ProductExtractor
+from ranking import RankingEngine, CandidateTable
+from normalization import normalize_batch
+from circuit_breaker import BreakerRegistry
+from rate_limit import get_rate_limiter, RequestBudget, Throttled, RateLimited, BudgetExhausted
+from catalog import ProductCatalog
+from events import EventBus, ProductsFound
+from tracing import log, span
+
+# Timeout of one network attempt; the limiter fits its retries into the tool call around them
+API_TIMEOUT = 10
+SCRAPE_TIMEOUT = 15
+
+class QueryState:
+    def __init__(self):
+        """What one query gathered (its offers and the catalog sources they came from) and its store request budget."""
+        self.offers = []
+        self.sources = set()
+        self.budget = RequestBudget()
+        self.lock = threading.Lock()
+
+    def reset_results(self):
+        """Drops the offers and sources gathered so far. The budget is kept: the requests were sent."""
+        with self.lock:
+            self.offers = []
+            self.sources = set()
 
 class ToolBox:
-    def __init__(self, kb: KnowledgeBase):
+    def __init__(self, kb: KnowledgeBase, events: EventBus = None):
         """Initializes the ToolBox with the single, shared Knowledge Base instance."""
-        print("[ToolBox] Initialized with shared Knowledge Base.")
+        log("[ToolBox] Initialized with shared Knowledge Base.")
         self.kb = kb
+        self.events = events or EventBus()
+        self.transport = get_transport()
+        self.cache = ResponseCache(kb)
+        self.ranking_engine = RankingEngine(kb)
+        # Dead endpoints fail fast instead of burning a full timeout on every query
+        self.breakers = BreakerRegistry(kb)
+        # Per-host request rates (from the KB) and retries that back off when a store throttles us
+        self.limiter = get_rate_limiter(kb)
+        # Offers returned by the store tools during the current query; rank_products ranks these.
+        # The ToolBox is shared by every session, so each query keeps its pool in its own context.
+        self.query_state = contextvars.ContextVar("query_state", default=None)
+        # Every offer fetched from a store is also indexed locally for later queries
+        self.catalog = ProductCatalog(kb)
+        self.catalog.fetch = self._refresh_source
+        self.local = threading.local()
+
+    def start_query(self) -> QueryState:
+        """Starts a fresh offer pool for the query running in this context."""
+        state = QueryState()
+        self.query_state.set(state)
+        return state
+
+    def current_query(self) -> QueryState:
+        """State of the current query; tools called outside a query get a state of their own."""
+        state = self.query_state.get()
+        return state if state is not None else self.start_query()
+
+    def _collect_offers(self, shop_name: str, output: str, source: tuple = None, fetched_at: float = None) -> str:
+        """
+        Remembers the product records found in a tool's JSON output and returns the output unchanged.
+        Offers from a store request (`source` = (tool name, args)), fetched or served from the response
+        cache, are also added to the catalog, so the request counts among the query's sources. A cached
+        response passes its `fetched_at`, so the catalog does not take it for a fresh fetch.
+        """
+        try:
+            data = json.loads(output)
+        except ValueError:
+            return output
+        if isinstance(data, dict):
+            data = next((data[key] for key in ('products', 'items', 'results') if isinstance(data.get(key), list)), [])
+        offers = [dict(item, shop_name=item.get('shop_name', shop_name)) for item in data if isinstance(item, dict)] if isinstance(data, list) else []
+        source_key = self.catalog.add_offers(shop_name, offers, *source, fetched_at=fetched_at) if source and offers else None
+        if getattr(self.local, 'background', False):
+            # A background catalog refresh is not part of the current query
+            return output
+        state = self.current_query()
+        with state.lock:
+            state.offers.extend(offers)
+            if source_key:
+                state.sources.add(source_key)
+        if offers:
+            self.events.emit(ProductsFound(shop_name, offers))
+        return output
+
+    def _refresh_source(self, tool_name: str, args: dict):
+        """Replays a store request for the catalog's background refresh, under a request budget of its own."""
+        self.local.background = True
+        # The refresh thread would otherwise keep one implicit QueryState whose budget never resets
+        token = self.query_state.set(QueryState())
+        try:
+            getattr(self, tool_name)(**args)
+        finally:
+            self.query_state.reset(token)
+            self.local.background = False
 
     def get_shop_details_from_kb(self) -> str:
         """
         Retrieves the list of shops, their capabilities, and current performance from the knowledge base.
         This should be the FIRST tool called to decide which shops to contact and how.
         """
-        print("    > Querying Knowledge Base for all shop details...")
+        log("    > Querying Knowledge Base for all shop details...")
         all_shops = self.kb.get_all_shops()
+        # Per-method stats (own request counts, recent success/latency, p50/p95/p99) drive the routing decision
+        method_stats = self.kb.get_method_stats()
+        # Methods listed under circuit_breakers are failing right now and will be rejected until retry_in elapses
+        breaker_states = self.breakers.states()
+        for shop in all_shops:
+            shop['method_stats'] = method_stats.get(shop['name'], {})
+            shop['circuit_breakers'] = breaker_states.get(shop['name'], {})
         return json.dumps(all_shops)
 
-    def _update_performance(self, shop_name: str, method: str, latency: float, success: bool):
-        """Internal helper to automatically update the KB."""
+    def _update_performance(self, shop_name: str, method: str, latency: float, success: bool, cached: bool = False,
+                            throttled: bool = False):
+        """Internal helper to automatically update the KB and the method's circuit breaker."""
         if method in ['api', 'mcp', 'scraping']:
-            self.kb.update_shop_performance(shop_name, method, latency, success)
+            self.kb.update_shop_performance(shop_name, method, latency, success, cached=cached, throttled=throttled)
+            # Being throttled says nothing about whether the endpoint works
+            if throttled:
+                self.breakers.release(shop_name, method)
+            elif not cached:
+                self.breakers.record(shop_name, method, success)
 
-    def make_api_request(self, shop_name: str, url: str, params: dict, headers: dict) -> str:
+    def _not_sent(self, shop_name: str, method: str, error: Exception) -> str:
+        """Output for a request our own limiter or the query's budget held back; nothing is recorded."""
+        log(f"    > Not sending request for '{shop_name}': {error}")
+        self.breakers.release(shop_name, method)
+        output = {"error": str(error)}
+        if isinstance(error, RateLimited):
+            output.update(throttled=True, retry_in=round(error.retry_in, 1))
+        else:
+            output['budget_exhausted'] = True
+        return json.dumps(output)
+
+    def _cancelled(self, shop_name: str, method: str, request: dict, sent: bool):
         """
-        Makes an API request to the given URL and AUTOMATICALLY records its performance in the KB.
-        The LLM must provide the shop_name and the url from the KB.
+        Records a call the async executor cancelled at its timeout. One that reached the store failed
+        like any timed-out call; one still held by the limiter only frees its breaker probe.
+        """
+        log(f"    > Request for '{shop_name}' ({method}) was cancelled.")
+        if sent:
+            self._update_performance(shop_name, method, time.monotonic() - request['start_time'], False)
+        else:
+            self.breakers.release(shop_name, method)
+
+    def _throttled_output(self, error: Throttled) -> str:
+        return json.dumps({"error": str(error), "throttled": True, "retry_after": error.retry_after})
+
+    def _circuit_open(self, shop_name: str, method: str) -> str:
+        retry_in = self.breakers.retry_in(shop_name, method)
+        log(f"    > Circuit open for '{shop_name}' ({method}); failing fast.")
+        return json.dumps({"error": f"The {method} endpoint of '{shop_name}' is failing and temporarily disabled. "
+                                    f"Retry in {retry_in:.0f}s or use another method or shop.", "circuit_open": True})
+
+    def _prepare_api_request(self, shop_name: str, url: str, params: dict, headers: dict):
+        """
+        Everything make_api_request does before the network. Returns (output, None) when the cache
+        or an open circuit answers, otherwise (None, request) holding what the call and its result need.
         """
         start_time = time.monotonic()
+        params = dict(params or {})
+        headers = dict(headers or {})
+        source = ('make_api_request', {'shop_name': shop_name, 'url': url, 'params': dict(params), 'headers': dict(headers)})
+
+        # Identical requests are answered from the cache while fresh
+        cache_key = self.cache.make_key(shop_name, url, params)
+        cached_entry, fresh = self.cache.lookup(cache_key, shop_name)
+        if fresh:
+            log(f"    > Serving cached API response for '{shop_name}' at: {url}")
+            self._update_performance(shop_name, 'api', time.monotonic() - start_time, True, cached=True)
+            return self._collect_offers(shop_name, cached_entry['body'], source, cached_entry['stored_at']), None
+        headers.update(self.cache.conditional_headers(cached_entry))
+        if not self.breakers.allow(shop_name, 'api'):
+            return self._circuit_open(shop_name, 'api'), None
 
         # Format the shop name to create a standard environment variable name (e.g., "Best Buy" -> "BESTBUY_API_KEY")
         env_var_name = f"{shop_name.replace(' ', '').upper()}_API_KEY"
         api_key = os.getenv(env_var_name)
 
         if api_key:
-            print(f"    > Found API key for '{shop_name}' in env var '{env_var_name}'.")
-            if params is None:
-                params = {}
+            log(f"    > Found API key for '{shop_name}' in env var '{env_var_name}'.")
             # Add the key to params. We assume the key name is 'apiKey', a common convention.
             if 'apiKey' not in params:
                 params['apiKey'] = api_key
-                print("      Injecting 'apiKey' into request parameters.")
+                log("      Injecting 'apiKey' into request parameters.")
+
+        log(f"    > Making API request for '{shop_name}' at: {url}")
+        return None, {'start_time': start_time, 'params': params, 'headers': headers, 'source': source,
+                      'cache_key': cache_key, 'cached_entry': cached_entry}
 
+    def _finish_api_request(self, shop_name: str, request: dict, response=None, error: Exception = None) -> str:
+        """Turns the store's response (or the transport error) into the tool output and records the outcome."""
+        if isinstance(error, Throttled):
+            self._update_performance(shop_name, 'api', time.monotonic() - request['start_time'], False, throttled=True)
+            return self._throttled_output(error)
         try:
-            print(f"    > Making API request for '{shop_name}' at: {url}")
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            response.raise_for_status()
-            result = response.json()
+            if error is not None:
+                raise error
+            if response.status_code == 304 and request['cached_entry']:
+                # Revalidated: the store confirmed our cached copy is still current
+                self.cache.mark_revalidated(request['cache_key'])
+                output = request['cached_entry']['body']
+            else:
+                response.raise_for_status()
+                output = json.dumps(response.json())
+                self.cache.store(request['cache_key'], shop_name, output,
+                                 response.headers.get('ETag'), response.headers.get('Last-Modified'))
             success = True
         except Exception as e:
-            result = {"error": str(e)}
+            output = json.dumps({"error": str(e)})
             success = False
-        
-        latency = time.monotonic() - start_time
+
+        latency = time.monotonic() - request['start_time']
         self._update_performance(shop_name, 'api', latency, success)
-        
-        return json.dumps(result)
+
+        return self._collect_offers(shop_name, output, request['source'])
+
+    def make_api_request(self, shop_name: str, url: str, params: dict, headers: dict) -> str:
+        """
+        Makes an API request to the given URL and AUTOMATICALLY records its performance in the KB.
+        The LLM must provide the shop_name and the url from the KB.
+        """
+        output, request = self._prepare_api_request(shop_name, url, params, headers)
+        if request is None:
+            return output
+        budget = self.current_query().budget
+        try:
+            for attempt in self.limiter.attempts(API_TIMEOUT):
+                with attempt:
+                    self.limiter.acquire(url, budget)
+                    response = self.transport.get(url, params=request['params'], headers=request['headers'], timeout=API_TIMEOUT)
+                    self.limiter.check(url, response)
+        except (RateLimited, BudgetExhausted) as e:
+            return self._not_sent(shop_name, 'api', e)
+        except Exception as e:
+            return self._finish_api_request(shop_name, request, error=e)
+        return self._finish_api_request(shop_name, request, response)
+
+    async def make_api_request_async(self, shop_name: str, url: str, params: dict, headers: dict) -> str:
+        """make_api_request on the event loop's async transport; KB and catalog writes run on a worker thread."""
+        output, request = self._prepare_api_request(shop_name, url, params, headers)
+        if request is None:
+            return output
+        budget = self.current_query().budget
+        transport = get_async_transport()
+        sent = False
+        try:
+            async for attempt in self.limiter.attempts_async(API_TIMEOUT):
+                with attempt:
+                    await self.limiter.acquire_async(url, budget)
+                    sent = True
+                    response = await transport.get(url, params=request['params'], headers=request['headers'], timeout=API_TIMEOUT)
+                    self.limiter.check(url, response)
+        except asyncio.CancelledError:
+            # Cancellation skips _finish_api_request, which would have recorded the call and settled its breaker
+            self._cancelled(shop_name, 'api', request, sent)
+            raise
+        except (RateLimited, BudgetExhausted) as e:
+            return self._not_sent(shop_name, 'api', e)
+        except Exception as e:
+            return await asyncio.to_thread(self._finish_api_request, shop_name, request, error=e)
+        return await asyncio.to_thread(self._finish_api_request, shop_name, request, response)
+
+    def _prepare_scrape(self, shop_name: str, url: str):
+        """Like _prepare_api_request, for scrape_website."""
+        start_time = time.monotonic()
+        source = ('scrape_website', {'shop_name': shop_name, 'url': url})
+        cache_key = self.cache.make_key(shop_name, url)
+        cached_entry, fresh = self.cache.lookup(cache_key, shop_name)
+        if fresh:
+            log(f"    > Serving cached scrape for '{shop_name}' at: {url}")
+            self._update_performance(shop_name, 'scraping', time.monotonic() - start_time, True, cached=True)
+            return self._collect_offers(shop_name, cached_entry['body'], source, cached_entry['stored_at']), None
+        if not self.breakers.allow(shop_name, 'scraping'):
+            return self._circuit_open(shop_name, 'scraping'), None
+
+        log(f"    > Scraping website for '{shop_name}' at: {url}")
+        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)...'}
+        headers.update(self.cache.conditional_headers(cached_entry))
+        return None, {'start_time': start_time, 'url': url, 'headers': headers, 'source': source,
+                      'cache_key': cache_key, 'cached_entry': cached_entry}
+
+    def _finish_scrape(self, shop_name: str, request: dict, response=None, extraction: dict = None, error: Exception = None) -> str:
+        if isinstance(error, Throttled):
+            self._update_performance(shop_name, 'scraping', time.monotonic() - request['start_time'], False, throttled=True)
+            return self._throttled_output(error)
+        if error is None and response.status_code == 304 and request['cached_entry']:
+            self.cache.mark_revalidated(request['cache_key'])
+            self._update_performance(shop_name, 'scraping', time.monotonic() - request['start_time'], True)
+            return self._collect_offers(shop_name, request['cached_entry']['body'], request['source'])
+        if error is None:
+            result = {'url': request['url'], **extraction}
+            log(f"    > Extracted {len(extraction['products'])} product(s) from {extraction['bytes_read']} bytes.")
+            self.cache.store(request['cache_key'], shop_name, json.dumps(result),
+                             response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            success = True
+        else:
+            result = {"error": str(error)}
+            success = False
+
+        latency = time.monotonic() - request['start_time']
+        self._update_performance(shop_name, 'scraping', latency, success)
+
+        return self._collect_offers(shop_name, json.dumps(result), request['source'])
 
     def scrape_website(self, shop_name: str, url: str) -> str:
         """
         Scrapes a website at the given URL and AUTOMATICALLY records its performance in the KB.
         Used as a fallback. The LLM must provide the shop_name and a constructed search url.
+        Returns a compact list of products (name, price, currency, url...) extracted from the page.
         """
-        start_time = time.monotonic()
+        output, request = self._prepare_scrape(shop_name, url)
+        if request is None:
+            return output
+        budget = self.current_query().budget
         try:
-            print(f"    > Scraping website for '{shop_name}' at: {url}")
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)...'}
-            response = requests.get(url, headers=headers, timeout=15)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, 'html.parser')
-            for el in soup(["script", "style"]): el.decompose()
-            text = '\n'.join(chunk for chunk in (phrase.strip() for line in (line.strip() for line in soup.get_text().splitlines()) for phrase in line.split("  ")) if chunk)
-            result = {'url': url, 'content': text[:20000]}
-            success = True
+            for attempt in self.limiter.attempts(SCRAPE_TIMEOUT):
+                with attempt:
+                    self.limiter.acquire(url, budget)
+                    # Stream the page into the extractor and stop downloading once its byte or item budget is hit
+                    with self.transport.stream("GET", url, headers=request['headers'], timeout=SCRAPE_TIMEOUT) as response:
+                        if response.status_code == 304 and request['cached_entry']:
+                            return self._finish_scrape(shop_name, request, response)
+                        self.limiter.check(url, response)
+                        response.raise_for_status()
+                        extraction = extract_products(response.iter_bytes(), encoding=response.charset_encoding)
+        except (RateLimited, BudgetExhausted) as e:
+            return self._not_sent(shop_name, 'scraping', e)
         except Exception as e:
-            result = {"error": str(e)}
-            success = False
-            
-        latency = time.monotonic() - start_time
-        self._update_performance(shop_name, 'scraping', latency, success)
-        
-        return json.dumps(result)
+            return self._finish_scrape(shop_name, request, error=e)
+        return self._finish_scrape(shop_name, request, response, extraction)
+
+    async def scrape_website_async(self, shop_name: str, url: str) -> str:
+        """scrape_website on the event loop's async transport, parsing chunks as they arrive."""
+        output, request = self._prepare_scrape(shop_name, url)
+        if request is None:
+            return output
+        budget = self.current_query().budget
+        transport = get_async_transport()
+        sent = False
+        extraction = None
+        try:
+            async for attempt in self.limiter.attempts_async(SCRAPE_TIMEOUT):
+                with attempt:
+                    await self.limiter.acquire_async(url, budget)
+                    sent = True
+                    async with transport.stream("GET", url, headers=request['headers'], timeout=SCRAPE_TIMEOUT) as response:
+                        if response.status_code == 304 and request['cached_entry']:
+                            # Not modified: _finish_scrape serves the cached body below
+                            break
+                        self.limiter.check(url, response)
+                        response.raise_for_status()
+                        with span("html_parse") as parse_span:
+                            extractor = ProductExtractor(encoding=response.charset_encoding)
+                            async for chunk in response.aiter_bytes():
+                                if extractor.feed(chunk):
+                                    break
+                            extraction = extractor.result()
+                            parse_span.set(bytes_read=extraction['bytes_read'], products=len(extraction['products']))
+        except asyncio.CancelledError:
+            self._cancelled(shop_name, 'scraping', request, sent)
+            raise
+        except (RateLimited, BudgetExhausted) as e:
+            return self._not_sent(shop_name, 'scraping', e)
+        except Exception as e:
+            return await asyncio.to_thread(self._finish_scrape, shop_name, request, error=e)
+        return await asyncio.to_thread(self._finish_scrape, shop_name, request, response, extraction)
+
+    def search_local_catalog(self, query: str, max_price: float = None, shop_names: list[str] = None, limit: int = 10) -> str:
+        """
+        Searches the offers fetched from the stores by earlier queries, in milliseconds, without contacting any store.
+        Each offer has its age_seconds; stale ones are refreshed in the background. If enough fresh offers match,
+        rank them with rank_products instead of calling the stores again. Optionally filter by max_price and shop_names.
+        """
+        start_time = time.monotonic()
+        offers = self.catalog.search(query, max_price=max_price, shop_names=shop_names, limit=limit)
+        source_keys = {offer.pop('source_key') for offer in offers}
+        state = self.current_query()
+        with state.lock:
+            state.offers.extend(offers)
+            state.sources.update(source_keys)
+        by_shop = {}
+        for offer in offers:
+            by_shop.setdefault(offer['shop_name'], []).append(offer)
+        for shop_name, shop_offers in by_shop.items():
+            self.events.emit(ProductsFound(shop_name, shop_offers))
+        fresh = sum(1 for offer in offers if not offer['stale'])
+        elapsed_ms = (time.monotonic() - start_time) * 1000
+        log(f"    > Local catalog: {len(offers)} offer(s) for '{query}' ({fresh} fresh) in {elapsed_ms:.1f} ms.")
+        return json.dumps({'offers': offers, 'fresh': fresh, 'stale': len(offers) - fresh})
+
+    def rank_products(self, top_k: int = 3, price_weight: float = 0.5, quality_weight: float = 0.3, stock_weight: float = 0.1,
+                      reliability_weight: float = 0.1, shipping_weight: float = 0.0, shop_names: list[str] = None) -> str:
+        """
+        Ranks every offer collected by make_api_request and scrape_website during this query and returns the top_k.
+        Weights are relative importances: lower price, review quality, stock, shop reliability (from the KB) and local shipping.
+        Optionally restrict the ranking to shop_names. Prefer this tool over comparing long product lists yourself.
+        Prices are compared in one currency: each result carries normalized_price and normalized_currency.
+        """
+        start_time = time.monotonic()
+        state = self.current_query()
+        with state.lock:
+            offers = [o for o in state.offers if not shop_names or o.get('shop_name') in shop_names]
+        # The same product can come from the catalog and from the store; keep the latest copy
+        offers = list({(o.get('shop_name'), o.get('name') or o.get('title') or id(o)): o for o in offers}.values())
+        weights = {'price': price_weight, 'quality': quality_weight, 'stock': stock_weight,
+                   'reliability': reliability_weight, 'shipping': shipping_weight}
+        # Every offer is converted to one currency in a single batch before prices are compared
+        normalized = normalize_batch(offers)
+        offers = [dict(offer, normalized_price=price, normalized_currency=currency) for offer, price, currency
+                  in zip(offers, normalized.column('price').to_pylist(), normalized.column('currency').to_pylist())]
+        candidates = CandidateTable(offers, self.ranking_engine.shop_info(),
+                                    prices=normalized.column('price').to_numpy(zero_copy_only=False))
+        ranked = self.ranking_engine.rank(candidates, weights, k=top_k) if offers else []
+        elapsed_ms = (time.monotonic() - start_time) * 1000
+        log(f"    > Ranked {len(offers)} offer(s) in {elapsed_ms:.1f} ms.")
+        return json.dumps({'candidates': len(offers), 'ranked': ranked})
 
     def get_tool_functions(self) -> dict:
         """Returns the dictionary of simplified, self-reporting tools."""
@@ -91,4 +432,20 @@ class ToolBox:
             "get_shop_details_from_kb": self.get_shop_details_from_kb,
             "make_api_request": self.make_api_request,
             "scrape_website": self.scrape_website,
+            "search_local_catalog": self.search_local_catalog,
+            "rank_products": self.rank_products,
         }
+
+    def get_async_tool_functions(self) -> dict:
+        """
+        Coroutine versions of the tools, for the async agent. Store calls use the async transport;
+        the local tools (KB, catalog, ranking) run on a worker thread so they never block the event loop.
+        """
+        tools = {name: _in_thread(function) for name, function in self.get_tool_functions().items()}
+        tools.update(make_api_request=self.make_api_request_async, scrape_website=self.scrape_website_async)
+        return tools
+
+def _in_thread(function):
+    async def run(**kwargs):
+        return await asyncio.to_thread(function, **kwargs)
+    return run
@@ -0,0 +1,196 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# Tracing is off unless AGENT_TRACING=1 or enable() is called; AGENT_TRACE_FILE adds a JSONL exporter
+TRACING_ENABLED = os.getenv("AGENT_TRACING", "0") == "1"
+TRACE_FILE = os.getenv("AGENT_TRACE_FILE")
+# log() still prints to the console unless AGENT_CONSOLE_LOG=0
+CONSOLE_LOG = os.getenv("AGENT_CONSOLE_LOG", "1") != "0"
+DEFAULT_BUFFER_SPANS = 2000
+MAX_EVENTS_PER_SPAN = 100
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_current_buffer = contextvars.ContextVar("trace_buffer", default=None)
+
+class TraceBuffer:
+    def __init__(self, max_spans=DEFAULT_BUFFER_SPANS):
+        """Ring buffer of finished spans. The oldest spans are dropped, so memory stays bounded."""
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def recent(self, limit=None):
+        """Finished spans as dicts, oldest first."""
+        with self.lock:
+            spans = list(self.spans)
+        return [span.to_dict() for span in spans[-limit if limit else 0:]]
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+class JsonlExporter:
+    def __init__(self, path):
+        """Appends one finished span per line, with OTLP-style field names, to `path`."""
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_otlp(), default=str)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+
+_default_buffer = TraceBuffer()
+_exporters = [JsonlExporter(TRACE_FILE)] if TRACE_FILE else []
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'events', 'status',
+                 'start_time', 'start_counter', 'duration', 'buffer', '_token')
+
+    def __init__(self, name, attributes):
+        parent = _current_span.get()
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.events = []
+        self.status = 'ok'
+        self.duration = None
+        self.buffer = _current_buffer.get() or _default_buffer
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, message):
+        if len(self.events) < MAX_EVENTS_PER_SPAN:
+            self.events.append((time.time(), message))
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start_counter
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.status = 'error'
+            self.attributes['error'] = f"{exc_type.__name__}: {exc}"
+        self.buffer.add(self)
+        for exporter in _exporters:
+            try:
+                exporter.export(self)
+            except OSError as e:
+                print(f"[Tracing] Could not export span: {e}")
+        return False
+
+    def to_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'start': self.start_time, 'duration': self.duration, 'status': self.status,
+                'attributes': dict(self.attributes), 'events': [{'time': t, 'message': message} for t, message in self.events]}
+
+    def to_otlp(self):
+        start_ns = int(self.start_time * 1e9)
+        return {
+            'traceId': self.trace_id, 'spanId': self.span_id, 'parentSpanId': self.parent_id or "",
+            'name': self.name, 'startTimeUnixNano': start_ns, 'endTimeUnixNano': start_ns + int(self.duration * 1e9),
+            'attributes': [{'key': key, 'value': value} for key, value in self.attributes.items()],
+            'events': [{'timeUnixNano': int(t * 1e9), 'name': message} for t, message in self.events],
+            'status': {'code': 'STATUS_CODE_ERROR' if self.status == 'error' else 'STATUS_CODE_OK'},
+        }
+
+class _NoopSpan:
+    """Returned by span() while tracing is off: entering, setting and logging do nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add_event(self, message):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def span(name, **attributes):
+    """
+    Context manager timing one unit of work, nested under the current span of this context:
+        with span("http_request", url=url) as s:
+            s.set(status=response.status_code)
+    """
+    if not TRACING_ENABLED:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+def log(message):
+    """Diagnostic line: printed to the console and attached to the current span as an event."""
+    if TRACING_ENABLED:
+        current = _current_span.get()
+        if current is not None:
+            current.add_event(message)
+    if CONSOLE_LOG:
+        print(message)
+
+def enable(trace_file=None):
+    global TRACING_ENABLED
+    if trace_file and not any(getattr(e, 'path', None) == trace_file for e in _exporters):
+        _exporters.append(JsonlExporter(trace_file))
+    TRACING_ENABLED = True
+
+def disable():
+    global TRACING_ENABLED
+    TRACING_ENABLED = False
+
+def set_console_log(enabled):
+    global CONSOLE_LOG
+    CONSOLE_LOG = enabled
+
+def use_buffer(buffer):
+    """Routes spans started in this context (e.g. one Streamlit session) to `buffer`. Returns a reset token."""
+    return _current_buffer.set(buffer)
+
+def in_current_context(function):
+    """Wraps `function` so it runs in a copy of the caller's context when handed to another thread."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+def format_tree(spans):
+    """Renders span dicts (as returned by TraceBuffer.recent) as an indented tree, one line per span and event."""
+    span_ids = {s['span_id'] for s in spans}
+    children = {}
+    for s in spans:
+        parent = s['parent_id'] if s['parent_id'] in span_ids else None
+        children.setdefault(parent, []).append(s)
+    lines = []
+
+    def render(s, depth):
+        attributes = ", ".join(f"{k}={v}" for k, v in s['attributes'].items() if v is not None)
+        marker = " !" if s['status'] == 'error' else ""
+        lines.append(f"{'  ' * depth}{s['name']} {s['duration'] * 1000:.1f} ms{marker}" + (f" [{attributes}]" if attributes else ""))
+        # Log lines and child spans interleaved in the order they happened
+        entries = [(e['time'], e['message']) for e in s['events']] + [(c['start'], c) for c in children.get(s['span_id'], [])]
+        for _, entry in sorted(entries, key=lambda e: e[0]):
+            if isinstance(entry, dict):
+                render(entry, depth + 1)
+            else:
+                lines.append(f"{'  ' * (depth + 1)}· {entry.strip()}")
+
+    for root in sorted(children.get(None, []), key=lambda s: s['start']):
+        render(root, 0)
+    return "\n".join(lines)
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import threading
+import weakref
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlsplit
+import httpx
+from tracing import span
+
+# Pool sizes can be tuned per deployment through the environment
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "10"))
+MAX_KEEPALIVE_PER_HOST = int(os.getenv("HTTP_MAX_KEEPALIVE_PER_HOST", "5"))
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+def _http2_available():
+    """HTTP/2 in httpx needs the optional 'h2' package."""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+class HttpTransport:
+    def __init__(self, max_connections_per_host=MAX_CONNECTIONS_PER_HOST, max_keepalive_per_host=MAX_KEEPALIVE_PER_HOST,
+                 keepalive_expiry=KEEPALIVE_EXPIRY, http2=None):
+        """
+        Shared HTTP layer for the tools and discovery. Each host gets its own keep-alive
+        connection pool, so repeated calls to the same store skip the TCP+TLS handshake.
+        """
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host,
+            max_keepalive_connections=max_keepalive_per_host,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.http2 = _http2_available() if http2 is None else http2
+        self.clients = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def _client_for(self, url):
+        """Returns the pooled client for the URL's origin, creating it on first use."""
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self.lock:
+            client = self.clients.get(origin)
+            if client is None:
+                client = self._new_client()
+                self.clients[origin] = client
+                self.stats[origin] = {'requests': 0, 'new_connections': 0, 'reused_connections': 0, 'errors': 0}
+        return origin, client
+
+    def _new_client(self):
+        return httpx.Client(limits=self.limits, http2=self.http2, follow_redirects=True)
+
+    def _trace_hook(self, connected):
+        def trace(event_name, info):
+            # httpcore only opens a TCP connection when the pool has no idle one to reuse
+            if event_name == "connection.connect_tcp.complete":
+                connected.append(True)
+        return trace
+
+    def _traced(self, kwargs):
+        """Adds an httpcore trace hook to the request kwargs and returns the list it marks on a new TCP connect."""
+        connected = []
+        extensions = dict(kwargs.pop('extensions', None) or {})
+        extensions['trace'] = self._trace_hook(connected)
+        kwargs['extensions'] = extensions
+        return connected
+
+    def _record(self, origin, connected, failed=False):
+        with self.lock:
+            stats = self.stats[origin]
+            stats['requests'] += 1
+            if failed:
+                stats['errors'] += 1
+            else:
+                stats['new_connections' if connected else 'reused_connections'] += 1
+
+    def request(self, method, url, **kwargs):
+        """Sends a request through the host's pool. Raises httpx.HTTPError subclasses on transport errors."""
+        origin, client = self._client_for(url)
+        connected = self._traced(kwargs)
+        with span("http_request", method=method, origin=origin) as request_span:
+            try:
+                response = client.request(method, url, **kwargs)
+            except httpx.HTTPError:
+                self._record(origin, connected, failed=True)
+                raise
+            self._record(origin, connected)
+            request_span.set(status=response.status_code, new_connection=bool(connected))
+        return response
+
+    @contextmanager
+    def stream(self, method, url, **kwargs):
+        """Like request(), but the body is read lazily so callers can stop downloading early."""
+        origin, client = self._client_for(url)
+        connected = self._traced(kwargs)
+        recorded = False
+        # The span covers the whole streamed download, not just the headers
+        with span("http_request", method=method, origin=origin, streamed=True) as request_span:
+            try:
+                with client.stream(method, url, **kwargs) as response:
+                    self._record(origin, connected)
+                    recorded = True
+                    request_span.set(status=response.status_code, new_connection=bool(connected))
+                    yield response
+            except httpx.HTTPError:
+                if not recorded:
+                    self._record(origin, connected, failed=True)
+                raise
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def metrics(self):
+        """Per-origin request counts and how many of those requests reused a pooled connection."""
+        with self.lock:
+            metrics = {}
+            for origin, stats in self.stats.items():
+                answered = stats['new_connections'] + stats['reused_connections']
+                metrics[origin] = dict(stats, reuse_ratio=stats['reused_connections'] / answered if answered else 0.0)
+            return metrics
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+class AsyncHttpTransport(HttpTransport):
+    """
+    The same per-host pools and metrics on httpx.AsyncClient: request(), stream(), get() and head()
+    are coroutines. Async clients belong to one event loop; use get_async_transport() to get the loop's own.
+    """
+    def _new_client(self):
+        return httpx.AsyncClient(limits=self.limits, http2=self.http2, follow_redirects=True)
+
+    def _trace_hook(self, connected):
+        # httpcore awaits trace hooks of async connections
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                connected.append(True)
+        return trace
+
+    async def request(self, method, url, **kwargs):
+        origin, client = self._client_for(url)
+        connected = self._traced(kwargs)
+        with span("http_request", method=method, origin=origin) as request_span:
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.HTTPError:
+                self._record(origin, connected, failed=True)
+                raise
+            self._record(origin, connected)
+            request_span.set(status=response.status_code, new_connection=bool(connected))
+        return response
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        origin, client = self._client_for(url)
+        connected = self._traced(kwargs)
+        recorded = False
+        with span("http_request", method=method, origin=origin, streamed=True) as request_span:
+            try:
+                async with client.stream(method, url, **kwargs) as response:
+                    self._record(origin, connected)
+                    recorded = True
+                    request_span.set(status=response.status_code, new_connection=bool(connected))
+                    yield response
+            except httpx.HTTPError:
+                if not recorded:
+                    self._record(origin, connected, failed=True)
+                raise
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def head(self, url, **kwargs):
+        return await self.request("HEAD", url, **kwargs)
+
+    async def close(self):
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            await client.aclose()
+
+_shared_transport = None
+_shared_transport_lock = threading.Lock()
+_async_transports = weakref.WeakKeyDictionary()
+
+def get_transport() -> HttpTransport:
+    """Returns the process-wide transport, creating it on first use."""
+    global _shared_transport
+    with _shared_transport_lock:
+        if _shared_transport is None:
+            _shared_transport = HttpTransport()
+        return _shared_transport
+
+def configure_transport(**kwargs) -> HttpTransport:
+    """Replaces the process-wide transport with one using the given pool settings."""
+    global _shared_transport
+    with _shared_transport_lock:
+        if _shared_transport is not None:
+            _shared_transport.close()
+        _shared_transport = HttpTransport(**kwargs)
+        return _shared_transport
+
+def get_async_transport() -> AsyncHttpTransport:
+    """Returns the async transport of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    with _shared_transport_lock:
+        transport = _async_transports.get(loop)
+        if transport is None:
+            transport = _async_transports[loop] = AsyncHttpTransport()
+        return transport